@@ -1,4 +1,50 @@
 -- create table which will contain all the played matches
 CREATE TABLE matches(
-	match_id		varchar(40) PRIMARY KEY
-)
+	match_id		varchar(40) PRIMARY KEY,
+	-- statistics download state - 'pending', 'leased' (claimed by a worker until `lease_expires_at`), 'done', 'failed'
+	-- or 'unavailable' (see `unavailable_matches`)
+	download_status		varchar(16) NOT NULL DEFAULT 'pending',
+	download_attempts	integer NOT NULL DEFAULT 0,
+	leased_by		varchar(100),
+	lease_expires_at	timestamptz,
+	last_error		text,
+	created_at		timestamptz NOT NULL DEFAULT now(),
+	downloaded_at		timestamptz
+);
+
+-- work queue of the statistics downloads (see `MatchesRepository.claim_downloads`)
+CREATE INDEX matches_download_status_idx ON matches(download_status, match_id);
+
+-- players (PUUIDs) who played the matches, one match can be shared by several crawled players
+CREATE TABLE player_matches(
+	puuid			varchar(78) NOT NULL,
+	match_id		varchar(40) NOT NULL REFERENCES matches(match_id),
+	PRIMARY KEY (puuid, match_id)
+);
+
+CREATE INDEX player_matches_match_id_idx ON player_matches(match_id);
+
+-- tombstones of the matches the Riot API doesn't have (anymore) - they are not requested again,
+-- unless `next_check_at` is set (recheck policy) and has passed
+CREATE TABLE unavailable_matches(
+	match_id		varchar(40) PRIMARY KEY,
+	reason			text NOT NULL,
+	first_seen_at		timestamptz NOT NULL DEFAULT now(),
+	checked_at		timestamptz NOT NULL DEFAULT now(),
+	checks			integer NOT NULL DEFAULT 1,
+	next_check_at		timestamptz
+);
+
+-- crawl progress of every (player, queue, type) query of the crawl filter - the oldest match id of the last stored page,
+-- resumed crawls continue from it (-1 / '' for all the queues / types)
+CREATE TABLE crawl_cursors(
+	puuid			varchar(78) NOT NULL,
+	queue			integer NOT NULL,
+	match_type		varchar(16) NOT NULL,
+	oldest_match_id		varchar(40) NOT NULL,
+	-- position of the crawl - `crawled` matches ended before `end_time` (epoch seconds)
+	end_time		bigint,
+	crawled			integer,
+	updated_at		timestamptz NOT NULL DEFAULT now(),
+	PRIMARY KEY (puuid, queue, match_type)
+);
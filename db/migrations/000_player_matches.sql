@@ -0,0 +1,9 @@
+-- players (PUUIDs) who played the matches for databases created before the roster crawl (`init.sql` already contains it)
+-- psql -U $DB_USER -d $DB_NAME -f db/migrations/000_player_matches.sql
+CREATE TABLE IF NOT EXISTS player_matches(
+	puuid			varchar(78) NOT NULL,
+	match_id		varchar(40) NOT NULL REFERENCES matches(match_id),
+	PRIMARY KEY (puuid, match_id)
+);
+
+CREATE INDEX IF NOT EXISTS player_matches_match_id_idx ON player_matches(match_id);
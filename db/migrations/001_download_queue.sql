@@ -0,0 +1,12 @@
+-- statistics download work queue for databases created before it (`init.sql` already contains it)
+-- psql -U $DB_USER -d $DB_NAME -f db/migrations/001_download_queue.sql
+ALTER TABLE matches
+	ADD COLUMN IF NOT EXISTS download_status	varchar(16) NOT NULL DEFAULT 'pending',
+	ADD COLUMN IF NOT EXISTS download_attempts	integer NOT NULL DEFAULT 0,
+	ADD COLUMN IF NOT EXISTS leased_by		varchar(100),
+	ADD COLUMN IF NOT EXISTS lease_expires_at	timestamptz,
+	ADD COLUMN IF NOT EXISTS last_error		text,
+	ADD COLUMN IF NOT EXISTS created_at		timestamptz NOT NULL DEFAULT now(),
+	ADD COLUMN IF NOT EXISTS downloaded_at		timestamptz;
+
+CREATE INDEX IF NOT EXISTS matches_download_status_idx ON matches(download_status, match_id);
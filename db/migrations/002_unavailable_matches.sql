@@ -0,0 +1,10 @@
+-- tombstones of the unavailable matches for databases created before them (`init.sql` already contains them)
+-- psql -U $DB_USER -d $DB_NAME -f db/migrations/002_unavailable_matches.sql
+CREATE TABLE IF NOT EXISTS unavailable_matches(
+	match_id		varchar(40) PRIMARY KEY,
+	reason			text NOT NULL,
+	first_seen_at		timestamptz NOT NULL DEFAULT now(),
+	checked_at		timestamptz NOT NULL DEFAULT now(),
+	checks			integer NOT NULL DEFAULT 1,
+	next_check_at		timestamptz
+);
@@ -0,0 +1,10 @@
+-- crawl progress per crawl filter query for databases created before it (`init.sql` already contains it)
+-- psql -U $DB_USER -d $DB_NAME -f db/migrations/003_crawl_cursors.sql
+CREATE TABLE IF NOT EXISTS crawl_cursors(
+	puuid			varchar(78) NOT NULL,
+	queue			integer NOT NULL,
+	match_type		varchar(16) NOT NULL,
+	oldest_match_id		varchar(40) NOT NULL,
+	updated_at		timestamptz NOT NULL DEFAULT now(),
+	PRIMARY KEY (puuid, queue, match_type)
+);
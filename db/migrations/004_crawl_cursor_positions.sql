@@ -0,0 +1,4 @@
+-- crawl positions of the crawl cursors for databases created before them (`init.sql` already contains them)
+-- psql -U $DB_USER -d $DB_NAME -f db/migrations/004_crawl_cursor_positions.sql
+ALTER TABLE crawl_cursors ADD COLUMN IF NOT EXISTS end_time bigint;
+ALTER TABLE crawl_cursors ADD COLUMN IF NOT EXISTS crawled integer;
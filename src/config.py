@@ -4,10 +4,22 @@ from dotenv import load_dotenv
 load_dotenv(override=True)
 
 rate_limits = dict(
-    per_second=20 - 3,  # 3 requests as buffer so RITO doesn't ban us O:)
-    per_minute=50 - 3,
+    # initial limits only, the real ones are taken from the `X-App-Rate-Limit` response headers
+    per_second=int(os.getenv('LOL_RATE_LIMIT_PER_SECOND', 20)),
+    per_minute=int(os.getenv('LOL_RATE_LIMIT_PER_MINUTE', 50)),
+    # one of 'spread', 'burst', 'max_throughput' (see utils.throttled_task_runner.PacingPolicy)
+    policy=os.getenv('LOL_RATE_LIMIT_POLICY', 'burst'),
+    # how many times a request is retried after 429/5xx responses
+    max_retries=int(os.getenv('LOL_MAX_RETRIES', 5)),
 )
 
+# Method (per endpoint) rate limits as `(value, time_window)`, enforced on top of the app rate limits.
+# Initial values only, the real ones are taken from the `X-Method-Rate-Limit` response headers.
+method_rate_limits = {
+    'match-v5.getMatchIdsByPUUID': [(2000, 10)],
+    'match-v5.getMatch': [(2000, 10)],
+}
+
 riot_api = dict(
     puuid=os.getenv('LOL_PUUID'),
     match_snapshot=os.getenv('LOL_MATCH_SNAPSHOT'),
@@ -23,11 +35,36 @@ postgres = dict(
     secret=os.getenv('DB_SECRET'),
     db_name=os.getenv('DB_NAME'),
     port=os.getenv('DB_PORT'),
-    host=os.getenv('DB_HOST')
+    host=os.getenv('DB_HOST'),
+    # connection pool - every worker checks out a connection per unit of work
+    pool_min_size=int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+    pool_max_size=int(os.getenv('DB_POOL_MAX_SIZE', 8)),
+    # seconds to wait for a free connection before failing
+    pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
 )
 
 endpoints = dict(
-    lol_base_url=os.getenv('LOL_BASE_URL')
+    # regional routing host, `{region}` is one of americas/europe/asia/sea
+    regional_base_url=os.getenv('LOL_REGIONAL_BASE_URL', 'https://{region}.api.riotgames.com'),
+    # region of players without explicit region and of unknown match platforms
+    default_region=os.getenv('LOL_REGION', 'europe'),
+    # pooled connections per regional session
+    connections_per_region=int(os.getenv('LOL_CONNECTIONS_PER_REGION', 20)),
+)
+
+# Match id platform prefix (e.g. `EUN1_3691872431`) -> routing region
+PLATFORM_REGIONS = {
+    'NA1': 'americas', 'BR1': 'americas', 'LA1': 'americas', 'LA2': 'americas',
+    'EUW1': 'europe', 'EUN1': 'europe', 'TR1': 'europe', 'RU': 'europe', 'ME1': 'europe',
+    'KR': 'asia', 'JP1': 'asia',
+    'OC1': 'sea', 'PH2': 'sea', 'SG2': 'sea', 'TH2': 'sea', 'TW2': 'sea', 'VN2': 'sea',
+}
+
+match_cache = dict(
+    # number of match payloads kept in memory (LRU), 0 disables the in-memory tier
+    memory_entries=int(os.getenv('LOL_MATCH_CACHE_ENTRIES', 256)),
+    # directory of the persistent cache, disk tier is disabled when not set
+    disk_dir=os.getenv('LOL_MATCH_CACHE_DIR'),
 )
 
 logging = dict(
@@ -37,10 +74,119 @@ logging = dict(
 exports = dict(
     csv_export_dir=os.getenv('CSV_EXPORT_DIR'),
     match_files_dir=os.getenv('LOL_MATCH_FILES_DIR'),
+    # worker processes decoding and transforming the matches
+    processes=int(os.getenv('EXPORT_PROCESSES', os.cpu_count() or 1)),
+    # matches sent to a worker process at once
+    batch_size=int(os.getenv('EXPORT_BATCH_SIZE', 64)),
+    # compute only the requested columns (`CSV_EXPORT_COLUMNS`) instead of all the team metrics
+    extraction_plan=os.getenv('EXPORT_EXTRACTION_PLAN', 'true').lower() == 'true',
+    # export file format - `csv`, `ndjson` or `arff` (Weka)
+    format=os.getenv('EXPORT_FORMAT', 'csv').lower(),
+    # sparse ARFF rows (zeros omitted) for wide, mostly-zero exports
+    sparse_arff=os.getenv('EXPORT_SPARSE_ARFF', 'false').lower() == 'true',
+    # export file write buffer (bytes), rows are written in batches on a writer thread
+    write_buffer_size=int(os.getenv('EXPORT_WRITE_BUFFER_SIZE', 1 << 20)),
+    # append only new matches to the previous export (see `manifest_file`)
+    incremental=os.getenv('EXPORT_INCREMENTAL', 'false').lower() == 'true',
+    # what was exported by the previous export
+    manifest_file=os.getenv('EXPORT_MANIFEST_FILE', os.path.join(os.getenv('CSV_EXPORT_DIR') or '.', 'manifest.json')),
+)
+
+fetch_matches = dict(
+    # number of match ids fetched per request (max 100)
+    page_size=int(os.getenv('FETCH_MATCHES_PAGE_SIZE', 100)),
+    # number of pages requested ahead of the one being stored
+    prefetch_pages=int(os.getenv('FETCH_MATCHES_PREFETCH_PAGES', 4)),
+)
+
+crawl_filter = dict(
+    # queue ids to crawl (comma separated), all the queues when empty - e.g. `400,420,430,440,450,490` for the
+    # Summoner's Rift and ARAM PvP queues, the only ones the export keeps. The API takes one queue per request,
+    # so every queue id is crawled separately
+    queues=[int(queue) for queue in os.getenv('LOL_CRAWL_QUEUES', '').split(',') if queue.strip()],
+    # match types to crawl (comma separated `ranked`, `normal`, `tourney`, `tutorial`), all the types when empty
+    types=[match_type.strip() for match_type in os.getenv('LOL_CRAWL_TYPES', '').split(',') if match_type.strip()],
+    # crawl only the matches started in this range - epoch seconds or ISO date (`2024-01-01`), open when not set
+    start_time=os.getenv('LOL_CRAWL_START_TIME'),
+    end_time=os.getenv('LOL_CRAWL_END_TIME'),
+)
+
+store_matches = dict(
+    # COPY the match ids into a staging table and merge them (instead of a row by row insert)
+    bulk=os.getenv('STORE_MATCHES_BULK', 'true').lower() == 'true',
+    # flush the accumulated match ids once there are this many of them...
+    flush_size=int(os.getenv('STORE_MATCHES_FLUSH_SIZE', 5000)),
+    # ...or after this many seconds
+    flush_interval=float(os.getenv('STORE_MATCHES_FLUSH_INTERVAL', 5)),
+)
+
+fetch_statistics = dict(
+    # number of coroutines downloading match statistics concurrently (per routing region)
+    workers=int(os.getenv('FETCH_STATISTICS_WORKERS', 8)),
+    # max number of requests in flight at once (shared by all the workers of a region)
+    max_in_flight=int(os.getenv('FETCH_STATISTICS_MAX_IN_FLIGHT', 8)),
+    # match ids read from the database at once (and queued ahead per region)
+    id_batch_size=int(os.getenv('FETCH_STATISTICS_ID_BATCH_SIZE', 1000)),
+    # claim the matches from the download work queue in the `matches` table (`download_status`), so several
+    # processes/machines can download together and re-runs continue where they stopped - otherwise all the matches are downloaded
+    queue=os.getenv('FETCH_STATISTICS_QUEUE', 'true').lower() == 'true',
+    # seconds the claimed matches stay leased to the worker, the leases are renewed while the worker runs
+    lease_seconds=float(os.getenv('FETCH_STATISTICS_LEASE_SECONDS', 300)),
+    # download attempts of a match before it is given up (`failed`)
+    max_attempts=int(os.getenv('FETCH_STATISTICS_MAX_ATTEMPTS', 5)),
+    # stream the responses straight into the match files (no JSON decoding/re-encoding)
+    streaming=os.getenv('FETCH_STATISTICS_STREAMING', 'true').lower() == 'true',
+    # gzip the streamed match files (`{match_id}.json.gz`)
+    compress=os.getenv('FETCH_STATISTICS_COMPRESS', 'false').lower() == 'true',
+)
+
+pipeline = dict(
+    # lists of stored match ids waiting for the downloads (the crawl waits when the downloads fall behind)
+    stored_queue_size=int(os.getenv('PIPELINE_STORED_QUEUE_SIZE', 4)),
+    # downloaded matches waiting for the export (the downloads wait when the export falls behind)
+    downloaded_queue_size=int(os.getenv('PIPELINE_DOWNLOADED_QUEUE_SIZE', 1000)),
+    # what the pipeline exported - its exports are partial (matches downloaded by the run), so they have their own manifest
+    manifest_file=os.getenv('PIPELINE_MANIFEST_FILE', os.path.join(os.getenv('CSV_EXPORT_DIR') or '.', 'pipeline_manifest.json')),
+)
+
+unavailable_matches = dict(
+    # days after which the matches the Riot API responded 404 for are requested again, 0 never checks them again
+    recheck_after_days=float(os.getenv('LOL_UNAVAILABLE_RECHECK_DAYS', 0)),
+)
+
+projection = dict(
+    # store slim match records - the projection is applied at download time. Trade-off: the responses are decoded
+    # and re-encoded, so the download streaming (`FETCH_STATISTICS_STREAMING`) is off, and the stored files lack
+    # the dropped keys for good (unless `keep_raw`) - hence opt-in
+    enabled=os.getenv('LOL_MATCH_PROJECTION', 'false').lower() == 'true',
+    # participant/team sub-objects not used by the export
+    drop_participant_keys=['challenges', 'perks', 'missions'],
+    drop_team_keys=['bans'],
+    # keep the full raw payloads as well (one `{match_id}.json` file per match in `raw_dir`)
+    keep_raw=os.getenv('LOL_KEEP_RAW_MATCHES', 'false').lower() == 'true',
+    raw_dir=os.getenv('LOL_RAW_MATCH_FILES_DIR'),
+)
+
+storage = dict(
+    # 'files' - one JSON file per match in `match_files_dir`, 'archive' - packed segment archive
+    backend=os.getenv('LOL_MATCH_STORAGE', 'files'),
+    archive_dir=os.getenv('LOL_MATCH_ARCHIVE_DIR'),
+    segment_size=int(os.getenv('LOL_MATCH_ARCHIVE_SEGMENT_SIZE', 256 * 1024 * 1024)),
+)
+
+schemas = dict(
+    # compile the export extraction per game version (`gameVersion`) and report schema drift between patches
+    enabled=os.getenv('LOL_SCHEMA_REGISTRY', 'true').lower() == 'true',
+    # reference match payloads (`version_<gameVersion>.json`) the schema registry starts with
+    snapshots_dir=os.getenv('LOL_MATCH_SNAPSHOTS_DIR', os.path.join(os.path.dirname(__file__), '..', 'match_snapshots')),
 )
 
-# TODO: make more generic
-PUUIDS = [
+# Roster of players whose matches are crawled (comma separated `LOL_PUUIDS`), their team is the "friendly" one.
+# Entries are `puuid` or `region:puuid` for players outside of the default region.
+_roster = [player.strip() for player in os.getenv('LOL_PUUIDS', '').split(',') if player.strip()]
+PUUID_REGIONS = {player.split(':')[-1]: player.split(':')[0] for player in _roster if ':' in player}
+# Falls back to the single `LOL_PUUID` player of older deployments
+PUUIDS = [player.split(':')[-1] for player in _roster] or ([riot_api['puuid']] if riot_api['puuid'] else None) or [
     'FiB--8fS9Kzsy8zwtz0afbpDSFc1GPtSvnH9jqBkwWGABj1ZN2bRMU2rXar6M31jXBKLlo_sfVUT_w',
     'YkhJDHjPwoRT6sBHoP8bDmIbWL5E5wZ5fOBjYZm9ACA2J5BkI_cbzZmBJMIH2ruLJxQwSLh1slBi7w'
 ]
@@ -1,5 +1,6 @@
 import logging
-import psycopg
+from psycopg_pool import AsyncConnectionPool
+from psycopg.conninfo import make_conninfo
 
 from db.executor import Executor
 import config
@@ -17,20 +18,30 @@ _pg_connection_dict = {
 
 
 async def init_db():
-    conn = await psycopg.AsyncConnection.connect(**_pg_connection_dict)
-    cur = conn.cursor()
-    exec = Executor(conn, cur)
+    """
+    Opens the connection pool - workers check out a connection per unit of work (see `Executor`).
+    """
+    pool = AsyncConnectionPool(
+        conninfo=config.postgres['connection_string'] or make_conninfo(
+            **{key: value for key, value in _pg_connection_dict.items() if value is not None}
+        ),
+        min_size=config.postgres['pool_min_size'],
+        max_size=config.postgres['pool_max_size'],
+        timeout=config.postgres['pool_timeout'],
+        name='lol-weka',
+        open=False,
+    )
+    await pool.open(wait=True)
+    exec = Executor(pool)
+    logger.info(f"[*] Database pool opened ({config.postgres['pool_min_size']}-{config.postgres['pool_max_size']} connections)")
 
     async def teardown():
         logger.info("[-] Database teardown in progress...")
-        if not cur.closed:
-            await cur.close()
+        logger.info(f"[.] Database pool statistics: {exec.stats()}")
+        if not pool.closed:
+            await pool.close()
         else:
-            logger.warning("[!] Database cursor is already closed.")
-        if not conn.closed:
-            await conn.close()
-        else:
-            logger.warning("[!] Database connection is already closed.")
-    return conn, cur, exec, teardown
+            logger.warning("[!] Database pool is already closed.")
+    return pool, exec, teardown
 
 __all__ = ['init_db']
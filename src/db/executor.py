@@ -1,26 +1,45 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
 import logging
 
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+
 logger = logging.getLogger(__name__)
 
 
 class Executor:
     """
-    Execute the queries and commit the changes on success to the database,
-    otherwise rollback the changes
+    Hands out pooled connections - one per unit of work. The changes of the unit of work are
+    committed on success to the database, otherwise rolled back, so a failing worker never
+    disrupts the transactions of the other workers.
 
     Closing a connection without committing the changes first will
     cause an implicit rollback to be performed - https://www.psycopg.org/docs/connection.html
     """
 
-    def __init__(self, conn, cur):
-        self.conn = conn
-        self.cur = cur
+    def __init__(self, pool: AsyncConnectionPool):
+        self.pool = pool
 
-    async def executemany(self, query, params_seq, returning=False):
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[AsyncConnection]:
+        """ Checks out a connection for one unit of work (waits if the pool is exhausted). """
         try:
-            await self.cur.executemany(query=query, params_seq=params_seq, returning=returning)
-            await self.conn.commit()
+            async with self.pool.connection() as conn:
+                yield conn
         except Exception as e:
-            logger.critical(f"[!] An error occurred at executemany, rollback initiated")
-            await self.conn.rollback()
+            logger.critical(f"[!] An error occurred in a unit of work, rollback initiated: {e}")
             raise
+
+    def stats(self) -> Dict[str, int]:
+        """ Pool statistics - connections in use, waiting requests and the time they waited. """
+        stats = self.pool.get_stats()
+        return {
+            'size': stats.get('pool_size', 0),
+            'in_use': stats.get('pool_size', 0) - stats.get('pool_available', 0),
+            'waiting': stats.get('requests_waiting', 0),
+            'requests': stats.get('requests_num', 0),
+            'queued_requests': stats.get('requests_queued', 0),
+            'wait_ms': stats.get('requests_wait_ms', 0),
+            'errors': stats.get('requests_errors', 0),
+        }
@@ -1,31 +1,306 @@
+from dataclasses import dataclass
+
+# the match is not known to be unavailable (or its tombstone is due for a recheck)
+_NOT_UNAVAILABLE = (
+    "NOT EXISTS (SELECT 1 FROM unavailable_matches u WHERE u.match_id = matches.match_id "
+    "AND (u.next_check_at IS NULL OR u.next_check_at > now()))"
+)
+
+
+def _platforms_filter(platforms: list[str] | None, known_platforms: list[str] | None) -> tuple[str, tuple]:
+    """
+    SQL condition (and its params) of the match ids of the `platforms` (their prefix, e.g. `EUN1_3691872431`),
+    plus the ids of platforms other than `known_platforms`, if given. True for None `platforms`.
+    """
+    if platforms is None:
+        return "TRUE", ()
+    patterns = [f"{platform}\\_%" for platform in platforms]
+    if known_platforms is None:
+        return "match_id ILIKE ANY(%s)", (patterns,)
+    return "(match_id ILIKE ANY(%s) OR match_id NOT ILIKE ALL(%s))", (patterns, [f"{platform}\\_%" for platform in known_platforms])
+
+
+@dataclass
+class BulkSaveResult:
+    """ Outcome of a bulk save - rows inserted vs. skipped as already stored. """
+    inserted_matches: int
+    skipped_matches: int
+    inserted_player_matches: int
+    skipped_player_matches: int
+
+
+@dataclass
+class CrawlCursor:
+    """
+    Crawl progress of a `(puuid, queue, match type)` query - its oldest crawled match and the position
+    within the pages of the crawl (`crawled` matches ended before the fixed `end_time`, epoch seconds).
+    Cursors saved before the positions existed only have the oldest match.
+    """
+    oldest_match_id: str
+    end_time: int | None = None
+    crawled: int | None = None
+
+
 class MatchesRepository:
+    """
+    Queries of the crawled matches - every method takes the connection of the caller's unit of work
+    (see `Executor.connection`), which commits or rolls back the changes.
+    """
 
-    async def save_matches(self, exec, matches):
+    async def save_matches(self, conn, matches):
         query = "INSERT INTO matches (match_id) VALUES (%s) ON CONFLICT (match_id) DO NOTHING;"
-        await exec.executemany(query=query, params_seq=matches)
+        async with conn.cursor() as cur:
+            await cur.executemany(query=query, params_seq=matches)
 
-    async def get_all_matches(self, cur) -> list[str]:
+    async def save_player_matches(self, conn, puuid: str, matches: list[str]):
         """
-        Get all matches from the database.
+        Save the player <-> match mapping (matches have to be already saved).
         """
-        await cur.execute("SELECT match_id FROM matches ORDER BY match_id DESC")
-        rows = await cur.fetchall()
-        return [row[0] for row in rows]
+        query = "INSERT INTO player_matches (puuid, match_id) VALUES (%s, %s) ON CONFLICT (puuid, match_id) DO NOTHING;"
+        async with conn.cursor() as cur:
+            await cur.executemany(query=query, params_seq=[(puuid, match_id) for match_id in matches])
 
-    async def get_matches_older_than(self, cur, match_id: str | None) -> list[str]:
+    async def bulk_save_player_matches(self, conn, player_matches: list[tuple[str, str]]) -> BulkSaveResult:
         """
-        Get all matches older than the given match id (from newest to oldest). None for all matches. 
+        Saves `(puuid, match_id)` pairs (both the matches and the player <-> match mapping) -
+        the pairs are `COPY`-ed into a staging table and merged by two set based inserts,
+        instead of a round trip per row.
+        """
+        unique_matches = len({match_id for _, match_id in player_matches})
+        unique_player_matches = len(set(player_matches))
+        async with conn.cursor() as cur:
+            # session scoped, emptied by every commit
+            await cur.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS player_matches_staging "
+                "(puuid varchar(78) NOT NULL, match_id varchar(40) NOT NULL) ON COMMIT DELETE ROWS;"
+            )
+            async with cur.copy("COPY player_matches_staging (puuid, match_id) FROM STDIN") as copy:
+                for player_match in player_matches:
+                    await copy.write_row(player_match)
+            await cur.execute(
+                "INSERT INTO matches (match_id) SELECT DISTINCT match_id FROM player_matches_staging "
+                "ON CONFLICT (match_id) DO NOTHING;"
+            )
+            inserted_matches = cur.rowcount
+            await cur.execute(
+                "INSERT INTO player_matches (puuid, match_id) SELECT DISTINCT puuid, match_id FROM player_matches_staging "
+                "ON CONFLICT (puuid, match_id) DO NOTHING;"
+            )
+            inserted_player_matches = cur.rowcount
+        return BulkSaveResult(
+            inserted_matches=inserted_matches,
+            skipped_matches=unique_matches - inserted_matches,
+            inserted_player_matches=inserted_player_matches,
+            skipped_player_matches=unique_player_matches - inserted_player_matches,
+        )
+
+    async def count_matches_older_than(self, conn, match_id: str | None) -> int:
+        """
+        Count the matches older than the given match id (except the unavailable ones). None for all matches.
         """
         if match_id is None:
-            return await self.get_all_matches(cur)
-        await cur.execute("SELECT match_id FROM matches WHERE match_id < %s ORDER BY match_id DESC", (match_id,))
+            cur = await conn.execute(f"SELECT count(*) FROM matches WHERE {_NOT_UNAVAILABLE}")
+        else:
+            cur = await conn.execute(f"SELECT count(*) FROM matches WHERE match_id < %s AND {_NOT_UNAVAILABLE}", (match_id,))
+        row = await cur.fetchone()
+        return row[0]
+
+    async def get_matches_page(self, conn, older_than: str | None, limit: int,
+                               platforms: list[str] | None = None, known_platforms: list[str] | None = None) -> list[str]:
+        """
+        Get a page of at most `limit` matches older than the given match id (from newest to oldest), except the unavailable ones.
+        None for the first page. Only the matches of the `platforms` (and of platforms other than `known_platforms`, if given),
+        None for all of them.
+
+        Keyset pagination - the next page starts after the last match id of the previous one, so every page
+        is a short index range scan and the connection can be returned to the pool between the pages.
+        """
+        platforms_filter, platforms_params = _platforms_filter(platforms, known_platforms)
+        if older_than is None:
+            cur = await conn.execute(
+                f"SELECT match_id FROM matches WHERE {_NOT_UNAVAILABLE} AND {platforms_filter} ORDER BY match_id DESC LIMIT %s",
+                (*platforms_params, limit),
+            )
+        else:
+            cur = await conn.execute(
+                f"SELECT match_id FROM matches WHERE match_id < %s AND {_NOT_UNAVAILABLE} AND {platforms_filter} "
+                f"ORDER BY match_id DESC LIMIT %s",
+                (older_than, *platforms_params, limit),
+            )
         rows = await cur.fetchall()
         return [row[0] for row in rows]
 
-    async def get_oldest_match(self, cur) -> str | None:
+    async def count_pending_downloads(self, conn, older_than: str | None, max_attempts: int) -> int:
         """
-        Get the oldest match id from the database.
+        Count the matches waiting for the statistics download (including the expired leases), of all the workers.
         """
-        await cur.execute("SELECT match_id FROM matches ORDER BY match_id ASC LIMIT 1")
+        cur = await conn.execute(
+            "SELECT count(*) FROM matches "
+            "WHERE (download_status = 'pending' OR (download_status = 'leased' AND lease_expires_at < now())) "
+            "AND download_attempts < %s AND (%s::varchar IS NULL OR match_id < %s)",
+            (max_attempts, older_than, older_than),
+        )
+        row = await cur.fetchone()
+        return row[0]
+
+    async def claim_downloads(self, conn, worker_id: str, limit: int, lease_seconds: float, max_attempts: int,
+                              older_than: str | None = None, platforms: list[str] | None = None,
+                              known_platforms: list[str] | None = None, match_ids: list[str] | None = None) -> list[str]:
+        """
+        Claim at most `limit` matches (from newest to oldest) for the statistics download - the matches are leased
+        to the worker for `lease_seconds`. Rows locked by the claims of other workers are skipped (`SKIP LOCKED`),
+        so any number of workers (processes, machines) can drain the queue together. Expired leases of crashed
+        workers are claimed again, until the match reaches `max_attempts`.
+
+        Only the matches of the `platforms` are claimed (see `get_matches_page`), None for all of them, and only
+        the given `match_ids`, if any - the ones downloaded or claimed by other workers already are not returned.
+        """
+        platforms_filter, platforms_params = _platforms_filter(platforms, known_platforms)
+        cur = await conn.execute(
+            "UPDATE matches SET download_status = 'leased', leased_by = %s, "
+            "lease_expires_at = now() + make_interval(secs => %s), download_attempts = download_attempts + 1 "
+            "WHERE match_id IN ("
+            "SELECT match_id FROM matches "
+            "WHERE (download_status = 'pending' OR (download_status = 'leased' AND lease_expires_at < now())) "
+            f"AND download_attempts < %s AND (%s::varchar IS NULL OR match_id < %s) AND {platforms_filter} "
+            "AND (%s::varchar[] IS NULL OR match_id = ANY(%s)) "
+            "ORDER BY match_id DESC LIMIT %s FOR UPDATE SKIP LOCKED"
+            ") RETURNING match_id",
+            (worker_id, lease_seconds, max_attempts, older_than, older_than, *platforms_params, match_ids, match_ids, limit),
+        )
+        rows = await cur.fetchall()
+        return sorted((row[0] for row in rows), reverse=True)
+
+    async def renew_leases(self, conn, worker_id: str, lease_seconds: float) -> int:
+        """
+        Extend the leases of the worker (heartbeat), returns the number of the renewed leases.
+        """
+        cur = await conn.execute(
+            "UPDATE matches SET lease_expires_at = now() + make_interval(secs => %s) "
+            "WHERE leased_by = %s AND download_status = 'leased'",
+            (lease_seconds, worker_id),
+        )
+        return cur.rowcount
+
+    async def complete_download(self, conn, match_id: str):
+        """
+        Mark the statistics of the match downloaded.
+        """
+        await conn.execute(
+            "UPDATE matches SET download_status = 'done', downloaded_at = now(), leased_by = NULL, "
+            "lease_expires_at = NULL, last_error = NULL WHERE match_id = %s",
+            (match_id,),
+        )
+        # rechecked match is available again
+        await conn.execute("DELETE FROM unavailable_matches WHERE match_id = %s", (match_id,))
+
+    async def fail_download(self, conn, match_id: str, error: str, max_attempts: int):
+        """
+        Record the failed download - the match is claimed again later, unless it already reached `max_attempts`.
+        """
+        await conn.execute(
+            "UPDATE matches SET download_status = CASE WHEN download_attempts >= %s THEN 'failed' ELSE 'pending' END, "
+            "leased_by = NULL, lease_expires_at = NULL, last_error = %s WHERE match_id = %s",
+            (max_attempts, error, match_id),
+        )
+
+    async def release_downloads(self, conn, worker_id: str) -> int:
+        """
+        Return the matches claimed by the worker, but not downloaded (yet), to the queue. The attempt is not counted.
+        """
+        cur = await conn.execute(
+            "UPDATE matches SET download_status = 'pending', leased_by = NULL, lease_expires_at = NULL, "
+            "download_attempts = GREATEST(download_attempts - 1, 0) "
+            "WHERE leased_by = %s AND download_status = 'leased'",
+            (worker_id,),
+        )
+        return cur.rowcount
+
+    async def get_oldest_match(self, conn, puuid: str | None = None, newer_than: str | None = None) -> str | None:
+        """
+        Get the oldest available match id from the database (of the given player, if any),
+        newer than the given match id, if any.
+        """
+        if puuid is None:
+            cur = await conn.execute(
+                "SELECT match_id FROM matches m WHERE NOT EXISTS (SELECT 1 FROM unavailable_matches u WHERE u.match_id = m.match_id) "
+                "AND (%s::varchar IS NULL OR match_id > %s) ORDER BY match_id ASC LIMIT 1",
+                (newer_than, newer_than),
+            )
+        else:
+            cur = await conn.execute(
+                "SELECT match_id FROM player_matches p WHERE puuid = %s "
+                "AND NOT EXISTS (SELECT 1 FROM unavailable_matches u WHERE u.match_id = p.match_id) "
+                "AND (%s::varchar IS NULL OR match_id > %s) ORDER BY match_id ASC LIMIT 1",
+                (puuid, newer_than, newer_than),
+            )
         row = await cur.fetchone()
         return row[0] if row else None
+
+    async def save_crawl_cursors(self, conn, cursors: dict[tuple[str, int | None, str | None], CrawlCursor]):
+        """
+        Save the crawl progress - `(puuid, queue, match type)` query -> its crawl cursor (None queue / type for all of them).
+        """
+        query = (
+            "INSERT INTO crawl_cursors (puuid, queue, match_type, oldest_match_id, end_time, crawled) VALUES (%s, %s, %s, %s, %s, %s) "
+            "ON CONFLICT (puuid, queue, match_type) DO UPDATE SET oldest_match_id = EXCLUDED.oldest_match_id, "
+            "end_time = EXCLUDED.end_time, crawled = EXCLUDED.crawled, updated_at = now();"
+        )
+        params_seq = [
+            (puuid, -1 if queue is None else queue, match_type or '', cursor.oldest_match_id, cursor.end_time, cursor.crawled)
+            for (puuid, queue, match_type), cursor in cursors.items()
+        ]
+        async with conn.cursor() as cur:
+            await cur.executemany(query=query, params_seq=params_seq)
+
+    async def get_crawl_cursor(self, conn, puuid: str, queue: int | None = None, match_type: str | None = None) -> CrawlCursor | None:
+        """
+        Get the crawl cursor of the `(puuid, queue, match type)` query, None if it was never crawled.
+        """
+        cur = await conn.execute(
+            "SELECT oldest_match_id, end_time, crawled FROM crawl_cursors WHERE puuid = %s AND queue = %s AND match_type = %s",
+            (puuid, -1 if queue is None else queue, match_type or ''),
+        )
+        row = await cur.fetchone()
+        return CrawlCursor(*row) if row else None
+
+    async def mark_unavailable(self, conn, match_id: str, reason: str, recheck_after: float | None = None):
+        """
+        Tombstone the match the Riot API doesn't have - it is skipped from now on, or until `recheck_after` seconds
+        pass (None to never check it again). Download of the match (if queued) is finished as `unavailable`.
+        """
+        await conn.execute(
+            "INSERT INTO unavailable_matches (match_id, reason, next_check_at) "
+            "VALUES (%s, %s, now() + make_interval(secs => %s)) "
+            "ON CONFLICT (match_id) DO UPDATE SET reason = EXCLUDED.reason, checked_at = now(), "
+            "checks = unavailable_matches.checks + 1, next_check_at = EXCLUDED.next_check_at",
+            (match_id, reason, recheck_after),
+        )
+        await conn.execute(
+            "UPDATE matches SET download_status = 'unavailable', leased_by = NULL, lease_expires_at = NULL, "
+            "last_error = %s WHERE match_id = %s",
+            (reason, match_id),
+        )
+
+    async def get_unavailable(self, conn, match_ids: list[str]) -> set[str]:
+        """
+        Get the given matches known to be unavailable (except the ones due for a recheck).
+        """
+        cur = await conn.execute(
+            "SELECT match_id FROM unavailable_matches WHERE match_id = ANY(%s) "
+            "AND (next_check_at IS NULL OR next_check_at > now())",
+            (match_ids,),
+        )
+        rows = await cur.fetchall()
+        return {row[0] for row in rows}
+
+    async def requeue_unavailable(self, conn) -> int:
+        """
+        Return the unavailable matches due for a recheck to the download queue, returns the number of them.
+        """
+        cur = await conn.execute(
+            "UPDATE matches SET download_status = 'pending', download_attempts = 0 "
+            "WHERE download_status = 'unavailable' AND EXISTS (SELECT 1 FROM unavailable_matches u "
+            "WHERE u.match_id = matches.match_id AND u.next_check_at <= now())"
+        )
+        return cur.rowcount
@@ -3,3 +3,18 @@ class MatchDataNotFoundException(Exception):
 
     def __init__(self, message="Match data not found"):
         super().__init__(message)
+
+
+class RiotApiException(Exception):
+    """Exception raised when the Riot API responds with an unexpected status."""
+
+    # the API key (or the configured request) is rejected - every other request fails the same way
+    FATAL_STATUSES = (400, 401, 403)
+
+    def __init__(self, status: int, message="Unexpected Riot API response"):
+        self.status = status
+        super().__init__(f"{message} (status {status})")
+
+    @property
+    def fatal(self) -> bool:
+        return self.status in self.FATAL_STATUSES
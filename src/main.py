@@ -1,23 +1,23 @@
 import logging
 import asyncio
-import aiohttp
 
 import config
 import toggles
 from logger import init_logger
 from db import init_db
 from event_loop import run_event_loop
-from utils.fs_helpers import get_filepaths_from_dir
+from storage import create_match_store
 from workers import StoreMatchesWorker, FetchStatisticsWorker, FetchMatchesWorker, ExportStatisticsWorker
 from services.riot_api import RiotApiService
+from utils.async_iterators import iter_batches, iter_queue, iter_queue_batches
 
 init_logger()
 logger = logging.getLogger(__name__)
 
 # TODO: Dependency injection
-cur = None
 riot_api_service = None
 exec = None
+match_store = None
 
 
 async def run_tasks(tasks: list[asyncio.Task], return_exceptions=True):
@@ -32,90 +32,180 @@ async def run_tasks(tasks: list[asyncio.Task], return_exceptions=True):
 
 # ===>===>===> FEATURES <===<===<===
 
-async def fetch_matches():
-    matches_queue = asyncio.Queue(5)
-    match_fetching_task = asyncio.create_task(
-        FetchMatchesWorker(cur, riot_api_service).run(queue=matches_queue, should_resume=toggles.SHOULD_RESUME_TOGGLE),
-        name="FetchMatchesWorker",
-    )
+async def fetch_matches(matches_queue: asyncio.Queue | None = None, stored_queue: asyncio.Queue | None = None):
+    matches_queue = matches_queue or asyncio.Queue(5)
+    # one crawler per player, all of them share the riot api service rate limiter
+    match_fetching_tasks = [
+        asyncio.create_task(
+            FetchMatchesWorker(exec, riot_api_service, puuid).run(queue=matches_queue, should_resume=toggles.SHOULD_RESUME_TOGGLE),
+            name=f"FetchMatchesWorker-{puuid}",
+        )
+        for puuid in config.PUUIDS
+    ]
     match_storing_task = asyncio.create_task(
-        StoreMatchesWorker(exec).run(queue=matches_queue),
+        StoreMatchesWorker(exec).run(queue=matches_queue, stored_queue=stored_queue),
         name="StoreMatchesWorker",
     )
-    await run_tasks([match_fetching_task, match_storing_task])
+    crawling = asyncio.ensure_future(run_tasks(match_fetching_tasks))
+    # the crawlers (and the end of the queue signal) would wait for the full queue forever if the storing failed
+    await asyncio.wait({crawling, match_storing_task}, return_when=asyncio.FIRST_COMPLETED)
+    if not match_storing_task.done():
+        # Signal the end of the queue
+        end_of_queue = asyncio.ensure_future(matches_queue.put(None))
+        await asyncio.wait({end_of_queue, match_storing_task}, return_when=asyncio.FIRST_COMPLETED)
+        end_of_queue.cancel()
+    if not crawling.done():
+        for task in match_fetching_tasks:
+            task.cancel()
+    await crawling
+
+    # re-raises the failure of the storing
+    await match_storing_task
 
 
 async def fetch_statistics():
-    # Just one worker for now, we are rate limited anyways
+    # The worker runs a pool of downloads sharing the riot api service rate limiter
     statistics_fetching_task = asyncio.create_task(
-        FetchStatisticsWorker(cur, riot_api_service).run(last_match_id=None),
+        FetchStatisticsWorker(exec, riot_api_service, match_store).run(last_match_id=None),
         name="FetchStatisticsWorker",
     )
     await run_tasks([statistics_fetching_task])
 
 
 async def export():
-    match_files_queue = asyncio.Queue()
+    # bounded queue of row batches - the transformation waits when the writer falls behind
     match_data_queue = asyncio.Queue(10)
+    export_worker = ExportStatisticsWorker()
 
-    filenames = get_filepaths_from_dir(config.exports['match_files_dir'])
-    for filename in filenames:
-        match_files_queue.put_nowait(filename)
-    logger.info(f"[*] Generating csv export from {match_files_queue.qsize()} match files")
-
-    read_tasks = []
-    # start 5 tasks to read statistics from JSON files
-    for _ in range(5):
-        read_tasks.append(
-            asyncio.create_task(
-                ExportStatisticsWorker().run_read(match_files_queue, match_data_queue),
-                name="ExportStatisticsWorker-Read",
-            )
-        )
+    # incremental export exports only the matches which are not exported yet
+    match_ids, manifest = export_worker.plan_export(match_store, match_store.ids())
+    logger.info(f"[*] Generating {export_worker.export_format} export from {len(match_ids)} matches")
+
+    # decode and transform the matches in a pool of worker processes (CPU bound work)
+    transform_task = asyncio.create_task(
+        export_worker.run_transform(iter_batches(match_ids, config.exports['batch_size']), match_data_queue, match_store),
+        name="ExportStatisticsWorker-Transform",
+    )
 
-    # start 1 task to write the statistics to a CSV file
+    # start 1 task to write the statistics to the export file
     write_task = asyncio.create_task(
-        ExportStatisticsWorker().run_write(match_data_queue),
+        export_worker.run_write(match_data_queue),
         name="ExportStatisticsWorker-Write",
     )
 
-    await run_tasks(read_tasks, return_exceptions=False)
+    await run_tasks([transform_task], return_exceptions=False)
 
     # Signal the end of the queue
     await match_data_queue.put(None)
 
     await write_task
 
+    export_worker.save_manifest(manifest)
+
+
+async def pipeline():
+    """
+    Runs all the three phases concurrently - the crawled match ids flow into the statistics downloads and
+    the downloaded matches into the export, through bounded queues. A stage waits whenever the next one
+    falls behind, so the memory stays bounded and the whole run takes about as long as the slowest stage.
+
+    The downloads take the matches stored by the crawl, then the ones left in the download queue by the previous
+    runs. The export contains just the matches downloaded by the run, under its own manifest.
+
+    Every stage signals the end of its output queue once it is done, so the pipeline drains on its own.
+    The first failure (or a shutdown, see `event_loop.cancel_all_tasks`) cancels all the stages.
+    """
+    matches_queue = asyncio.Queue(5)
+    # lists of the stored match ids waiting for the downloads
+    stored_queue = asyncio.Queue(config.pipeline['stored_queue_size'])
+    # ids of the downloaded matches waiting for the export
+    downloaded_queue = asyncio.Queue(config.pipeline['downloaded_queue_size'])
+    match_data_queue = asyncio.Queue(10)
+
+    # the exported matches are not known up front - always a new export, its manifest is built on the fly
+    # (kept apart from the manifest of the full exports, see `export`)
+    export_worker = ExportStatisticsWorker(manifest_file=config.pipeline['manifest_file'])
+    manifest = export_worker.new_manifest({})
+    logger.info(f"[*] Running the pipeline, generating {export_worker.export_format} export {export_worker.export_filename}")
+
+    async def fetch_matches_stage():
+        await fetch_matches(matches_queue, stored_queue)
+        await stored_queue.put(None)
+
+    async def fetch_statistics_stage():
+        await FetchStatisticsWorker(exec, riot_api_service, match_store).run(
+            match_id_batches=iter_queue(stored_queue),
+            downloaded_queue=downloaded_queue,
+        )
+        await downloaded_queue.put(None)
+
+    async def exported_match_batches():
+        async for match_ids in iter_queue_batches(downloaded_queue, config.exports['batch_size']):
+            manifest.matches.update({match_id: match_store.fingerprint(match_id) for match_id in match_ids})
+            yield match_ids
+
+    async def transform_stage():
+        await export_worker.run_transform(exported_match_batches(), match_data_queue, match_store)
+        await match_data_queue.put(None)
+
+    stages = [
+        asyncio.create_task(fetch_matches_stage(), name="Pipeline-FetchMatches"),
+        asyncio.create_task(fetch_statistics_stage(), name="Pipeline-FetchStatistics"),
+        asyncio.create_task(transform_stage(), name="Pipeline-Transform"),
+        asyncio.create_task(export_worker.run_write(match_data_queue), name="Pipeline-Write"),
+    ]
+    try:
+        done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        for stage in done:
+            # re-raises the first failure
+            stage.result()
+    finally:
+        for stage in stages:
+            stage.cancel()
+        # let the cancelled stages clean up (e.g. release the claimed matches, close the export file)
+        await asyncio.gather(*stages, return_exceptions=True)
+
+    export_worker.save_manifest(manifest)
+
 
 async def main():
-    global cur, riot_api_service, exec
+    global riot_api_service, exec, match_store
     try:
         logger.info("[*] Bootstrapping the application")
 
-        # Initialize the database connection.
-        _conn, cur, exec, teardown = await init_db()
+        # Initialize the database connection pool (workers check out a connection per unit of work)
+        _pool, exec, teardown = await init_db()
+
+        # Initialize the Riot API service (it creates one session per routing region)
+        riot_api_service = RiotApiService()  # TODO: do this via dependency injection
 
-        # Initialize the aiohttp session and the Riot API service
-        session = aiohttp.ClientSession(base_url=config.endpoints['lol_base_url'])
-        riot_api_service = RiotApiService(session=session)  # TODO: do this via dependency injection
+        # Initialize the match storage backend (match files directory or archive), only the crawl doesn't need it
+        if toggles.PIPELINE_TOGGLE or toggles.FETCH_STATISTICS_TOGGLE or toggles.EXPORT_STATISTICS_TOGGLE:
+            match_store = create_match_store()
 
-        if toggles.FETCH_MATCHES_TOGGLE:
-            await fetch_matches()
-        if toggles.FETCH_STATISTICS_TOGGLE:
-            await fetch_statistics()
-        if toggles.EXPORT_STATISTICS_TOGGLE:
-            await export()
+        if toggles.PIPELINE_TOGGLE:
+            await pipeline()
+        else:
+            if toggles.FETCH_MATCHES_TOGGLE:
+                await fetch_matches()
+            if toggles.FETCH_STATISTICS_TOGGLE:
+                await fetch_statistics()
+            if toggles.EXPORT_STATISTICS_TOGGLE:
+                await export()
 
     except Exception as e:
         logger.critical(f"[!] An error occurred: {e}", exc_info=True)
         print(f"[!] An error occurred: {e}")
     finally:
         if teardown:
-            logger.info("[-] Closing database connection")
+            logger.info("[-] Closing database connection pool")
             await teardown()
-        if session:
-            logger.info("[-] Closing session connection")
-            await session.close()
+        if riot_api_service:
+            logger.info("[-] Closing session connections")
+            await riot_api_service.close()
+        if match_store:
+            logger.info("[-] Closing match store")
+            match_store.close()
 
 
 if __name__ == "__main__":
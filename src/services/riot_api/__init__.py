@@ -1,2 +1,6 @@
 from services.riot_api.riot_api_service import *
 from services.riot_api.riot_api_dto import *
+from services.riot_api.match_cache import *
+from services.riot_api.match_projection import *
+from services.riot_api.schema_registry import *
+from services.riot_api.extraction_plan import *
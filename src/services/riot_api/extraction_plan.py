@@ -0,0 +1,316 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from services.riot_api.schema_registry import MatchSchema, SchemaRegistry
+import config
+
+# Match metadata columns (in the order of `MatchDto.metadata`)
+META_COLUMNS = ['matchId', 'gameMode', 'gameCreation', 'gameStartTimestamp', 'gameEndTimestamp', 'gameDuration']
+# Columns computed at the end of the transformation (in this order)
+DERIVED_COLUMNS = ['matchDate', 'matchHour', 'win']
+# Participant sub-objects dropped by `MatchDto`
+DROPPED_PARTICIPANT_KEYS = ('challenges', 'perks', 'missions')
+# Exported game modes (all the others are filtered out)
+GAME_MODES = ('CLASSIC', 'ARAM')
+# Types of the metadata and derived columns, team columns are numeric or boolean (see `column_type`)
+COLUMN_TYPES = {
+    'matchId': 'string',
+    'gameMode': GAME_MODES,
+    'gameCreation': 'numeric',
+    'gameStartTimestamp': 'numeric',
+    'gameEndTimestamp': 'numeric',
+    'gameDuration': 'numeric',
+    'matchDate': 'date',
+    'matchHour': 'numeric',
+    'win': 'boolean',
+}
+
+_FRIENDLY, _ENEMY, _DIFF = 'friendly_team_', 'enemy_team_', 'team_'
+# cached participant keys layouts (see `ExtractionPlan.__key_positions`)
+_MAX_KEY_LAYOUTS = 256
+
+
+def column_type(column: str, value) -> str | Tuple[str, ...]:
+    """
+    Type of the export column - `numeric`, `string`, `date`, `boolean` or a tuple of nominal values.
+    Team columns are boolean when aggregated from boolean participant keys (e.g. `firstBloodKill`).
+    """
+    if column in COLUMN_TYPES:
+        return COLUMN_TYPES[column]
+    return 'boolean' if isinstance(value, bool) else 'numeric'
+
+
+class UnsupportedMatchError(Exception):
+    """Raised when the compiled plan can't reproduce the full transformation for the match."""
+
+
+def _is_number(value) -> bool:
+    # won't filter bools (same as the full transformation)
+    return isinstance(value, (int, float, complex))
+
+
+def _aggregate(current, value):
+    """ Booleans are OR-ed, numbers summed - the same rules as `MatchDto` uses. """
+    if isinstance(value, bool):
+        return bool(value if value else current)
+    return current + value
+
+
+class ExtractionPlan:
+    """
+    Compiled extraction of the export columns, built once from the requested columns
+    (`config.CSV_EXPORT_COLUMNS`).
+
+    Unlike `MatchDto` + the full transformation, which compute `team_*`, `friendly_team_*` and
+    `enemy_team_*` aggregates of every numeric participant key (hundreds of them) and then throw
+    away everything but the requested ones, the plan reads only the participant keys it needs,
+    walking every participant once.
+
+    With a `SchemaRegistry` the plan is further compiled for every game version - matches whose
+    participants have the layout of their version's schema skip the key discovery and read only
+    the keys the version has.
+
+    The result (values and columns order) is identical to the full transformation. Matches the plan
+    can't reproduce exactly (participant keys colliding with objective columns, keys missing in the first
+    participant) raise
+    `UnsupportedMatchError`, so the caller can fall back to the full transformation.
+    """
+
+    columns: List[str]
+    registry: SchemaRegistry | None
+
+    def __init__(self, columns: List[str], registry: SchemaRegistry | None = None):
+        self.columns = list(columns)
+        self.registry = registry
+        self.meta_columns = [column for column in self.columns if column in META_COLUMNS]
+        self.derived_columns = [column for column in self.columns if column in DERIVED_COLUMNS]
+        # (column, side, key) - side is one of friendly/enemy/diff
+        self.team_columns: List[Tuple[str, str, str]] = []
+        for column in self.columns:
+            if column in META_COLUMNS or column in DERIVED_COLUMNS:
+                continue
+            for side in (_FRIENDLY, _ENEMY, _DIFF):
+                if column.startswith(side):
+                    self.team_columns.append((column, side, column[len(side):]))
+                    break
+        # participant keys the plan reads
+        self.participant_keys = sorted({key for _, _, key in self.team_columns} - set(DROPPED_PARTICIPANT_KEYS))
+        # participant keys layout -> key positions (matches of a game version share the same layouts)
+        self.__key_layouts: Dict[tuple, Dict[str, int]] = {}
+        # game version -> the plan compiled for the version's schema
+        self.__version_layouts: Dict[str, _VersionLayout] = {}
+
+    def __version_layout(self, riot_match_data: Dict, participants: List[Dict]) -> '_VersionLayout | None':
+        """ Compiled layout of the match version, None if the participants don't follow it. """
+        schema = self.registry.schema_of(riot_match_data)
+        layout = self.__version_layouts.get(schema.game_version)
+        if layout is None:
+            layout = self.__version_layouts[schema.game_version] = _VersionLayout(self, schema)
+        keys = layout.keys
+        if all(tuple(participant) == keys for participant in participants):
+            return layout
+        return None
+
+    def __key_positions(self, participant: Dict, skip_dropped: bool = False) -> Dict[str, int]:
+        layout = (skip_dropped, *participant)
+        positions = self.__key_layouts.get(layout)
+        if positions is None:
+            if len(self.__key_layouts) >= _MAX_KEY_LAYOUTS:
+                self.__key_layouts.clear()
+            keys = [key for key in participant if not skip_dropped or key not in DROPPED_PARTICIPANT_KEYS]
+            positions = self.__key_layouts[layout] = {key: idx for idx, key in enumerate(keys)}
+        return positions
+
+    @staticmethod
+    def __objective_positions(friendly_team: Dict, enemy_team: Dict) -> Dict[str, int]:
+        """ Positions of the objective columns in `MatchDto.team_data`. """
+        positions = {}
+        for objective in friendly_team['objectives']:
+            for column in (f"team_{objective}_kills", f"team_{objective}_first", f"friendly_team_{objective}_kills"):
+                positions.setdefault(column, len(positions))
+        for objective in enemy_team['objectives']:
+            positions.setdefault(f"enemy_team_{objective}_kills", len(positions))
+        return positions
+
+    @staticmethod
+    def __objective_value(side: str, key: str, friendly_team: Dict, enemy_team: Dict):
+        objective, stat = key.rsplit('_', 1)
+        if side == _FRIENDLY:
+            return friendly_team['objectives'][objective]['kills']
+        if side == _ENEMY:
+            return enemy_team['objectives'][objective]['kills']
+        if stat == 'first':
+            return friendly_team['objectives'][objective]['first']
+        enemy_objective = enemy_team['objectives'].get(objective, {'kills': 0})
+        return friendly_team['objectives'][objective]['kills'] - enemy_objective['kills']
+
+    def prepare(self, riot_match_data: Dict) -> '_MatchContext | None':
+        """
+        Parses the match scaffolding (metadata, teams), None for unwanted matches
+        (the same filters as the full transformation).
+        """
+        info_dto = riot_match_data['info']
+        metadata = {
+            'matchId': riot_match_data['metadata']['matchId'],
+            'gameMode': info_dto['gameMode'],
+            'gameCreation': info_dto['gameCreation'],
+            'gameStartTimestamp': info_dto['gameStartTimestamp'],
+            'gameEndTimestamp': info_dto['gameEndTimestamp'],
+            'gameDuration': info_dto['gameDuration'],
+        }
+
+        # Filter out unwanted PVE game modes, PVP game modes and games which took less than 5 minutes
+        if len(info_dto['teams']) != 2:
+            return None
+        if metadata['gameMode'] not in GAME_MODES:
+            return None
+        if metadata['gameDuration'] < 300:
+            return None
+
+        participants = info_dto['participants']
+
+        # Friendly team - the one of the first participant from the roster
+        friendly_team_id = None
+        for participant in participants:
+            if participant['puuid'] in config.PUUIDS:
+                friendly_team_id = participant['teamId']
+                break
+        friendly_team, enemy_team = info_dto['teams'][0], info_dto['teams'][1]
+        if friendly_team['teamId'] != friendly_team_id:
+            friendly_team, enemy_team = enemy_team, friendly_team
+
+        layout = self.__version_layout(riot_match_data, participants) if self.registry is not None and participants else None
+        return _MatchContext(metadata, participants, friendly_team, enemy_team, layout)
+
+    def aggregate(self, context: '_MatchContext') -> Dict[str, list]:
+        """
+        Single pass over participants computing only the needed aggregates.
+
+        Returns key -> [friendly aggregate, enemy aggregate, difference,
+        index of the first friendly participant with the key, index of the first enemy one]
+        """
+        friendly_team_id = context.friendly_team['teamId']
+        aggregates = {key: [None, None, 0, None, None] for key in self.participant_keys}
+        # only the keys of the match version, if the participants follow its layout
+        keys = context.layout.participant_keys if context.layout is not None else self.participant_keys
+        for participant_idx, participant in enumerate(context.participants):
+            is_friendly = participant['teamId'] == friendly_team_id
+            for key in keys:
+                aggregate = aggregates[key]
+                value = participant.get(key)
+                if value is None or not _is_number(value):
+                    continue
+                if is_friendly:
+                    if aggregate[3] is None:
+                        aggregate[3] = participant_idx
+                    aggregate[0] = _aggregate(aggregate[0] or 0, value)
+                    if not isinstance(value, bool) or key != 'win':
+                        aggregate[2] = _aggregate(aggregate[2], value)
+                else:
+                    if aggregate[4] is None:
+                        aggregate[4] = participant_idx
+                    aggregate[1] = _aggregate(aggregate[1] or 0, value)
+                    if not isinstance(value, bool):
+                        aggregate[2] -= value
+        return aggregates
+
+    def assemble(self, context: '_MatchContext', aggregates: Dict[str, list]) -> Dict:
+        """ Flat export row of the requested columns, in the columns order of the full transformation. """
+        friendly_team, enemy_team, participants = context.friendly_team, context.enemy_team, context.participants
+        objective_positions = self.__objective_positions(friendly_team, enemy_team)
+        key_positions: Dict[int, Dict[str, int]] = {}
+        if context.layout is not None:
+            # every participant has the layout of the version
+            first_participant_keys = context.layout.first_participant_keys
+
+            def key_position(_participant_idx: int, key: str) -> int:
+                return context.layout.key_positions[key]
+        else:
+            first_participant_keys = self.__key_positions(participants[0], skip_dropped=True)
+
+            def key_position(participant_idx: int, key: str) -> int:
+                if participant_idx not in key_positions:
+                    key_positions[participant_idx] = self.__key_positions(participants[participant_idx])
+                return key_positions[participant_idx][key]
+
+        # (rank, column, value) - rank reproduces the columns order of the full transformation
+        row: List[Tuple[tuple, str, object]] = []
+        for idx, column in enumerate(META_COLUMNS):
+            if column in self.meta_columns:
+                row.append(((0, idx), column, context.metadata[column]))
+
+        for column, side, key in self.team_columns:
+            if column in objective_positions:
+                if key in first_participant_keys or key in aggregates and (aggregates[key][3] is not None or aggregates[key][4] is not None):
+                    raise UnsupportedMatchError(f"Participant key {key} collides with objective column {column}")
+                row.append(((1, objective_positions[column]), column, self.__objective_value(side, key, friendly_team, enemy_team)))
+                continue
+            if key in DROPPED_PARTICIPANT_KEYS:
+                continue
+            aggregate = aggregates[key]
+            if side == _DIFF:
+                # `team_*` columns exist for every key of the first participant (besides `win`)
+                if key == 'win':
+                    continue
+                if key not in first_participant_keys:
+                    # the full transformation still creates the column for a true (bool) value of a friendly participant
+                    if aggregate[3] is not None or aggregate[4] is not None:
+                        raise UnsupportedMatchError(f"Participant key {key} is missing in the first participant")
+                    continue
+                row.append(((1, len(objective_positions) + first_participant_keys[key]), column, aggregate[2]))
+            elif side == _FRIENDLY and aggregate[3] is not None:
+                # columns appear in the order of participants and their keys
+                row.append(((2, aggregate[3], key_position(aggregate[3], key)), column, aggregate[0]))
+            elif side == _ENEMY and aggregate[4] is not None:
+                row.append(((2, aggregate[4], key_position(aggregate[4], key)), column, aggregate[1]))
+
+        game_creation = datetime.fromtimestamp(context.metadata['gameCreation']/1000)
+        derived = {
+            'matchDate': lambda: game_creation.strftime('%Y-%m-%d %H:%M:%S'),
+            'matchHour': lambda: game_creation.strftime('%H'),
+            'win': lambda: friendly_team['win'],
+        }
+        for idx, column in enumerate(DERIVED_COLUMNS):
+            if column in self.derived_columns:
+                row.append(((3, idx), column, derived[column]()))
+
+        row.sort(key=lambda item: item[0])
+        return {column: value for _, column, value in row}
+
+    def extract(self, riot_match_data: Dict) -> Dict | None:
+        """
+        Flat export row of the requested columns, None for unwanted matches
+        (the same filters as the full transformation).
+        """
+        context = self.prepare(riot_match_data)
+        if context is None:
+            return None
+        return self.assemble(context, self.aggregate(context))
+
+
+class _VersionLayout:
+    """ The plan compiled for the participants layout of one game version. """
+
+    def __init__(self, plan: ExtractionPlan, schema: MatchSchema):
+        self.keys = schema.participant_keys
+        # keys of the plan the version has (the other ones are never found)
+        self.participant_keys = [key for key in plan.participant_keys if key in schema.participant_key_types]
+        self.key_positions = {key: idx for idx, key in enumerate(self.keys)}
+        self.first_participant_keys = {
+            key: idx for idx, key in enumerate(key for key in self.keys if key not in DROPPED_PARTICIPANT_KEYS)
+        }
+
+
+@dataclass
+class _MatchContext:
+    """ Parsed scaffolding of a wanted match. """
+    metadata: Dict
+    participants: List[Dict]
+    friendly_team: Dict
+    enemy_team: Dict
+    # compiled layout of the match version (None without a registry or for an unexpected layout)
+    layout: _VersionLayout | None = None
+
+
+__ALL__ = ['ExtractionPlan', 'UnsupportedMatchError', 'column_type', 'COLUMN_TYPES', 'GAME_MODES']
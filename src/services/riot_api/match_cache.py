@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict
+import asyncio
+import json
+import logging
+import os
+import zlib
+import aiofiles
+
+from utils.json_stream import JsonFileStream, JsonStreamError
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class MatchCache:
+    """
+    Two-tier cache for Riot match payloads (match data is immutable, so entries never expire).
+
+    - in-memory LRU bounded by `memory_entries` matches
+    - optional persistent on-disk store keyed by match id (`disk_dir/{match_id}.json`)
+
+    Concurrent requests for the same match id are coalesced (single-flight), so they share
+    one fetch. Cached payloads are shared between the callers and must not be mutated.
+
+    Payloads streamed straight into match files (`get_or_download`) go through the same tiers.
+    """
+
+    def __init__(self, memory_entries: int, disk_dir: str | None = None):
+        self.memory_entries = memory_entries
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.misses = 0
+        self.__memory: OrderedDict[str, Dict] = OrderedDict()
+        self.__in_flight: Dict[str, asyncio.Task] = {}
+        self.__in_flight_downloads: Dict[str, asyncio.Task] = {}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def __disk_path(self, match_id: str) -> str:
+        return os.path.join(self.disk_dir, f"{match_id}.json")
+
+    def __memorize(self, match_id: str, data: Dict):
+        if self.memory_entries <= 0:
+            return
+        self.__memory[match_id] = data
+        self.__memory.move_to_end(match_id)
+        while len(self.__memory) > self.memory_entries:
+            self.__memory.popitem(last=False)
+
+    def get_memory(self, match_id: str) -> Dict | None:
+        data = self.__memory.get(match_id)
+        if data is not None:
+            self.__memory.move_to_end(match_id)
+        return data
+
+    async def __read_disk(self, match_id: str) -> Dict | None:
+        if not self.disk_dir or not os.path.isfile(self.__disk_path(match_id)):
+            return None
+        async with aiofiles.open(self.__disk_path(match_id), mode='r', encoding='utf-8') as f:
+            try:
+                return json.loads(await f.read())
+            except json.JSONDecodeError as json_error:
+                logger.warning(f"[!] Corrupted cache entry for match {match_id}, refetching: {json_error}")
+                return None
+
+    async def __write_disk(self, match_id: str, data: Dict):
+        if not self.disk_dir:
+            return
+        # write to a temporary file first, so readers never see a partial entry
+        tmp_path = f"{self.__disk_path(match_id)}.{os.getpid()}.tmp"
+        async with aiofiles.open(tmp_path, mode='w', encoding='utf-8') as f:
+            await f.write(json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+        os.replace(tmp_path, self.__disk_path(match_id))
+
+    async def __load(self, match_id: str, fetch: Callable[[], Awaitable[Dict]]) -> Dict:
+        data = await self.__read_disk(match_id)
+        if data is not None:
+            self.hits += 1
+            logger.debug(f"[.] Match {match_id} loaded from the disk cache")
+        else:
+            self.misses += 1
+            data = await fetch()
+            await self.__write_disk(match_id, data)
+        self.__memorize(match_id, data)
+        return data
+
+    async def get_or_fetch(self, match_id: str, fetch: Callable[[], Awaitable[Dict]]) -> Dict:
+        """
+        Returns the cached match payload, or fetches it with `fetch` (once for all concurrent callers).
+        Failed fetches are not cached.
+        """
+        data = self.get_memory(match_id)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        task = self.__in_flight.get(match_id)
+        if task is None:
+            task = asyncio.create_task(self.__load(match_id, fetch), name=f"MatchCache-{match_id}")
+            self.__in_flight[match_id] = task
+            task.add_done_callback(lambda _: self.__in_flight.pop(match_id, None))
+        else:
+            logger.debug(f"[.] Match {match_id} is already being fetched, waiting for it")
+        # one cancelled caller must not cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def __copy(source: str, source_compressed: bool, filepath: str, compress: bool) -> Dict[str, int]:
+        """ Copies the match payload file into `filepath` (re-compressing it when needed), returns the extracted fields. """
+        # wbits=31 -> gzip container
+        decompressor = zlib.decompressobj(wbits=31) if source_compressed else None
+        async with aiofiles.open(source, mode='rb') as f:
+            async with JsonFileStream(filepath, fields=['gameEndTimestamp'], compress=compress) as stream:
+                while chunk := await f.read(_CHUNK_SIZE):
+                    await stream.write(decompressor.decompress(chunk) if decompressor is not None else chunk)
+                if decompressor is not None:
+                    await stream.write(decompressor.flush())
+        return stream.extracted
+
+    async def __download(self, match_id: str, filepath: str, compress: bool,
+                         download: Callable[[], Awaitable[Dict[str, int]]]) -> tuple[str, bool, Dict[str, int]]:
+        if self.disk_dir and os.path.isfile(self.__disk_path(match_id)):
+            try:
+                extracted = await self.__copy(self.__disk_path(match_id), False, filepath, compress)
+                self.hits += 1
+                logger.debug(f"[.] Match {match_id} copied from the disk cache")
+                return filepath, compress, extracted
+            except JsonStreamError as json_error:
+                logger.warning(f"[!] Corrupted cache entry for match {match_id}, refetching: {json_error}")
+
+        self.misses += 1
+        extracted = await download()
+        if self.disk_dir:
+            await self.__copy(filepath, compress, self.__disk_path(match_id), False)
+        return filepath, compress, extracted
+
+    async def get_or_download(self, match_id: str, filepath: str, compress: bool,
+                              download: Callable[[], Awaitable[Dict[str, int]]]) -> Dict[str, int]:
+        """
+        Writes the match payload into `filepath` (gzip compressed when `compress`), returns the extracted
+        `gameEndTimestamp`. Cached payloads are copied, otherwise `download` streams the payload into
+        `filepath` (once for all concurrent callers, the others copy the downloaded file) and it is added
+        to the disk tier. Failed downloads are not cached.
+        """
+        data = self.get_memory(match_id)
+        if data is not None:
+            self.hits += 1
+            async with JsonFileStream(filepath, compress=compress) as stream:
+                await stream.write(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            return {'gameEndTimestamp': data['info']['gameEndTimestamp']}
+
+        task = self.__in_flight_downloads.get(match_id)
+        if task is None:
+            task = asyncio.create_task(self.__download(match_id, filepath, compress, download), name=f"MatchCache-Download-{match_id}")
+            self.__in_flight_downloads[match_id] = task
+            task.add_done_callback(lambda _: self.__in_flight_downloads.pop(match_id, None))
+        else:
+            logger.debug(f"[.] Match {match_id} is already being downloaded, waiting for it")
+        # one cancelled caller must not cancel the download for the others
+        source, source_compressed, extracted = await asyncio.shield(task)
+        if source != filepath:
+            extracted = await self.__copy(source, source_compressed, filepath, compress)
+        return extracted
+
+
+__ALL__ = ['MatchCache']
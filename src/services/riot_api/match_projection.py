@@ -0,0 +1,39 @@
+from typing import Dict, Iterable
+
+import config
+
+
+def _without(data: Dict, keys: Iterable[str]) -> Dict:
+    return {key: value for key, value in data.items() if key not in keys}
+
+
+def project_match(riot_match_data: Dict, drop_participant_keys: Iterable[str] = (), drop_team_keys: Iterable[str] = ()) -> Dict:
+    """
+    Slim copy of the Riot match DTO (the original payload is not modified, it may be cached).
+
+    Only sub-objects the export pipeline doesn't use are dropped (`challenges`, `perks` and `missions`
+    of participants are most of each match payload), the rest of the DTO keeps its shape, so
+    `MatchDto` parses projected and raw payloads alike.
+    """
+    drop_participant_keys, drop_team_keys = set(drop_participant_keys), set(drop_team_keys)
+    info_dto = riot_match_data['info']
+    return {
+        'metadata': riot_match_data['metadata'],
+        'info': {
+            **info_dto,
+            'participants': [_without(participant, drop_participant_keys) for participant in info_dto['participants']],
+            'teams': [_without(team, drop_team_keys) for team in info_dto['teams']],
+        },
+    }
+
+
+def project_match_by_config(riot_match_data: Dict) -> Dict:
+    """ Applies the projection configured in `config.projection`. """
+    return project_match(
+        riot_match_data,
+        drop_participant_keys=config.projection['drop_participant_keys'],
+        drop_team_keys=config.projection['drop_team_keys'],
+    )
+
+
+__ALL__ = ['project_match', 'project_match_by_config']
@@ -1,59 +1,233 @@
-from functools import wraps
+from typing import Any, Awaitable, Callable, Dict
+import asyncio
 import logging
 import aiohttp
 
-from utils.requests import construct_query_params
-from utils.throttled_task_runner import ThrottledTaskRunner, RateLimit
+from services.riot_api.match_cache import MatchCache
+from utils.json_stream import JsonFileStream
+from utils.requests import construct_query_params, parse_rate_limit_header
+from utils.throttled_task_runner import ThrottledTaskRunner, RateLimit, PacingPolicy, acquire_all
 import config
-from errors import MatchDataNotFoundException
+from errors import MatchDataNotFoundException, RiotApiException
 
 logger = logging.getLogger(__name__)
 
 
-class RiotApiService:
+# Routes (Riot API methods) with their own method rate limits
+MATCH_IDS_BY_PUUID_ROUTE = 'match-v5.getMatchIdsByPUUID'
+MATCH_ROUTE = 'match-v5.getMatch'
+
+
+def _to_rate_limits(limits: list[tuple[int, int]]) -> list[RateLimit]:
+    return [RateLimit(value=value, time_window=time_window) for value, time_window in limits]
+
+
+def _adapt_rate_limits(ttr: ThrottledTaskRunner, limits_header: str | None, counts_header: str | None):
+    """ Resizes the rate limiter and syncs its counts based on the rate limit headers reported by Riot. """
+    limits = parse_rate_limit_header(limits_header)
+    if not limits:
+        return
+    ttr.update_rate_limits(_to_rate_limits(limits))
+    for count, time_window in parse_rate_limit_header(counts_header):
+        ttr.sync_count(time_window=time_window, count=count)
+
+
+def region_of_match(match_id: str) -> str:
+    """
+    Routing region (americas/europe/asia/sea) of the match based on its platform prefix, e.g. `EUN1_3691872431`.
+    """
+    platform = match_id.split('_', 1)[0].upper()
+    return config.PLATFORM_REGIONS.get(platform, config.endpoints['default_region'])
+
+
+def platforms_of_region(region: str) -> list[str]:
+    """ Match id platform prefixes routed to the region, see `config.PLATFORM_REGIONS`. """
+    return [platform for platform, platform_region in config.PLATFORM_REGIONS.items() if platform_region == region]
+
 
-    __ttr: ThrottledTaskRunner
+def region_of_player(puuid: str | None) -> str:
+    """ Routing region of the player, see `config.PUUID_REGIONS`. """
+    return config.PUUID_REGIONS.get(puuid, config.endpoints['default_region'])
 
+
+class _RegionalClient:
+    """
+    Pooled session and rate limits of one regional host - Riot rate limits are enforced per region.
+    """
+
+    region: str
     session: aiohttp.ClientSession
 
-    def __init__(self, session):
-        self.session = session
-        self.headers = {"X-Riot-Token": config.secrets['api_key']}
+    # App rate limiter - every request counts against it
+    __app_ttr: ThrottledTaskRunner
+    # Method rate limiters - a request counts only against the one of its route
+    __method_ttrs: dict[str, ThrottledTaskRunner]
+
+    def __init__(self, region: str):
+        self.region = region
+        self.__policy = PacingPolicy(config.rate_limits['policy'])
+        self.session = aiohttp.ClientSession(
+            base_url=config.endpoints['regional_base_url'].format(region=region),
+            connector=aiohttp.TCPConnector(limit=config.endpoints['connections_per_region']),
+        )
         rate_limits = [
             RateLimit(value=config.rate_limits['per_second'], time_window=1),
             RateLimit(value=config.rate_limits['per_minute'], time_window=60),
         ]
-        self.__ttr = ThrottledTaskRunner(rate_limits=rate_limits)
-
-    def rate_limited(func):
-        @wraps(func)
-        async def wrapper(self: 'RiotApiService', *args, **kwargs):
-            return await self.__ttr.run(self, *args, cb=func, **kwargs)
-        return wrapper
-
-    @rate_limited
-    async def _GET(self, resource):
-        async with self.session.get(url=resource, headers=self.headers) as response:
-            logger.info(f"[>] GET {response.url}")
-            res = await response.json()
-            if response.status == 404:
-                # Data not found, happens for older matches that are no longer available.
-                logger.warning(f"[^] 404 - Data not found: {res} for {response.url}")
-                raise MatchDataNotFoundException
-            elif response.status != 200:
-                raise Exception(f"Error: {res}")
-            return res
-
-    async def get_matches(self, startTime=None, endTime=None, queue=None, type=None, start=None, count=None):
+        self.__app_ttr = ThrottledTaskRunner(rate_limits=rate_limits, policy=self.__policy)
+        self.__method_ttrs = {}
+        for route, method_rate_limits in config.method_rate_limits.items():
+            self.register_route(route, _to_rate_limits(method_rate_limits))
+
+    def register_route(self, route: str, rate_limits: list[RateLimit]):
+        """ Registers a method rate limit bucket for the given route. """
+        self.__method_ttrs[route] = ThrottledTaskRunner(rate_limits=rate_limits, policy=self.__policy)
+
+    def rate_limiters(self, route: str | None) -> list[ThrottledTaskRunner]:
+        if route in self.__method_ttrs:
+            return [self.__app_ttr, self.__method_ttrs[route]]
+        return [self.__app_ttr]
+
+    def adapt_rate_limits(self, route: str | None, headers):
+        _adapt_rate_limits(self.__app_ttr, headers.get('X-App-Rate-Limit'), headers.get('X-App-Rate-Limit-Count'))
+        if route in self.__method_ttrs:
+            _adapt_rate_limits(self.__method_ttrs[route], headers.get('X-Method-Rate-Limit'), headers.get('X-Method-Rate-Limit-Count'))
+
+    def pause(self, route: str | None, limit_type: str, seconds: float) -> bool:
+        """ Pauses the rate limiter which was exceeded, returns False if it isn't one of ours. """
+        if limit_type == 'application':
+            self.__app_ttr.pause(seconds)
+            return True
+        if limit_type == 'method' and route in self.__method_ttrs:
+            self.__method_ttrs[route].pause(seconds)
+            return True
+        return False
+
+    async def close(self):
+        if not self.session.closed:
+            await self.session.close()
+
+
+class RiotApiService:
+    """
+    Requests are routed to the regional host of the player/match, every region has its own
+    session and rate limits, so regions are crawled concurrently without affecting each other.
+    """
+
+    __regional_clients: dict[str, _RegionalClient]
+
+    match_cache: MatchCache
+
+    def __init__(self):
+        self.match_cache = MatchCache(
+            memory_entries=config.match_cache['memory_entries'],
+            disk_dir=config.match_cache['disk_dir'],
+        )
+        self.headers = {"X-Riot-Token": config.secrets['api_key']}
+        self.__regional_clients = {}
+
+    def regional_client(self, region: str) -> _RegionalClient:
+        """ Lazily creates the client of the given region. """
+        if region not in self.__regional_clients:
+            logger.info(f"[+] Creating client for region {region}")
+            self.__regional_clients[region] = _RegionalClient(region)
+        return self.__regional_clients[region]
+
+    async def close(self):
+        for client in self.__regional_clients.values():
+            await client.close()
+
+    async def _GET(
+        self,
+        resource,
+        route: str | None = None,
+        region: str | None = None,
+        on_response: Callable[[aiohttp.ClientResponse], Awaitable[Any]] | None = None,
+    ):
+        """
+        GET request to the regional host waiting only on the rate limits it actually uses - the app
+        one and the method one of its `route` within the `region`.
+
+        Successful responses are decoded from JSON, unless `on_response` is given - then it consumes
+        the (not yet read) response body itself and its result is returned.
+        """
+        client = self.regional_client(region or config.endpoints['default_region'])
+        max_retries = config.rate_limits['max_retries']
+        rate_limiters = client.rate_limiters(route)
+        for attempt in range(1, max_retries + 1):
+            await acquire_all(rate_limiters)
+            async with client.session.get(url=resource, headers=self.headers) as response:
+                logger.info(f"[>] GET {response.url}")
+                client.adapt_rate_limits(route, response.headers)
+
+                if response.status == 429:
+                    retry_after = float(response.headers.get('Retry-After', attempt))
+                    limit_type = response.headers.get('X-Rate-Limit-Type', 'service')
+                    logger.warning(f"[^] 429 - Rate limit exceeded ({limit_type}), retrying in {retry_after}s "
+                                   f"({attempt}/{max_retries}) for {response.url}")
+                    if not client.pause(route, limit_type, retry_after):
+                        # underlying service is overloaded, our budget is fine - only this request waits
+                        await asyncio.sleep(retry_after)
+                    continue
+
+                if response.status >= 500:
+                    logger.warning(f"[^] {response.status} - Server error, retrying ({attempt}/{max_retries}) for {response.url}")
+                    await asyncio.sleep(attempt)
+                    continue
+
+                if response.status == 200 and on_response is not None:
+                    return await on_response(response)
+
+                res = await response.json()
+                if response.status == 404:
+                    # Data not found, happens for older matches that are no longer available.
+                    logger.warning(f"[^] 404 - Data not found: {res} for {response.url}")
+                    reason = res.get('status', {}).get('message') if isinstance(res, dict) else None
+                    raise MatchDataNotFoundException(reason or "Match data not found")
+                elif response.status != 200:
+                    raise RiotApiException(response.status, f"Error: {res}")
+                return res
+
+        raise RiotApiException(response.status, f"Giving up on {resource} after {max_retries} attempts")
+
+    async def get_matches(self, puuid=None, startTime=None, endTime=None, queue=None, type=None, start=None, count=None):
         arguments = {**locals()}
-        del arguments['self']
+        del arguments['self'], arguments['puuid']
+        puuid = puuid or config.riot_api['puuid']
         query_params = construct_query_params(**arguments)
-        resource = f"/lol/match/v5/matches/by-puuid/{config.riot_api['puuid']}/ids" + query_params
-        return await self._GET(resource=resource)
+        resource = f"/lol/match/v5/matches/by-puuid/{puuid}/ids" + query_params
+        return await self._GET(resource=resource, route=MATCH_IDS_BY_PUUID_ROUTE, region=region_of_player(puuid))
 
     async def get_match_statistics(self, match_id):
+        """ Match data is immutable, so it is served from the match cache whenever possible. """
+        resource = f"/lol/match/v5/matches/{match_id}"
+        return await self.match_cache.get_or_fetch(
+            match_id,
+            lambda: self._GET(resource=resource, route=MATCH_ROUTE, region=region_of_match(match_id)),
+        )
+
+    async def download_match_statistics(self, match_id, filepath: str, compress: bool = False) -> Dict[str, int]:
+        """
+        Streams the match payload straight into `filepath` (optionally gzip compressed) without
+        decoding it. Cached matches are copied from the match cache, downloaded ones are added to it.
+
+        Returns lightweight fields extracted on the fly (`gameEndTimestamp`).
+        """
+        async def stream_to_file(response: aiohttp.ClientResponse) -> Dict[str, int]:
+            # aiohttp transparently decodes compressed responses, content length is then of the encoded body
+            expected_length = response.content_length if 'Content-Encoding' not in response.headers else None
+            async with JsonFileStream(filepath, fields=['gameEndTimestamp'], compress=compress, expected_length=expected_length) as stream:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    await stream.write(chunk)
+            return stream.extracted
+
         resource = f"/lol/match/v5/matches/{match_id}"
-        return await self._GET(resource=resource)
+        return await self.match_cache.get_or_download(
+            match_id,
+            filepath,
+            compress,
+            lambda: self._GET(resource=resource, route=MATCH_ROUTE, region=region_of_match(match_id), on_response=stream_to_file),
+        )
 
     async def get_match_end_timestamp(self, match_id) -> int:
         try:
@@ -0,0 +1,177 @@
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+import glob
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def _version_key(game_version: str) -> Tuple[int, ...]:
+    """ `14.23.636.9832` -> (14, 23, 636, 9832), non-numeric parts are ignored. """
+    return tuple(int(part) for part in game_version.split('.') if part.isdigit())
+
+
+@dataclass(frozen=True)
+class MatchSchema:
+    """
+    Shape of the match payloads of one game version (patch).
+    """
+    game_version: str
+    # participant keys in the order of the payload
+    participant_keys: Tuple[str, ...]
+    # participant key -> type name of its value (`bool`, `int`, `str`, `dict`...)
+    participant_key_types: Dict[str, str] = field(hash=False, compare=False)
+    # team objectives in the order of the payload
+    objectives: Tuple[str, ...]
+    # where the schema comes from - `snapshot` or `learned`
+    source: str = 'learned'
+
+    @staticmethod
+    def of_match(riot_match_data: Dict, source: str = 'learned') -> 'MatchSchema':
+        info_dto = riot_match_data['info']
+        participant = info_dto['participants'][0] if info_dto['participants'] else {}
+        teams = info_dto.get('teams') or [{}]
+        return MatchSchema(
+            game_version=info_dto.get('gameVersion', ''),
+            participant_keys=tuple(participant),
+            participant_key_types={key: type(value).__name__ for key, value in participant.items()},
+            objectives=tuple(teams[0].get('objectives', {})),
+            source=source,
+        )
+
+
+@dataclass
+class SchemaDrift:
+    """ Differences between the schemas of two game versions. """
+    from_version: str
+    to_version: str
+    added_keys: List[str]
+    removed_keys: List[str]
+    # key -> (old type, new type)
+    retyped_keys: Dict[str, Tuple[str, str]]
+    added_objectives: List[str]
+    removed_objectives: List[str]
+
+    @staticmethod
+    def between(old: MatchSchema, new: MatchSchema) -> 'SchemaDrift':
+        old_types, new_types = old.participant_key_types, new.participant_key_types
+        return SchemaDrift(
+            from_version=old.game_version,
+            to_version=new.game_version,
+            added_keys=[key for key in new.participant_keys if key not in old_types],
+            removed_keys=[key for key in old.participant_keys if key not in new_types],
+            retyped_keys={
+                key: (old_types[key], new_types[key])
+                for key in new.participant_keys if key in old_types and old_types[key] != new_types[key]
+            },
+            added_objectives=[objective for objective in new.objectives if objective not in old.objectives],
+            removed_objectives=[objective for objective in old.objectives if objective not in new.objectives],
+        )
+
+    def __bool__(self):
+        return bool(self.added_keys or self.removed_keys or self.retyped_keys or self.added_objectives or self.removed_objectives)
+
+    def __str__(self):
+        changes = []
+        if self.added_keys:
+            changes.append(f"added keys {self.added_keys}")
+        if self.removed_keys:
+            changes.append(f"removed keys {self.removed_keys}")
+        if self.retyped_keys:
+            changes.append(f"retyped keys {self.retyped_keys}")
+        if self.added_objectives:
+            changes.append(f"added objectives {self.added_objectives}")
+        if self.removed_objectives:
+            changes.append(f"removed objectives {self.removed_objectives}")
+        return f"{self.from_version} -> {self.to_version}: {', '.join(changes) or 'no changes'}"
+
+
+class SchemaRegistry:
+    """
+    Match schemas keyed by `gameVersion` - built from the reference payloads in the snapshots
+    directory (`version_<gameVersion>.json`) or learned from the first match of an unknown version.
+
+    Every newly registered version is compared with the closest older known version (or the
+    closest newer one) and the schema drift is reported.
+
+    The snapshots are raw payloads - with `projection` (the one applied to the stored matches) they are
+    projected first, so their schemas have the shape of the stored matches the learned schemas come from.
+    """
+
+    def __init__(self, snapshots_dir: str | None = None, report_drift: bool = True,
+                 projection: Callable[[Dict], Dict] | None = None):
+        self.report_drift = report_drift
+        self.projection = projection
+        self.drifts: List[SchemaDrift] = []
+        self.__schemas: Dict[str, MatchSchema] = {}
+        # schemas learned since the last `pop_learned`
+        self.__learned: List[MatchSchema] = []
+        if snapshots_dir:
+            self.load_snapshots(snapshots_dir)
+
+    def load_snapshots(self, snapshots_dir: str):
+        filepaths = sorted(glob.glob(os.path.join(snapshots_dir, 'version_*.json')))
+        for filepath in filepaths:
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+                if self.projection is not None:
+                    snapshot = self.projection(snapshot)
+                self.register(MatchSchema.of_match(snapshot, source='snapshot'))
+            except (OSError, json.JSONDecodeError, KeyError) as e:
+                logger.warning(f"[!] Skipping the match snapshot {filepath}: {e}")
+        logger.debug(f"[.] Loaded {len(filepaths)} match snapshots from {snapshots_dir}")
+
+    def __contains__(self, game_version: str) -> bool:
+        return game_version in self.__schemas
+
+    def get(self, game_version: str) -> MatchSchema | None:
+        return self.__schemas.get(game_version)
+
+    def versions(self) -> List[str]:
+        return sorted(self.__schemas, key=_version_key)
+
+    def __closest(self, game_version: str) -> MatchSchema | None:
+        version_key = _version_key(game_version)
+        older = [version for version in self.__schemas if _version_key(version) < version_key]
+        if older:
+            return self.__schemas[max(older, key=_version_key)]
+        newer = [version for version in self.__schemas if version != game_version]
+        return self.__schemas[min(newer, key=_version_key)] if newer else None
+
+    def register(self, schema: MatchSchema) -> SchemaDrift | None:
+        """ Adds the schema of a new game version, returns its drift from the closest known version. """
+        if schema.game_version in self.__schemas:
+            return None
+        closest = self.__closest(schema.game_version)
+        self.__schemas[schema.game_version] = schema
+
+        if closest is None:
+            return None
+        drift = SchemaDrift.between(closest, schema) if _version_key(closest.game_version) < _version_key(schema.game_version) \
+            else SchemaDrift.between(schema, closest)
+        if drift:
+            self.drifts.append(drift)
+            if self.report_drift:
+                logger.warning(f"[!] Match schema drift {drift}")
+        return drift
+
+    def schema_of(self, riot_match_data: Dict) -> MatchSchema:
+        """ Schema of the match version, learned from the match on the first sight of the version. """
+        schema = self.__schemas.get(riot_match_data['info'].get('gameVersion', ''))
+        if schema is None:
+            schema = MatchSchema.of_match(riot_match_data)
+            logger.info(f"[+] Learned the match schema of the game version {schema.game_version}")
+            self.register(schema)
+            self.__learned.append(schema)
+        return schema
+
+    def pop_learned(self) -> List[MatchSchema]:
+        """ Schemas learned since the last call (e.g. to be reported by the main process). """
+        learned, self.__learned = self.__learned, []
+        return learned
+
+
+__ALL__ = ['MatchSchema', 'SchemaDrift', 'SchemaRegistry']
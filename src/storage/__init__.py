@@ -0,0 +1,2 @@
+from storage.match_archive import *
+from storage.match_store import *
@@ -0,0 +1,213 @@
+from typing import Dict, Iterator, List, Tuple
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# record header: magic, match id length, payload length, crc32 of the (compressed) payload
+_HEADER = struct.Struct('<2sBII')
+_MAGIC = b'MA'
+_INDEX_FILENAME = 'index.tsv'
+
+
+class MatchArchive:
+    """
+    Append-only archive of match payloads, replacing one-JSON-file-per-match directories.
+
+    Payloads are zlib compressed and appended as records into segment files (`segment_000001.dat`,
+    a new segment is started once the active one exceeds `segment_size` bytes). An index file
+    (`match_id  segment  offset  length` lines) maps match ids to their records, it is loaded into
+    memory on open. Records are read through mmap, both randomly (`get`) and sequentially (`scan`).
+
+    A record which was written but not indexed (crash in between) is re-indexed on open, a partial
+    record at the end of the active segment is truncated.
+
+    Example:
+
+    ```python
+    archive = MatchArchive('/data/matches')
+    archive.append('EUN1_3691872431', b'{"metadata": ...}')
+    payload = archive.get('EUN1_3691872431')
+    for match_id, payload in archive.scan():
+        ...
+    archive.close()
+    ```
+    """
+
+    directory: str
+    segment_size: int
+
+    def __init__(self, directory: str, segment_size: int = 256 * 1024 * 1024, compression_level: int = 6):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compression_level = compression_level
+        # match id -> (segment, offset of the record, record length)
+        self.__index: Dict[str, Tuple[int, int, int]] = {}
+        self.__maps: Dict[int, mmap.mmap] = {}
+        self.__lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.__load_index()
+        self.__active_segment = max(self.__segments(), default=1)
+        self.__recover(self.__active_segment)
+        self.__segment_file = open(self.__segment_path(self.__active_segment), 'ab')
+        self.__index_file = open(os.path.join(directory, _INDEX_FILENAME), 'a', encoding='utf-8')
+
+    def __segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment_{segment:06d}.dat")
+
+    def __segments(self) -> List[int]:
+        return sorted(
+            int(filename[len('segment_'):-len('.dat')])
+            for filename in os.listdir(self.directory)
+            if filename.startswith('segment_') and filename.endswith('.dat')
+        )
+
+    def __load_index(self):
+        index_path = os.path.join(self.directory, _INDEX_FILENAME)
+        if not os.path.isfile(index_path):
+            return
+        with open(index_path, 'r', encoding='utf-8') as index_file:
+            for line in index_file:
+                try:
+                    match_id, segment, offset, length = line.rstrip('\n').split('\t')
+                    self.__index[match_id] = (int(segment), int(offset), int(length))
+                except ValueError:
+                    logger.warning(f"[!] Skipping malformed archive index line: {line!r}")
+
+    def __recover(self, segment: int):
+        """ Indexes records written after the last indexed one, drops a partial record at the end. """
+        segment_path = self.__segment_path(segment)
+        if not os.path.isfile(segment_path):
+            return
+        indexed_end = max((offset + length for seg, offset, length in self.__index.values() if seg == segment), default=0)
+        segment_length = os.path.getsize(segment_path)
+        if indexed_end == segment_length:
+            return
+
+        # the unindexed tail is read once and walked record by record
+        with open(segment_path, 'rb') as segment_file:
+            segment_file.seek(indexed_end)
+            tail = memoryview(segment_file.read(segment_length - indexed_end))
+
+        recovered = []
+        position = 0
+        while position < len(tail):
+            record = self.__read_record(tail, position)
+            if record is None:
+                break
+            match_id, _payload, length = record
+            recovered.append((match_id, segment, indexed_end + position, length))
+            position += length
+        offset = indexed_end + position
+
+        if offset < segment_length:
+            logger.warning(f"[!] Truncating {segment_length - offset} bytes of a partial record in {segment_path}")
+            os.truncate(segment_path, offset)
+        with open(os.path.join(self.directory, _INDEX_FILENAME), 'a', encoding='utf-8') as index_file:
+            for match_id, seg, record_offset, length in recovered:
+                self.__index[match_id] = (seg, record_offset, length)
+                index_file.write(f"{match_id}\t{seg}\t{record_offset}\t{length}\n")
+        logger.info(f"[.] Recovered {len(recovered)} unindexed records of {segment_path}")
+
+    @staticmethod
+    def __read_record(buffer, offset: int) -> Tuple[str, bytes, int] | None:
+        """ Reads a record at `offset`, returns (match id, compressed payload, record length) or None if invalid. """
+        if offset + _HEADER.size > len(buffer):
+            return None
+        magic, id_length, payload_length, crc = _HEADER.unpack_from(buffer, offset)
+        start = offset + _HEADER.size
+        end = start + id_length + payload_length
+        if magic != _MAGIC or end > len(buffer):
+            return None
+        payload = bytes(buffer[start + id_length:end])
+        if zlib.crc32(payload) != crc:
+            return None
+        return bytes(buffer[start:start + id_length]).decode('ascii'), payload, end - offset
+
+    def __map(self, segment: int, end: int) -> mmap.mmap:
+        """ mmap of the segment covering at least `end` bytes (the active segment grows, so it is remapped). """
+        segment_map = self.__maps.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self.__segment_path(segment), 'rb') as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__maps[segment] = segment_map
+        return segment_map
+
+    def append(self, match_id: str, data: bytes):
+        """ Appends (uncompressed) match payload, already archived matches are skipped. """
+        payload = zlib.compress(data, self.compression_level)
+        match_id_bytes = match_id.encode('ascii')
+        record = _HEADER.pack(_MAGIC, len(match_id_bytes), len(payload), zlib.crc32(payload)) + match_id_bytes + payload
+
+        with self.__lock:
+            if match_id in self.__index:
+                return
+            if self.__segment_file.tell() >= self.segment_size:
+                self.__segment_file.close()
+                self.__active_segment += 1
+                self.__segment_file = open(self.__segment_path(self.__active_segment), 'ab')
+
+            offset = self.__segment_file.tell()
+            self.__segment_file.write(record)
+            self.__segment_file.flush()
+            # the index entry goes after the record, so an indexed record is always complete
+            self.__index_file.write(f"{match_id}\t{self.__active_segment}\t{offset}\t{len(record)}\n")
+            self.__index_file.flush()
+            self.__index[match_id] = (self.__active_segment, offset, len(record))
+
+    def get(self, match_id: str) -> bytes | None:
+        """ Random access to the (uncompressed) match payload. """
+        # appends (other threads) update the index and remapping closes the previous map
+        with self.__lock:
+            location = self.__index.get(match_id)
+            if location is None:
+                return None
+            segment, offset, length = location
+            record = self.__read_record(self.__map(segment, offset + length), offset)
+        if record is None:
+            raise ValueError(f"[!] Corrupted archive record of match {match_id}")
+        return zlib.decompress(record[1])
+
+    def location(self, match_id: str) -> str | None:
+        """ `segment:offset:length` of the match record. """
+        with self.__lock:
+            location = self.__index.get(match_id)
+        return ':'.join(map(str, location)) if location else None
+
+    def scan(self) -> Iterator[Tuple[str, bytes]]:
+        """ Sequential scan of all the (match id, uncompressed payload) records in the archive order. """
+        for match_id in self.ids():
+            yield match_id, self.get(match_id)
+
+    def ids(self) -> List[str]:
+        """ Archived match ids in the archive (segment, offset) order. """
+        # snapshot, the index may grow meanwhile
+        with self.__lock:
+            index = dict(self.__index)
+        return sorted(index, key=index.__getitem__)
+
+    def __contains__(self, match_id: str) -> bool:
+        with self.__lock:
+            return match_id in self.__index
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__index)
+
+    def close(self):
+        with self.__lock:
+            for segment_map in self.__maps.values():
+                segment_map.close()
+            self.__maps.clear()
+            self.__segment_file.close()
+            self.__index_file.close()
+
+
+__ALL__ = ['MatchArchive']
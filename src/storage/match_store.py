@@ -0,0 +1,112 @@
+from typing import List
+import asyncio
+import gzip
+import os
+import aiofiles
+
+from storage.match_archive import MatchArchive
+from utils.fs_helpers import get_filepaths_from_dir
+import config
+
+
+class DirectoryMatchStore:
+    """
+    Storage backend keeping one `{match_id}.json` (or `.json.gz`) file per match in a flat directory.
+    """
+
+    directory: str
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def filepath(self, match_id: str, compress: bool = False) -> str:
+        return os.path.join(self.directory, f"{match_id}.json" + ('.gz' if compress else ''))
+
+    def __existing_filepath(self, match_id: str) -> str | None:
+        for compress in (False, True):
+            if os.path.isfile(self.filepath(match_id, compress)):
+                return self.filepath(match_id, compress)
+        return None
+
+    async def put(self, match_id: str, data: bytes):
+        async with aiofiles.open(self.filepath(match_id), 'wb') as f:
+            await f.write(data)
+
+    async def get(self, match_id: str) -> bytes | None:
+        filepath = self.__existing_filepath(match_id)
+        if filepath is None:
+            return None
+        async with aiofiles.open(filepath, mode='rb') as f:
+            content = await f.read()
+        return gzip.decompress(content) if filepath.endswith('.gz') else content
+
+    def contains(self, match_id: str) -> bool:
+        return self.__existing_filepath(match_id) is not None
+
+    def fingerprint(self, match_id: str) -> str | None:
+        """ Changes whenever the stored match changes (file size and mtime). """
+        filepath = self.__existing_filepath(match_id)
+        if filepath is None:
+            return None
+        stat = os.stat(filepath)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def ids(self) -> List[str]:
+        return [
+            os.path.basename(filepath).split('.json')[0]
+            for filepath in get_filepaths_from_dir(self.directory)
+            if filepath.endswith(('.json', '.json.gz'))
+        ]
+
+    def close(self):
+        pass
+
+
+class ArchiveMatchStore:
+    """
+    Storage backend keeping the matches in the append-only `MatchArchive`.
+    """
+
+    archive: MatchArchive
+
+    def __init__(self, directory: str, segment_size: int):
+        self.archive = MatchArchive(directory, segment_size=segment_size)
+
+    async def put(self, match_id: str, data: bytes):
+        # compression + write, keep it off the event loop
+        await asyncio.to_thread(self.archive.append, match_id, data)
+
+    async def get(self, match_id: str) -> bytes | None:
+        # mmap read + decompression, keep it off the event loop
+        return await asyncio.to_thread(self.archive.get, match_id)
+
+    def contains(self, match_id: str) -> bool:
+        return match_id in self.archive
+
+    def fingerprint(self, match_id: str) -> str | None:
+        """ Archived records are immutable, their location identifies them. """
+        return self.archive.location(match_id)
+
+    def ids(self) -> List[str]:
+        return self.archive.ids()
+
+    def close(self):
+        self.archive.close()
+
+
+MatchStore = DirectoryMatchStore | ArchiveMatchStore
+
+
+def create_match_store() -> MatchStore:
+    """ Creates the match storage backend configured in `config.storage`. """
+    if config.storage['backend'] == 'archive':
+        if not config.storage['archive_dir']:
+            raise ValueError("The match archive directory is not set (`LOL_MATCH_ARCHIVE_DIR`)")
+        return ArchiveMatchStore(config.storage['archive_dir'], segment_size=config.storage['segment_size'])
+    if not config.exports['match_files_dir']:
+        raise ValueError("The match files directory is not set (`LOL_MATCH_FILES_DIR`)")
+    return DirectoryMatchStore(config.exports['match_files_dir'])
+
+
+__ALL__ = ['DirectoryMatchStore', 'ArchiveMatchStore', 'MatchStore', 'create_match_store']
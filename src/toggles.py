@@ -9,3 +9,7 @@ FETCH_STATISTICS_TOGGLE = False
 
 # Phase 3 - Export match statistics to a CSV file
 EXPORT_STATISTICS_TOGGLE = True
+
+# All the phases at once - crawled match ids flow into the statistics downloads and downloaded matches
+# into the export through bounded queues (the phase toggles above are ignored)
+PIPELINE_TOGGLE = False
@@ -0,0 +1,105 @@
+from typing import Any, Iterable, List, Sequence, TextIO, Tuple
+import re
+
+# `datetime.strftime` format of the date attributes and the same format for Weka (Java `SimpleDateFormat`)
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+_ARFF_DATE_FORMAT = 'yyyy-MM-dd HH:mm:ss'
+# nominal values of boolean attributes, `False` first - omitted sparse values mean the first one
+BOOLEAN_VALUES = ('False', 'True')
+
+_PLAIN_VALUE = re.compile(r'^[A-Za-z0-9_.\-+]+$')
+
+
+def _quote(value: str) -> str:
+    """ Quotes the value (or attribute name) only when ARFF requires it. """
+    if _PLAIN_VALUE.match(value) and value not in ('?', ''):
+        return value
+    escaped = value.replace('\\', '\\\\').replace("'", "\\'").replace('\n', '\\n').replace('\r', '\\r')
+    return f"'{escaped}'"
+
+
+class ArffAttribute:
+    """
+    Attribute of the ARFF relation.
+
+    `attribute_type` is one of `numeric`, `string`, `date`, `boolean` or a tuple of nominal values.
+    """
+
+    def __init__(self, name: str, attribute_type: str | Tuple[str, ...]):
+        self.name = name
+        self.attribute_type = attribute_type
+
+    def declaration(self) -> str:
+        if self.attribute_type == 'numeric':
+            declared = 'NUMERIC'
+        elif self.attribute_type == 'string':
+            declared = 'STRING'
+        elif self.attribute_type == 'date':
+            declared = f'DATE "{_ARFF_DATE_FORMAT}"'
+        else:
+            values = BOOLEAN_VALUES if self.attribute_type == 'boolean' else self.attribute_type
+            declared = '{' + ','.join(_quote(value) for value in values) + '}'
+        return f"@ATTRIBUTE {_quote(self.name)} {declared}"
+
+    def format(self, value: Any) -> str | None:
+        """ ARFF representation of the value, None for the default (zero) value omitted by sparse rows. """
+        if value is None or value == '':
+            return '?'
+        if self.attribute_type == 'numeric':
+            if isinstance(value, bool):
+                value = int(value)
+            if value == 0:
+                return None
+            return repr(value) if isinstance(value, float) else str(value)
+        if self.attribute_type == 'boolean':
+            value = value if isinstance(value, bool) else str(value) == 'True'
+            return BOOLEAN_VALUES[value] if value else None
+        return _quote(str(value))
+
+
+class ArffWriter:
+    """
+    Streams an ARFF relation into a text file - the header is written once, then the rows are
+    formatted and written right away, so the memory usage doesn't depend on the export size.
+
+    Sparse rows (`{index value, ...}`) omit zero numeric values and `False` booleans, which makes
+    wide, mostly-zero exports much smaller and faster to load by Weka.
+    """
+
+    def __init__(self, f: TextIO, relation: str, attributes: Sequence[ArffAttribute], sparse: bool = False):
+        self.f = f
+        self.relation = relation
+        self.attributes = list(attributes)
+        self.sparse = sparse
+
+    def write_header(self):
+        lines = [f"@RELATION {_quote(self.relation)}", '']
+        lines.extend(attribute.declaration() for attribute in self.attributes)
+        lines.extend(['', '@DATA', ''])
+        self.f.write('\n'.join(lines))
+
+    def writerow(self, row: List[Any]):
+        self.f.write(self.format_row(row) + '\n')
+
+    def writerows(self, rows: Iterable[List[Any]]):
+        self.f.write(''.join(self.format_row(row) + '\n' for row in rows))
+
+    def format_row(self, row: List[Any]) -> str:
+        if self.sparse:
+            values = []
+            for idx, (attribute, value) in enumerate(zip(self.attributes, row)):
+                formatted = attribute.format(value)
+                if formatted is not None:
+                    values.append(f"{idx} {formatted}")
+            return '{' + ', '.join(values) + '}'
+
+        values = []
+        for attribute, value in zip(self.attributes, row):
+            formatted = attribute.format(value)
+            if formatted is None:
+                formatted = '0' if attribute.attribute_type == 'numeric' else BOOLEAN_VALUES[0]
+            values.append(formatted)
+        return ','.join(values)
+
+
+__ALL__ = ['ArffAttribute', 'ArffWriter', 'DATE_FORMAT', 'BOOLEAN_VALUES']
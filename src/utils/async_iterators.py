@@ -0,0 +1,49 @@
+import asyncio
+from typing import Any, AsyncIterator, List
+
+
+async def iter_batches(items: List[Any], batch_size: int) -> AsyncIterator[List[Any]]:
+    """
+    Yields the list in batches of `batch_size` items.
+    """
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+async def iter_queue(queue: asyncio.Queue) -> AsyncIterator[Any]:
+    """
+    Yields the items of the queue until None (end of the queue) is received.
+    """
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            yield item
+        finally:
+            queue.task_done()
+
+
+async def iter_queue_batches(queue: asyncio.Queue, batch_size: int) -> AsyncIterator[List[Any]]:
+    """
+    Yields the items of the queue in batches of at most `batch_size` items until None (end of the queue) is received.
+    Waits only for the first item of a batch, the rest are the items already queued - items are never held back
+    waiting for a full batch.
+    """
+    while True:
+        batch = []
+        item = await queue.get()
+        queue.task_done()
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= batch_size or queue.empty():
+                break
+            item = queue.get_nowait()
+            queue.task_done()
+        if batch:
+            yield batch
+        if item is None:
+            return
+
+
+__ALL__ = ['iter_batches', 'iter_queue', 'iter_queue_batches']
@@ -0,0 +1,60 @@
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List
+import json
+import os
+
+
+@dataclass
+class ExportManifest:
+    """
+    Records what was exported into the export file - the columns, the transform version, the roster and
+    a fingerprint (size/mtime, archive location...) of every exported match, so the next export
+    only transforms new matches and appends them.
+    """
+    transform_version: int
+    columns: List[str]
+    export_filename: str | None = None
+    # columns order of the export file (None until the first row was written)
+    headers: List[str] | None = None
+    # match id -> fingerprint of the exported match
+    matches: Dict[str, str] = field(default_factory=dict)
+    # format of the export file (`csv`, `arff`)
+    export_format: str = 'csv'
+    # types of the `headers` columns (see `column_type`), needed to append typed (ARFF) rows
+    column_types: List | None = None
+    # sorted puuids of the roster - the team columns (friendly or enemy) of every row depend on it
+    roster: List[str] | None = None
+
+    def is_compatible(self, transform_version: int, columns: List[str], export_format: str = 'csv',
+                      roster: List[str] | None = None) -> bool:
+        """ Whether new rows can be appended to the export, otherwise a full rebuild is needed. """
+        return (
+            self.transform_version == transform_version
+            and self.columns == columns
+            and self.export_format == export_format
+            and self.roster == sorted(roster or [])
+            and self.headers is not None
+            and (export_format == 'csv' or self.column_types is not None)
+            and self.export_filename is not None
+            and os.path.isfile(self.export_filename)
+        )
+
+    @staticmethod
+    def load(filepath: str) -> 'ExportManifest | None':
+        if not os.path.isfile(filepath):
+            return None
+        with open(filepath, 'r', encoding='utf-8') as f:
+            try:
+                return ExportManifest(**json.load(f))
+            except (json.JSONDecodeError, TypeError):
+                return None
+
+    def save(self, filepath: str):
+        # write to a temporary file first, so a crash never leaves a broken manifest
+        tmp_filepath = f"{filepath}.tmp"
+        with open(tmp_filepath, 'w', encoding='utf-8') as f:
+            json.dump(asdict(self), f)
+        os.replace(tmp_filepath, filepath)
+
+
+__ALL__ = ['ExportManifest']
@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Type
+import asyncio
+import csv
+import json
+import os
+
+from utils.arff_writer import ArffAttribute, ArffWriter
+
+
+@dataclass
+class ExportSchema:
+    """ Columns of the export file (in order) and their types (see `column_type`). """
+    columns: List[str]
+    types: List
+
+
+class ExportSink:
+    """
+    Writes batches of rows (lists of values in the `ExportSchema.columns` order) into the export file.
+
+    Sinks do plain blocking IO with a large write buffer - they are meant to be driven by a
+    `SinkWriter`, which runs them on a dedicated writer thread.
+    """
+    extension: str
+
+    def __init__(self, filepath: str, append: bool = False, buffer_size: int = 1 << 20):
+        self.filepath = filepath
+        self.append = append
+        self.buffer_size = buffer_size
+        self.schema: ExportSchema | None = None
+        self.f = None
+
+    def open(self, schema: ExportSchema):
+        self.schema = schema
+        self.f = open(self.filepath, 'a' if self.append else 'w', newline='', encoding='utf-8', buffering=self.buffer_size)
+        self.on_open()
+        # appended export already has its header
+        if not self.append:
+            self.write_header()
+
+    def on_open(self):
+        """ Called once the file is open, before the header is written. """
+
+    def write_header(self):
+        pass
+
+    def write_rows(self, rows: List[List[Any]]):
+        raise NotImplementedError
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class CsvSink(ExportSink):
+    extension = 'csv'
+
+    def on_open(self):
+        self.__writer = csv.writer(self.f)
+
+    def write_header(self):
+        self.__writer.writerow(self.schema.columns)
+
+    def write_rows(self, rows: List[List[Any]]):
+        self.__writer.writerows(rows)
+
+
+class NdjsonSink(ExportSink):
+    """ One JSON object per line, missing values are `null`. """
+    extension = 'ndjson'
+
+    def write_rows(self, rows: List[List[Any]]):
+        columns = self.schema.columns
+        self.f.write(''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows))
+
+
+class ArffSink(ExportSink):
+    """ Weka ARFF relation with attributes typed by the export schema. """
+    extension = 'arff'
+
+    def __init__(self, filepath: str, append: bool = False, buffer_size: int = 1 << 20, sparse: bool = False):
+        super().__init__(filepath, append, buffer_size)
+        self.sparse = sparse
+
+    def on_open(self):
+        attributes = [
+            ArffAttribute(column, attribute_type)
+            for column, attribute_type in zip(self.schema.columns, self.schema.types)
+        ]
+        relation = os.path.splitext(os.path.basename(self.filepath))[0]
+        self.__writer = ArffWriter(self.f, relation, attributes, sparse=self.sparse)
+
+    def write_header(self):
+        self.__writer.write_header()
+
+    def write_rows(self, rows: List[List[Any]]):
+        self.__writer.writerows(rows)
+
+
+SINKS: Dict[str, Type[ExportSink]] = {sink.extension: sink for sink in (CsvSink, NdjsonSink, ArffSink)}
+
+
+def create_export_sink(export_format: str, filepath: str, append: bool = False, **kwargs) -> ExportSink:
+    if export_format not in SINKS:
+        raise ValueError(f"Unsupported export format: {export_format}, expected one of {list(SINKS)}")
+    return SINKS[export_format](filepath, append, **kwargs)
+
+
+class SinkWriter:
+    """
+    Runs the sink on its own writer thread - every batch of rows is handed off to the thread
+    at once, so the event loop never waits for the disk. Every writer has its own thread,
+    so several exports can be written concurrently.
+    """
+
+    def __init__(self, sink: ExportSink):
+        self.sink = sink
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"export-{sink.extension}")
+
+    async def __run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, fn, *args)
+
+    async def open(self, schema: ExportSchema):
+        await self.__run(self.sink.open, schema)
+
+    async def write(self, rows: List[List[Any]]):
+        await self.__run(self.sink.write_rows, rows)
+
+    async def close(self):
+        try:
+            await self.__run(self.sink.close)
+        finally:
+            self.__executor.shutdown(wait=False)
+
+
+__ALL__ = ['ExportSchema', 'ExportSink', 'CsvSink', 'NdjsonSink', 'ArffSink', 'SINKS', 'create_export_sink', 'SinkWriter']
@@ -0,0 +1,104 @@
+from typing import Dict, List
+import os
+import re
+import zlib
+import aiofiles
+
+# chunk overlap kept between two chunks, so a field split by the chunk boundary is still found
+_OVERLAP = 128
+
+
+class JsonStreamError(Exception):
+    """Exception raised when the streamed JSON document doesn't pass the validation."""
+
+
+class JsonFileStream:
+    """
+    Writes a JSON document chunk by chunk straight into a file (optionally gzip compressed),
+    without parsing and re-serializing it.
+
+    The document is validated incrementally (cheap structural checks only - it has to be an object
+    of the expected length) and top-level numeric `fields` (e.g. `gameEndTimestamp`) are extracted
+    on the fly. The data is written into a temporary file first, which is moved to `filepath`
+    only when the whole document was received and valid.
+
+    Example:
+
+    ```python
+    async with JsonFileStream('match.json.gz', fields=['gameEndTimestamp'], compress=True) as stream:
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            await stream.write(chunk)
+    print(stream.extracted)
+    ```
+    """
+
+    filepath: str
+    extracted: Dict[str, int]
+
+    def __init__(self, filepath: str, fields: List[str] | None = None, compress: bool = False, expected_length: int | None = None):
+        self.filepath = filepath
+        self.expected_length = expected_length
+        self.extracted = {}
+        self.length = 0
+        self.__fields = {field: re.compile(rb'"' + re.escape(field.encode()) + rb'"\s*:\s*(-?\d+)') for field in fields or []}
+        # wbits=31 -> gzip container
+        self.__compressor = zlib.compressobj(wbits=31) if compress else None
+        self.__tmp_filepath = f"{filepath}.{os.getpid()}.part"
+        self.__tail = b''
+        self.__first_byte = None
+        self.__file = None
+
+    async def __aenter__(self):
+        self.__file = await aiofiles.open(self.__tmp_filepath, mode='wb')
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                if self.__compressor is not None:
+                    await self.__file.write(self.__compressor.flush())
+                self.__validate()
+        except Exception:
+            await self.__file.close()
+            os.remove(self.__tmp_filepath)
+            raise
+        await self.__file.close()
+        if exc_type is not None:
+            os.remove(self.__tmp_filepath)
+            return
+        os.replace(self.__tmp_filepath, self.filepath)
+
+    async def write(self, chunk: bytes):
+        if not chunk:
+            return
+        self.length += len(chunk)
+        if self.__first_byte is None and chunk.strip():
+            self.__first_byte = chunk.lstrip()[:1]
+
+        window = self.__tail + chunk
+        for field, pattern in self.__fields.items():
+            if field in self.extracted:
+                continue
+            match = pattern.search(window)
+            # the number could continue in the next chunk
+            if match and match.end() < len(window):
+                self.extracted[field] = int(match.group(1))
+        self.__tail = window[-_OVERLAP:]
+
+        await self.__file.write(self.__compressor.compress(chunk) if self.__compressor is not None else chunk)
+
+    def __validate(self):
+        last_byte = self.__tail.rstrip()[-1:]
+        if self.__first_byte != b'{' or last_byte != b'}':
+            raise JsonStreamError(f"{self.filepath} is not a JSON object")
+        if self.expected_length is not None and self.length != self.expected_length:
+            raise JsonStreamError(f"{self.filepath} is truncated: {self.length}/{self.expected_length} bytes")
+        # the field at the very end of the document
+        for field, pattern in self.__fields.items():
+            if field not in self.extracted:
+                match = pattern.search(self.__tail)
+                if match:
+                    self.extracted[field] = int(match.group(1))
+
+
+__ALL__ = ['JsonFileStream', 'JsonStreamError']
@@ -2,9 +2,29 @@ def construct_query_params(**params):
     query_params = ""
     for param_key in params:
         param_value = params[param_key]
-        if param_value:
+        # `0` is a valid value (e.g. `start`, custom games `queue`)
+        if param_value is not None:
             query_params += f"&{param_key}={param_value}"
     if query_params:
         # replace first '&' with '?'
         query_params = '?' + query_params[1:]
     return query_params
+
+
+def parse_rate_limit_header(header_value: str | None) -> list[tuple[int, int]]:
+    """
+    Parses Riot rate limit headers (`X-App-Rate-Limit`, `X-App-Rate-Limit-Count`, ...)
+    in the `value:time_window,value:time_window` format, e.g. "20:1,100:120".
+
+    @return: list of (value, time_window) tuples, empty list for missing/malformed headers
+    """
+    if not header_value:
+        return []
+    parsed = []
+    for rate_limit in header_value.split(','):
+        try:
+            value, time_window = rate_limit.strip().split(':')
+            parsed.append((int(value), int(time_window)))
+        except ValueError:
+            return []
+    return parsed
@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+from enum import Enum
 from typing import List, Callable, Any, Optional, Awaitable
 import logging
 import asyncio
@@ -27,22 +28,73 @@ class RateLimit:
             raise ValueError("Rate limit time window must be greater than 0")
 
 
+class PacingPolicy(Enum):
+    """
+    How permits are distributed inside the rate limits.
+
+    - `SPREAD` - requests are spread evenly, the time step is based on the slowest rate limit
+    - `BURST` - requests are granted as soon as every window has a free slot, then we wait
+    - `MAX_THROUGHPUT` - requests are spread based on the fastest rate limit, slower windows
+      are still enforced (bursts at the fast rate, then waits for the slow window)
+    """
+    SPREAD = 'spread'
+    BURST = 'burst'
+    MAX_THROUGHPUT = 'max_throughput'
+
+
 @dataclass
 class _SlidingWindow:
-    """Class for defining sliding windows"""
+    """
+    Class for defining sliding windows
+
+    Keeps the granted permits which still count against the window in a deque (oldest first),
+    expired ones are pruned from its left, so the deque length is the running count of the window.
+    """
     # Rate limit for this sliding window
     rate_limit: RateLimit
-    # Queue to store timestamps of requests
-    queue: deque = field(default_factory=deque)
+    # Timestamps (time.monotonic) of the granted permits within the window
+    queue: deque = field(init=False)
     # Time step for the sliding window
     delta_t: float = field(init=False)
 
     def __post_init__(self):
+        self.queue = deque()
         self.delta_t = self.rate_limit.time_window / self.rate_limit.value
 
     def is_full(self):
         return len(self.queue) >= self.rate_limit.value
 
+    def earliest(self) -> float:
+        """Earliest time at which a new permit fits into this window - O(1)."""
+        if not self.is_full():
+            return 0
+        # the permit which has to expire first, permits over the limit (see `sync_count`) wait too
+        return self.queue[-self.rate_limit.value] + self.rate_limit.time_window
+
+    def prune(self, now: float):
+        """Drops the permits which expired by `now` - amortized O(1)."""
+        expired = now - self.rate_limit.time_window
+        while self.queue and self.queue[0] <= expired:
+            self.queue.popleft()
+
+    def grant(self, timestamp: float):
+        self.queue.append(timestamp)
+        # permits are granted in order, the expired ones never delay a later permit
+        self.prune(timestamp)
+
+    def release(self, timestamp: float):
+        """Gives back a permit which was not used."""
+        try:
+            self.queue.remove(timestamp)
+        except ValueError:
+            # already expired
+            pass
+
+    def count(self, now: float) -> int:
+        """Number of permits granted within the last `time_window` seconds."""
+        self.prune(now)
+        return len(self.queue)
+
 
 class ThrottledTaskRunner:
     """
@@ -52,16 +104,21 @@ class ThrottledTaskRunner:
     have a rate limit of 20 requests per second and 50 requests per minute.
 
     This class allows you to define rate limits and run arbitrary code while adhering
-    to those specific rate limits using a sliding window approach. The approach ensures 
-    that the rate limits are not exceeded over the specified time windows while allowing 
-    for "bursts" of requests by choosing small time step. **By default, the time step (`delta_t`) 
-    is precalculated based on the slowest rate limit, so the requests are distributed 
+    to those specific rate limits using a sliding window approach. The approach ensures
+    that the rate limits are not exceeded over the specified time windows while the
+    `PacingPolicy` decides how bursty the requests can be. **By default, the time step (`delta_t`)
+    is precalculated based on the slowest rate limit, so the requests are distributed
     evenly over the time windows**.
 
+    Permits are reserved synchronously (no `await` between reading and updating the windows),
+    so the runner is safe to share between many coroutines. Every caller gets its own time
+    slot in the order of calling (FIFO) and then just sleeps until the slot comes. Each
+    reservation is O(1), since every window only looks at its oldest permit.
+
     Example:
 
     ```python
-    from throttled_task_runner import ThrottledTaskRunner, RateLimit
+    from throttled_task_runner import ThrottledTaskRunner, RateLimit, PacingPolicy
 
     async def main():
         try:
@@ -70,7 +127,7 @@ class ThrottledTaskRunner:
                 RateLimit(value=50, time_window=60)
             ]
 
-            ttr = ThrottledTaskRunner(rate_limits=rate_limits, delta_t=0.1)
+            ttr = ThrottledTaskRunner(rate_limits=rate_limits, policy=PacingPolicy.BURST)
 
             async def some_request(param1, param2):
                 return f'Request: {param1}, {param2}'
@@ -90,52 +147,151 @@ class ThrottledTaskRunner:
     """
     rate_limits: List[RateLimit]
     delta_t: float
+    policy: PacingPolicy
+    margin: float
 
     # META
     __counter: int = 0
-    __last_time_ran: float = 0
+    __last_reserved: float = 0
+    __paused_until: float = 0
     __sliding_windows: List[_SlidingWindow]
 
-    def __init__(self, rate_limits: List[RateLimit], delta_t: Optional[float] = None):
+    def __init__(
+        self,
+        rate_limits: List[RateLimit],
+        delta_t: Optional[float] = None,
+        policy: PacingPolicy = PacingPolicy.SPREAD,
+        margin: float = 0.05,
+    ):
         """
         Args:
             rate_limits (List[RateLimit]): A list of RateLimit objects defining the rate limits.
             delta_t (Optional[float]): The time step speed (in seconds) for the sliding windows.
-                Defaults to None and will be precalculated based on the slowest rate limit.
+                Defaults to None and will be precalculated based on the `policy`.
+            policy (PacingPolicy): Strategy used to precalculate `delta_t`. Defaults to `PacingPolicy.SPREAD`.
+            margin (float): Extra seconds added to every window to account for clock/network errors.
         """
         self.rate_limits = rate_limits
-        self.delta_t = delta_t
+        self.policy = policy
+        self.margin = margin
+        self.__explicit_delta_t = delta_t
+        self.__last_reserved = 0
+        self.__paused_until = 0
+        self.__counter = 0
 
         self.__sliding_windows = [_SlidingWindow(rate_limit) for rate_limit in rate_limits]
+        self.delta_t = self.__compute_delta_t()
+        logger.info(f"[.] Sliding windows delta_t: {self.delta_t} ({self.policy.value})")
 
-        # Determine the time step (delta_t) for the sliding windows:
-        # NOTE:
-        # We could choose different strategies here, such as fetching as fast as possible
-        # by setting delta_t to the minimum of all rate limits.
-        if self.delta_t is None:
+    def __compute_delta_t(self) -> float:
+        if self.__explicit_delta_t is not None:
+            return self.__explicit_delta_t
+        if self.policy == PacingPolicy.SPREAD:
             # try to distribute the requests evenly over the time windows
-            self.delta_t = max([window.delta_t for window in self.__sliding_windows])
-        logger.info(f"[.] Sliding windows delta_t: {self.delta_t}")
-
-    async def __check_sliding_window(self, window: _SlidingWindow):
-        if window.is_full():
-            queue, ratelimit, ratelimit_time_window = window.queue, window.rate_limit.value, window.rate_limit.time_window
-            logger.debug(f'[>] Sliding window ({ratelimit_time_window}s) size: {len(queue)}/{ratelimit}')
-            while len(queue):
-                oldest = queue[0]
-                time_passed = time.time() - oldest
-                # we can remove the oldest element(s)
-                if time_passed >= ratelimit_time_window:
-                    queue.popleft()
-                # we exceeded the rate limit, so we have to wait
-                elif window.is_full():
-                    sleep_time = ratelimit_time_window - time_passed + 0.6  # 0.6 to account for some time errors
-                    logger.debug(f"[>] Rate limit exceeded for sliding window ({ratelimit_time_window}s), sleeping for: {sleep_time}")
-                    await asyncio.sleep(sleep_time)
-                # sliding window is now within the limits
-                else:
-                    break
-            logger.debug(f'[<] Sliding window ({ratelimit_time_window}s) size: {len(queue)}/{ratelimit}')
+            return max(window.delta_t for window in self.__sliding_windows)
+        if self.policy == PacingPolicy.MAX_THROUGHPUT:
+            # fetch as fast as the fastest window allows, slower windows will make us wait
+            return min(window.delta_t for window in self.__sliding_windows)
+        return 0
+
+    def earliest(self) -> float:
+        """
+        Earliest time (`time.monotonic`) at which the next permit can be granted.
+        """
+        earliest = self.__last_reserved + self.delta_t if self.__counter else 0
+        earliest = max(earliest, self.__last_reserved, self.__paused_until)
+        for window in self.__sliding_windows:
+            earliest = max(earliest, window.earliest() + self.margin)
+        return earliest
+
+    def grant(self, timestamp: float):
+        """
+        Records a permit granted at `timestamp`. Timestamps have to be non-decreasing,
+        which `reserve` (and `earliest`) guarantee.
+        """
+        self.__counter += 1
+        self.__last_reserved = timestamp
+        for window in self.__sliding_windows:
+            window.grant(timestamp)
+
+    def release(self, timestamp: float):
+        """
+        Gives back a permit granted at `timestamp` which was not used (e.g. moved past a pause),
+        so it doesn't count against the windows twice.
+        """
+        self.__counter = max(self.__counter - 1, 0)
+        for window in self.__sliding_windows:
+            window.release(timestamp)
+
+    def update_rate_limits(self, rate_limits: List[RateLimit]):
+        """
+        Resizes the sliding windows at runtime (e.g. based on the limits reported by the API).
+        Already granted permits are kept for windows with the same time window.
+        """
+        if [(r.value, r.time_window) for r in rate_limits] == [(r.value, r.time_window) for r in self.rate_limits]:
+            return
+
+        old_windows = {window.rate_limit.time_window: window for window in self.__sliding_windows}
+        longest_history = max(self.__sliding_windows, key=lambda window: len(window.queue), default=None)
+
+        sliding_windows = []
+        for rate_limit in rate_limits:
+            window = _SlidingWindow(rate_limit)
+            previous = old_windows.get(rate_limit.time_window, longest_history)
+            if previous is not None:
+                window.queue.extend(previous.queue)
+            sliding_windows.append(window)
+
+        logger.info(f"[.] Rate limits updated: {self.rate_limits} -> {rate_limits}")
+        self.rate_limits = rate_limits
+        self.__sliding_windows = sliding_windows
+        self.delta_t = self.__compute_delta_t()
+
+    def sync_count(self, time_window: int, count: int):
+        """
+        Aligns our bookkeeping with the count reported by the server for the given time window.
+        If the server has seen more requests than we know about (other processes using the same
+        key, requests lost in flight...), the missing permits are counted as granted right now.
+        """
+        now = time.monotonic()
+        for window in self.__sliding_windows:
+            if window.rate_limit.time_window != time_window:
+                continue
+            missing = min(count, window.rate_limit.value) - window.count(now)
+            if missing > 0:
+                logger.debug(f"[.] Sliding window ({time_window}s) is behind the server by {missing} requests")
+                timestamp = max(now, self.__last_reserved)
+                for _ in range(missing):
+                    window.grant(timestamp)
+
+    @property
+    def paused_until(self) -> float:
+        """ No permit is granted before this time (`time.monotonic`), see `pause`. """
+        return self.__paused_until
+
+    def pause(self, seconds: float):
+        """
+        No permit will be granted for the next `seconds` seconds (e.g. `Retry-After` of a 429 response).
+        Permits reserved before the pause are moved past it by `acquire` / `acquire_all`.
+        """
+        self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+        logger.warning(f"[!] Rate limiter paused for {seconds}s")
+
+    def reserve(self) -> float:
+        """
+        Reserves the next free permit and returns its time slot (`time.monotonic`).
+
+        Must not `await` anything - this is what makes the runner safe for concurrent callers.
+        """
+        return reserve_all([self])
+
+    async def acquire(self):
+        """
+        Waits until a permit is granted. Permits are granted in the order of calling.
+
+        A cancelled caller doesn't give its slot back, which only makes us slower, never faster.
+        """
+        await _sleep_until_reserved([self])
 
     async def run(
         self,
@@ -144,8 +300,8 @@ class ThrottledTaskRunner:
         **kwargs
     ) -> Any:
         """
-        Run the specified callback `cb` function while adhering to the rate limits. 
-        It will take at least `delta_t` seconds before the callback is called.
+        Run the specified callback `cb` function while adhering to the rate limits.
+        It will take at least `delta_t` seconds between two callback calls.
 
         Any additional arguments and keyword arguments will be passed to the callback function.
 
@@ -155,33 +311,67 @@ class ThrottledTaskRunner:
         Returns:
             Any: The result of the callback function.
         """
+        await self.acquire()
+
+        logger.debug(f"[+] Calling {cb.__name__}, iteration: {self.__counter}")
 
-        remaining_sleep = self.delta_t - (time.time() - self.__last_time_ran)
-        if remaining_sleep > 0:
-            logger.debug(f"[.] Early call detected, sleeping for: {remaining_sleep}")
-            await asyncio.sleep(remaining_sleep)
+        if asyncio.iscoroutinefunction(cb):
+            return await cb(*args, **kwargs)
+        return cb(*args, **kwargs)
 
-        for window in self.__sliding_windows:
-            await self.__check_sliding_window(window)
 
-        if any(window.is_full() for window in self.__sliding_windows):
-            raise RuntimeError("Unexpected full window detected; please report this incident")
+def reserve_all(runners: List[ThrottledTaskRunner]) -> float:
+    """
+    Reserves one permit in every runner at the same time slot - the earliest one at which
+    all of them have a free permit.
+    """
+    slot = max([time.monotonic(), *(runner.earliest() for runner in runners)])
+    for runner in runners:
+        runner.grant(slot)
+    return slot
 
-        self.__counter += 1
-        logger.debug(f"[+] Calling {cb.__name__}, iteration: {self.__counter}")
 
-        res = None
-        if asyncio.iscoroutinefunction(cb):
-            res = await cb(*args, **kwargs)
-        else:
-            res = cb(*args, **kwargs)
+async def acquire_all(runners: List[ThrottledTaskRunner]):
+    """
+    Waits until a permit is granted by all the `runners` - hierarchical rate limits, e.g.
+    app-wide rate limit (first runner, shared by everybody) and per-endpoint rate limits.
+
+    The other runners only gate the caller: we wait (without reserving anything) until each of
+    them has a free permit, and only then reserve the permits in all of them at once, queueing
+    FIFO on the first one. This way a caller stuck on its own endpoint limit never blocks callers
+    of other endpoints in the shared runner.
+    """
+    shared, gates = runners[0], runners[1:]
+    while gates:
+        gate_slot = max(gate.earliest() for gate in gates)
+        if gate_slot <= time.monotonic():
+            break
+        await sleep_until(gate_slot)
+    await _sleep_until_reserved([shared, *gates])
+
+
+async def _sleep_until_reserved(runners: List[ThrottledTaskRunner]):
+    """
+    Reserves a permit in all the `runners` and sleeps until its slot. When a runner got paused
+    meanwhile (429) and the pause covers the slot, the unused permit is released and a new one is
+    reserved after the pause - the permits reserved before a 429 never fire during its `Retry-After`.
+    """
+    while True:
+        slot = reserve_all(runners)
+        await sleep_until(slot)
+        if all(runner.paused_until <= slot for runner in runners):
+            return
+        logger.debug("[.] Rate limiter paused while waiting for a slot, reserving a new one")
+        for runner in runners:
+            runner.release(slot)
 
-        now = time.time()
-        self.__last_time_ran = now
-        for window in self.__sliding_windows:
-            window.queue.append(now)
 
-        return res
+async def sleep_until(slot: float):
+    """ Sleeps until the given `time.monotonic` timestamp. """
+    remaining_sleep = slot - time.monotonic()
+    if remaining_sleep > 0:
+        logger.debug(f"[.] Waiting for a free slot, sleeping for: {remaining_sleep}")
+        await asyncio.sleep(remaining_sleep)
 
 
-__ALL__ = ['RateLimit', 'SlidingWindowLoop']
+__ALL__ = ['RateLimit', 'PacingPolicy', 'ThrottledTaskRunner', 'reserve_all', 'acquire_all']
@@ -1,3 +1,6 @@
+from datetime import datetime, timezone
+
+
 def get_next_timestamp(timestamp_ms: int) -> int:
     """
     We iterate the matches from the newest to the oldest.
@@ -11,3 +14,22 @@ def get_next_timestamp(timestamp_ms: int) -> int:
     """
     # -1 s to avoid fetching the last match again
     return int(timestamp_ms / 1000) - 1
+
+
+def parse_timestamp(value: str | None) -> int | None:
+    """
+    Parses a timestamp given either as epoch seconds (`1704067200`) or as an ISO 8601 date/datetime
+    (`2024-01-01`, `2024-01-01T12:00:00+02:00` - UTC unless the offset is given).
+
+    @param value: timestamp to parse, empty for none
+    @return: timestamp in seconds (as accepted by the MatchV5 API) or None
+    """
+    if value is None or not value.strip():
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
@@ -1,155 +1,344 @@
 from datetime import datetime
-from typing import Dict, List
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Dict, List
 import os
 import logging
 import json
 import asyncio
-import aiofiles
-from aiocsv import AsyncWriter
 
-from services.riot_api import MatchDto
+from services.riot_api import MatchDto, ExtractionPlan, UnsupportedMatchError, MatchSchema, \
+    SchemaRegistry, column_type, project_match_by_config
+from storage import MatchStore
+from utils.export_manifest import ExportManifest
+from utils.export_sinks import ExportSchema, SinkWriter, SINKS, create_export_sink
 import config
 
 logger = logging.getLogger(__name__)
 
+# Bump whenever the transformation changes the exported values - forces a full rebuild of incremental exports
+TRANSFORM_VERSION = 1
+
+# Compiled lazily once per (worker) process from `config.CSV_EXPORT_COLUMNS`
+_extraction_plan: ExtractionPlan | None = None
+# Schemas of the seen game versions, drift is reported by the main process (see `transform_match_batch`)
+_schema_registry: SchemaRegistry | None = None
+
+
+def _new_schema_registry(report_drift: bool = True) -> SchemaRegistry:
+    """ Registry seeded with the snapshots in the shape of the stored matches (projected, if they are). """
+    projection = project_match_by_config if config.projection['enabled'] else None
+    return SchemaRegistry(config.schemas['snapshots_dir'], report_drift=report_drift, projection=projection)
+
+
+def _get_extraction_plan() -> ExtractionPlan:
+    global _extraction_plan, _schema_registry
+    if _extraction_plan is None:
+        if config.schemas['enabled']:
+            _schema_registry = _new_schema_registry(report_drift=False)
+        _extraction_plan = ExtractionPlan(config.CSV_EXPORT_COLUMNS, registry=_schema_registry)
+    return _extraction_plan
+
+
+def transform_match_data(match_data: Dict) -> Dict | None:
+    """
+    Transforms the Riot match DTO into a flat export row (only `config.CSV_EXPORT_COLUMNS`),
+    None for unwanted matches. Pure function, so it can run in the worker processes.
+
+    Uses the compiled `ExtractionPlan` (computes only the requested columns), falls back to
+    the full transformation for matches the plan doesn't support.
+    """
+    if not config.exports['extraction_plan']:
+        return transform_match_data_full(match_data)
+    try:
+        return _get_extraction_plan().extract(match_data)
+    except UnsupportedMatchError as e:
+        logger.debug(f"[.] Falling back to the full transformation: {e}")
+        return transform_match_data_full(match_data)
+
+
+def transform_match_data_full(match_data: Dict) -> Dict | None:
+    """
+    Full transformation computing all the team metrics, then keeping only `config.CSV_EXPORT_COLUMNS`.
+    """
+    # TODO: refactor this mess
+
+    # Get base match dto
+    match_dto = MatchDto(match_data)
+
+    # Filter out unwanted PVE game modes
+    if match_dto.team_data is None:
+        return None
+
+    # Filter out unwanted PVP game modes
+    game_mode = match_dto.metadata.get('gameMode', '')
+    if game_mode != 'CLASSIC' and game_mode != 'ARAM':
+        return None
+
+    # Filter out games which took less than 5 minutes
+    if match_dto.metadata.get('gameDuration', 0) < 300:
+        return None
+
+    # Flattened object for export
+    match_dto_dict = {
+        **match_dto.metadata,
+        **match_dto.team_data,
+    }
+
+    # Compute extended headers
+    for participant in match_dto.participants:
+        for key, value in participant.items():
+            # won't filter bools
+            if not isinstance(value, (int, float, complex)):
+                continue
+
+            if participant['teamId'] == match_dto.friendly_team['teamId']:
+                dict_key = f"friendly_team_{key}"
+            else:
+                dict_key = f"enemy_team_{key}"
+
+            if match_dto_dict.get(dict_key, None) is None:
+                match_dto_dict[dict_key] = 0
+
+            if isinstance(value, bool):
+                match_dto_dict[dict_key] = bool(value if value else match_dto_dict[dict_key])
+            else:  # value is number
+                match_dto_dict[dict_key] += value
+
+    match_dto_dict['matchDate'] = datetime.fromtimestamp(match_dto_dict['gameCreation']/1000).strftime('%Y-%m-%d %H:%M:%S')
+    match_dto_dict['matchHour'] = datetime.fromtimestamp(match_dto_dict['gameCreation']/1000).strftime('%H')
+    match_dto_dict['win'] = match_dto.friendly_team['win']
+
+    # filter out unwanted columns
+    match_dto_dict = {k: v for k, v in match_dto_dict.items() if k in config.CSV_EXPORT_COLUMNS}
+
+    return match_dto_dict
+
+
+def transform_match_batch(raw_matches: List[bytes]) -> tuple[List[Dict | None], List[MatchSchema]]:
+    """
+    Decodes and transforms a batch of raw (JSON encoded) matches - runs in the worker processes,
+    results are in the order of the batch (unreadable matches are dropped), None for unwanted matches.
+    Also returns the schemas of game versions the process hasn't seen before.
+    """
+    matches = []
+    for raw_match in raw_matches:
+        try:
+            matches.append(json.loads(raw_match))
+        except json.JSONDecodeError as json_error:
+            logger.error(f"[!] Error decoding JSON of match: {json_error}")
+
+    rows = [transform_match_data(match_data) for match_data in matches]
+    return rows, _schema_registry.pop_learned() if _schema_registry is not None else []
+
 
 class ExportStatisticsWorker:
-    _instance = None
+    """
+    A single export of the match statistics into an export file (CSV, NDJSON or ARFF sink).
 
-    headers: List[str] | None = None
-    export_filename: str
+    Every instance keeps its own state (export file, schema, manifest file), so several
+    exports can run concurrently in one process.
 
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super(ExportStatisticsWorker, cls).__new__(cls)
-            cls._instance.__ensure_export_filename()
-        return cls._instance
-
-    async def __read_match_file(self, json_match_filepath: str) -> Dict:
-        if not json_match_filepath.endswith('.json'):
-            logger.warning(f"[!] The file {json_match_filepath} is not a JSON file, skipping")
-            return None
-
-        async with aiofiles.open(json_match_filepath, mode='r') as file:
-            try:
-                data = json.loads(await file.read())
-                return data
-            except json.JSONDecodeError as json_error:
-                logger.error(f"[!] Error decoding JSON from file {json_match_filepath}: {json_error}")
-                return None
-
-    def __ensure_export_filename(self):
+    `run_transform` puts the `ExportSchema` into the queue first (declared from the first
+    exported row, or from the manifest when appending), then batches of rows. `run_write`
+    writes them through the sink until it gets None.
+    """
+    export_format: str
+    export_filename: str
+    manifest_file: str
+    # columns (order and types) of the export file, None until the first row is transformed
+    schema: ExportSchema | None
+    # append rows to an existing export instead of creating a new one
+    append: bool
+
+    def __init__(
+        self,
+        export_format: str | None = None,
+        export_filename: str | None = None,
+        manifest_file: str | None = None,
+    ):
+        self.export_format = export_format or config.exports['format']
+        if self.export_format not in SINKS:
+            raise ValueError(f"Unsupported export format: {self.export_format}, expected one of {list(SINKS)}")
+        self.export_filename = export_filename or self.__new_export_filename()
+        self.manifest_file = manifest_file or config.exports['manifest_file']
+        self.schema = None
+        self.append = False
+        # game versions of the exported matches, learned by the worker processes
+        self.schema_registry = _new_schema_registry() if config.schemas['enabled'] else None
+
+    def __new_export_filename(self) -> str:
         csv_export_dir = config.exports['csv_export_dir']
         os.makedirs(csv_export_dir, exist_ok=True)
         timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        self.export_filename = os.path.abspath(f'{csv_export_dir}/csv_export_{timestamp}.csv')
-
-    def __transform_match_data(self, match_data) -> List[str | int] | None:
-        # TODO: refactor this mess
-
-        # Get base match dto
-        match_dto = MatchDto(match_data)
-
-        # Filter out unwanted PVE game modes
-        if match_dto.team_data is None:
-            return None
-
-        # Filter out unwanted PVP game modes
-        game_mode = match_dto.metadata.get('gameMode', '')
-        if game_mode != 'CLASSIC' and game_mode != 'ARAM':
-            return None
-
-        # Filter out games which took less than 5 minutes
-        if match_dto.metadata.get('gameDuration', 0) < 300:
-            return None
-
-        # Flattened object for export
-        match_dto_dict = {
-            **match_dto.metadata,
-            **match_dto.team_data,
-        }
-
-        # Compute extended headers
-        for participant in match_dto.participants:
-            for key, value in participant.items():
-                # won't filter bools
-                if not isinstance(value, (int, float, complex)):
-                    continue
-
-                if participant['teamId'] == match_dto.friendly_team['teamId']:
-                    dict_key = f"friendly_team_{key}"
-                else:
-                    dict_key = f"enemy_team_{key}"
-
-                if match_dto_dict.get(dict_key, None) is None:
-                    match_dto_dict[dict_key] = 0
-
-                if isinstance(value, bool):
-                    match_dto_dict[dict_key] = bool(value if value else match_dto_dict[dict_key])
-                else:  # value is number
-                    match_dto_dict[dict_key] += value
-
-        match_dto_dict['matchDate'] = datetime.fromtimestamp(match_dto_dict['gameCreation']/1000).strftime('%Y-%m-%d %H:%M:%S')
-        match_dto_dict['matchHour'] = datetime.fromtimestamp(match_dto_dict['gameCreation']/1000).strftime('%H')
-        match_dto_dict['win'] = match_dto.friendly_team['win']
-
-        # filter out unwanted columns
-        match_dto_dict = {k: v for k, v in match_dto_dict.items() if k in config.CSV_EXPORT_COLUMNS}
-
-        if ExportStatisticsWorker.headers is None:
-            ExportStatisticsWorker.headers = list(match_dto_dict.keys())
-
-        return [match_dto_dict.get(key, '') for key in ExportStatisticsWorker.headers]
-
-    async def run_read(self, filepaths_queue: asyncio.Queue[str], match_data_queue: asyncio.Queue):
+        return os.path.abspath(f'{csv_export_dir}/{self.export_format}_export_{timestamp}.{self.export_format}')
+
+    def plan_export(self, match_store: MatchStore, match_ids: List[str]) -> tuple[List[str], ExportManifest]:
+        """
+        Decides which matches have to be exported. In incremental mode (`config.exports['incremental']`)
+        only matches missing in the manifest of the previous export are exported and appended to it.
+        A full rebuild happens when the columns, the format, the roster or the transform version change, or when
+        an already exported match has changed (match data is immutable, so rows are never patched in place).
+        """
+        fingerprints = {match_id: match_store.fingerprint(match_id) for match_id in match_ids}
+        manifest = ExportManifest.load(self.manifest_file) if config.exports['incremental'] else None
+
+        if manifest is not None and manifest.is_compatible(TRANSFORM_VERSION, config.CSV_EXPORT_COLUMNS, self.export_format, config.PUUIDS):
+            changed_matches = [
+                match_id for match_id, fingerprint in manifest.matches.items()
+                if match_id in fingerprints and fingerprints[match_id] != fingerprint
+            ]
+            if not changed_matches:
+                new_matches = [match_id for match_id in match_ids if match_id not in manifest.matches]
+                logger.info(f"[*] Incremental export - appending {len(new_matches)} new matches to {manifest.export_filename}")
+                self.export_filename = manifest.export_filename
+                self.append = True
+                # csv manifests of older exports don't have the column types
+                self.schema = ExportSchema(manifest.headers, manifest.column_types or ['numeric'] * len(manifest.headers))
+                manifest.matches.update({match_id: fingerprints[match_id] for match_id in new_matches})
+                return new_matches, manifest
+            logger.info(f"[*] {len(changed_matches)} exported matches have changed, full rebuild of the export")
+        elif manifest is not None:
+            logger.info("[*] Exported columns, format, roster or transform version have changed, full rebuild of the export")
+
+        return match_ids, self.new_manifest(fingerprints)
+
+    def new_manifest(self, fingerprints: Dict[str, str | None]) -> ExportManifest:
+        """ Manifest of a new (full) export of the matches with the given fingerprints. """
+        return ExportManifest(
+            transform_version=TRANSFORM_VERSION,
+            columns=list(config.CSV_EXPORT_COLUMNS),
+            export_filename=self.export_filename,
+            matches=fingerprints,
+            export_format=self.export_format,
+            roster=sorted(config.PUUIDS),
+        )
+
+    def save_manifest(self, manifest: ExportManifest):
+        """ Saves the manifest once the export finished. """
+        if self.schema is not None:
+            manifest.headers = self.schema.columns
+            manifest.column_types = self.schema.types
+        manifest.save(self.manifest_file)
+        logger.info(f"[*] Export manifest saved to {self.manifest_file}")
+
+    async def __read_batch(self, match_store: MatchStore, match_ids: List[str]) -> List[bytes]:
+        raw_matches = []
+        for match_id in match_ids:
+            content = await match_store.get(match_id)
+            if content is None:
+                logger.warning(f"[!] The match {match_id} is missing in the match store, skipping")
+                continue
+            raw_matches.append(content)
+        return raw_matches
+
+    async def run_transform(
+        self,
+        match_id_batches: AsyncIterator[List[str]],
+        match_data_queue: asyncio.Queue,
+        match_store: MatchStore,
+        processes: int | None = None,
+    ):
+        """
+        Reads the batches of matches and sends them to a pool of worker processes, which decode
+        and transform them (CPU bound work). Batches of rows are put into the `match_data_queue`
+        in the order of `match_id_batches`, so the export is deterministic.
+
+        The batches may be streamed (e.g. from the downloads in the pipeline mode) - the rows of every
+        transformed batch are put into the queue right away.
+        """
+        processes = processes or config.exports['processes']
+        loop = asyncio.get_running_loop()
+        pending_batches: deque[asyncio.Future] = deque()
+
+        # appended export has its schema declared already
+        if self.schema is not None:
+            await match_data_queue.put(self.schema)
+
+        async def put_oldest_batch():
+            rows, schemas = await pending_batches.popleft()
+            # reports drift of the new game versions once (every process learns them on its own)
+            for schema in schemas:
+                if self.schema_registry is not None:
+                    self.schema_registry.register(schema)
+            # Unwanted match data are None
+            match_dto_dicts = [match_dto_dict for match_dto_dict in rows if match_dto_dict]
+            if not match_dto_dicts:
+                return
+            # the first exported row determines the columns order
+            if self.schema is None:
+                columns = list(match_dto_dicts[0].keys())
+                self.schema = ExportSchema(columns, [column_type(column, match_dto_dicts[0][column]) for column in columns])
+                await match_data_queue.put(self.schema)
+            columns = self.schema.columns
+            await match_data_queue.put([
+                [match_dto_dict.get(column) for column in columns] for match_dto_dict in match_dto_dicts
+            ])
+
+        pool = ProcessPoolExecutor(max_workers=processes)
         try:
-            while not filepaths_queue.empty():
-                json_match_filepath = await filepaths_queue.get()
-                raw_match_data = await self.__read_match_file(json_match_filepath)
-
-                # Unreadable match data
-                if raw_match_data is None:
-                    filepaths_queue.task_done()
-                    continue
-
-                match_data = self.__transform_match_data(raw_match_data)
-
-                # Unwanted match data
-                if (match_data is None):
-                    continue
-
-                await match_data_queue.put(match_data)
-
-                filepaths_queue.task_done()
-
-            logger.info("[*] Worker finished reading match files")
+            logger.info(f"[*] Transforming matches with {processes} processes")
+            transformed = 0
+            async for match_ids in match_id_batches:
+                raw_matches = await self.__read_batch(match_store, match_ids)
+                pending_batches.append(loop.run_in_executor(pool, transform_match_batch, raw_matches))
+                transformed += len(raw_matches)
+                # keep every process busy, but don't read the whole store into memory - the finished
+                # batches are put right away, as the streamed batches may come slowly
+                while pending_batches and (pending_batches[0].done() or len(pending_batches) >= 2 * processes):
+                    await put_oldest_batch()
+            while pending_batches:
+                await put_oldest_batch()
+
+            logger.info(f"[*] Finished transforming {transformed} match files")
+            if self.schema_registry is not None:
+                logger.info(
+                    f"[*] Known game versions: {', '.join(self.schema_registry.versions()) or '-'}, "
+                    f"schema drifts: {len(self.schema_registry.drifts)}"
+                )
 
         except Exception as e:
             logger.exception(f"[!] An error occurred while reading match statistics: {e}")
             raise
+        finally:
+            # don't block the event loop, unfinished batches are not needed anymore
+            pool.shutdown(wait=False, cancel_futures=True)
 
     async def run_write(self, match_data_queue: asyncio.Queue):
+        """
+        Writes the schema and the batches of rows from the `match_data_queue` into the export
+        file, until None is received. Rows are written on a dedicated writer thread.
+        """
+        schema = await match_data_queue.get()
+        if schema is None:
+            logger.warning("[!] There are no matches to export")
+            return
+
+        sink = create_export_sink(
+            self.export_format,
+            self.export_filename,
+            append=self.append,
+            buffer_size=config.exports['write_buffer_size'],
+            **({'sparse': config.exports['sparse_arff']} if self.export_format == 'arff' else {}),
+        )
+        writer = SinkWriter(sink)
         try:
-            async with aiofiles.open(self.export_filename, 'w') as f:
-                writer = AsyncWriter(f)
-
-                while ExportStatisticsWorker.headers is None:
-                    logger.debug("[>] Waiting for headers to be set")
-                    await asyncio.sleep(0.5)
-
-                await writer.writerow(ExportStatisticsWorker.headers)
-
-                while True:
-                    data = await match_data_queue.get()
-                    if data is None:
-                        logger.info("[*] Export to csv finished!")
-                        break
+            await writer.open(schema)
+            exported = 0
+            while True:
+                rows = await match_data_queue.get()
+                if rows is None:
+                    logger.info(f"[*] Export to {self.export_format} finished!")
+                    break
 
-                    await writer.writerow(data)
-                    match_data_queue.task_done()
+                await writer.write(rows)
+                exported += len(rows)
+                match_data_queue.task_done()
 
-            logger.info(f"[*] Exported matches statistics to {self.export_filename}")
+            logger.info(f"[*] Exported statistics of {exported} matches to {self.export_filename}")
 
         except Exception as e:
             logger.exception(f"[!] An error occurred while exporting match statistics: {e}")
             raise
+        finally:
+            await writer.close()
@@ -1,63 +1,188 @@
 import asyncio
 import logging
-import psycopg
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List
 
+import config
 from db.repository.matches_repository import MatchesRepository
+from db.executor import Executor
 from services.riot_api import RiotApiService
-from utils.timestamps import get_next_timestamp
+from utils.timestamps import get_next_timestamp, parse_timestamp
 from errors import MatchDataNotFoundException
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class CrawlFilter:
+    """
+    Match id filter pushed down into the MatchV5 query (`queue`, `type`, `startTime`/`endTime`),
+    so the unwanted matches are never crawled, nor downloaded. Empty lists / None don't filter.
+    """
+    queues: List[int] = field(default_factory=list)
+    types: List[str] = field(default_factory=list)
+    # epoch seconds
+    start_time: int | None = None
+    end_time: int | None = None
+
+    @staticmethod
+    def from_config() -> 'CrawlFilter':
+        return CrawlFilter(
+            queues=config.crawl_filter['queues'],
+            types=config.crawl_filter['types'],
+            start_time=parse_timestamp(config.crawl_filter['start_time']),
+            end_time=parse_timestamp(config.crawl_filter['end_time']),
+        )
+
+    def queries(self) -> List[Dict]:
+        """ The API takes one queue and one type per request - a query per combination of them. """
+        return [
+            {'queue': queue, 'type': match_type}
+            for queue in self.queues or [None]
+            for match_type in self.types or [None]
+        ]
+
+    def __str__(self):
+        return f"queues {self.queues or 'all'}, types {self.types or 'all'}, time range {self.start_time} - {self.end_time}"
+
+
 class FetchMatchesWorker:
+    """
+    Crawls match ids of one player (`puuid`). Several workers (one per player of the roster)
+    can share one queue and one riot api service (and so one rate limiter).
+    """
 
     riot_api_service: RiotApiService
-    cur: psycopg.cursor
+    exec: Executor
+    puuid: str
     matches_repository: MatchesRepository = MatchesRepository()  # TODO: do this via Dependency Injection
 
-    def __init__(self, cur, riot_api_service: RiotApiService):
-        self.cur = cur
+    def __init__(self, exec: Executor, riot_api_service: RiotApiService, puuid: str, crawl_filter: CrawlFilter | None = None):
+        self.exec = exec
         self.riot_api_service = riot_api_service
+        self.puuid = puuid
+        self.crawl_filter = crawl_filter or CrawlFilter.from_config()
+        # seconds until the unavailable matches are requested again, None for never
+        self.recheck_after = config.unavailable_matches['recheck_after_days'] * 24 * 3600 or None
 
-    async def __resumed_timestamp(self) -> int | None:
-        """ 
-        Get the next timestamp (in seconds) based on the last match we have 
-        in the database from which we want to resume fetching matches.
+    async def __resumed_position(self, query: Dict, single_query: bool, end_time: int) -> tuple[int, int] | None:
+        """
+        Get the position (end time in seconds and the offset of the next page) from which we want to resume
+        fetching the matches of the query. The crawl cursor of the query keeps the position of the crawl,
+        so it is resumed without any request, unless the crawl end time has changed meanwhile. Then (and for
+        the cursors saved before the positions existed) the crawl resumes from the end of the oldest crawled
+        match - players crawled before the crawl cursors existed resume a single query from their oldest match
+        in the database.
         """
-        oldest_match_id = await self.matches_repository.get_oldest_match(cur=self.cur)
-        if oldest_match_id:
-            oldest_match_end_timestamp_ms = await self.riot_api_service.get_match_end_timestamp(match_id=oldest_match_id)
-            logger.info(f"[>] Resuming from match: {oldest_match_id}, gameEndTimestamp: {oldest_match_end_timestamp_ms}")
-            return get_next_timestamp(oldest_match_end_timestamp_ms)
+        async with self.exec.connection() as conn:
+            cursor = await self.matches_repository.get_crawl_cursor(conn, self.puuid, query['queue'], query['type'])
+            oldest_match_id = cursor.oldest_match_id if cursor is not None else None
+            if oldest_match_id is None and single_query:
+                oldest_match_id = await self.matches_repository.get_oldest_match(conn, puuid=self.puuid)
+        if cursor is not None and cursor.end_time is not None and cursor.end_time <= end_time:
+            logger.info(f"[>] Resuming {self.__describe(query)} from match: {oldest_match_id}, "
+                        f"{cursor.crawled} matches ended before {cursor.end_time} crawled")
+            return cursor.end_time, cursor.crawled
+        while oldest_match_id:
+            try:
+                oldest_match_end_timestamp_ms = await self.riot_api_service.get_match_end_timestamp(match_id=oldest_match_id)
+            except MatchDataNotFoundException as e:
+                # expired on the Riot side - tombstoned, the next newer match of the player is tried instead
+                # (a part of the query is crawled again, but no match is missed)
+                async with self.exec.connection() as conn:
+                    await self.matches_repository.mark_unavailable(conn, match_id=oldest_match_id, reason=str(e), recheck_after=self.recheck_after)
+                    unavailable_match_id = oldest_match_id
+                    oldest_match_id = await self.matches_repository.get_oldest_match(conn, puuid=self.puuid, newer_than=unavailable_match_id)
+                logger.warning(f"[!] Match {unavailable_match_id} is unavailable ({e}), resuming from the next newer one")
+                continue
+            logger.info(f"[>] Resuming {self.__describe(query)} from match: {oldest_match_id}, gameEndTimestamp: {oldest_match_end_timestamp_ms}")
+            return min(get_next_timestamp(oldest_match_end_timestamp_ms), end_time), 0
         return None
 
-    async def run(self, queue: asyncio.Queue, should_resume: bool = False):
-        try:
-            end_time = await self.__resumed_timestamp() if should_resume else None
+    def __describe(self, query: Dict) -> str:
+        return f"matches of {self.puuid} (queue {query['queue'] or 'all'}, type {query['type'] or 'all'})"
 
+    async def __fetch_pages(self, end_time: int, start_time: int | None = None, queue: int | None = None,
+                            match_type: str | None = None, start: int = 0) -> AsyncIterator[List[str]]:
+        """
+        Yields pages of match ids (from the newest to the oldest) using `start`/`count` offsets (from `start` on),
+        only of the matches of the given queue and type (if any) started since `start_time`.
+
+        `end_time` is fixed for the whole crawl, so the offsets stay stable even when new matches
+        are played meanwhile. Next pages don't depend on the previous ones, so `prefetch_pages`
+        of them are requested ahead while the earlier ones are being stored.
+        """
+        page_size = config.fetch_matches['page_size']
+        prefetch_pages = max(1, config.fetch_matches['prefetch_pages'])
+
+        pending_pages: deque[asyncio.Task] = deque()
+        next_start = start
+        try:
             while True:
-                # Fetch 100 matches at a time
-                fetched_matches = await self.riot_api_service.get_matches(start=0, count=100, endTime=end_time)
-                logger.info(f"[+] Fetched {len(fetched_matches)} matches: {fetched_matches}")
-
-                # If we didn't fetch any matches, we're done
-                if len(fetched_matches) == 0:
-                    logger.info("[*] No more matches to fetch")
-                    await queue.put(None)
+                while len(pending_pages) < prefetch_pages:
+                    pending_pages.append(asyncio.create_task(
+                        self.riot_api_service.get_matches(
+                            puuid=self.puuid, start=next_start, count=page_size, startTime=start_time, endTime=end_time,
+                            queue=queue, type=match_type,
+                        ),
+                        name=f"FetchMatchesWorker-Page-{next_start}",
+                    ))
+                    next_start += page_size
+
+                fetched_matches = await pending_pages.popleft()
+                last_page = len(fetched_matches) < page_size
+                if last_page:
+                    # Last (partial) page - the prefetched pages are past the end, cancel them before they
+                    # use the rate budget (the consumer may take a while to take this page)
+                    for page in pending_pages:
+                        page.cancel()
+                    pending_pages.clear()
+                if fetched_matches:
+                    yield fetched_matches
+                if last_page:
                     return
+        finally:
+            for page in pending_pages:
+                page.cancel()
+
+    async def run(self, queue: asyncio.Queue, should_resume: bool = False):
+        """
+        Puts `(puuid, match_ids, query)` pages into the `queue` - `query` is the crawl filter query
+        (queue and type) of the page. The end of the queue (`None`) is signalled by the caller once
+        all the players are crawled.
+
+        Resumed crawls continue every query from the position of its own crawl cursor (see `StoreMatchesWorker`).
+        """
+        try:
+            now = int(time.time())
+            crawl_filter = self.crawl_filter
+            queries = crawl_filter.queries()
+            logger.info(f"[>] Fetching matches of {self.puuid} ({crawl_filter})")
+
+            for query in queries:
+                end_time = now if crawl_filter.end_time is None else min(now, crawl_filter.end_time)
+                start = 0
+                if should_resume:
+                    position = await self.__resumed_position(query, single_query=len(queries) == 1, end_time=end_time)
+                    if position is not None:
+                        end_time, start = position
+                if crawl_filter.start_time is not None and end_time <= crawl_filter.start_time:
+                    logger.info(f"[*] No {self.__describe(query)} left to fetch in the crawl time range ({crawl_filter})")
+                    continue
 
-                await queue.put(fetched_matches)
+                crawled = start
+                async for fetched_matches in self.__fetch_pages(end_time, crawl_filter.start_time, query['queue'], query['type'], start):
+                    logger.info(f"[+] Fetched {len(fetched_matches)} matches of {self.puuid}: {fetched_matches}")
+                    crawled += len(fetched_matches)
+                    # position of the page for its crawl cursor
+                    await queue.put((self.puuid, fetched_matches, {**query, 'end_time': end_time, 'crawled': crawled}))
 
-                # Get the last fetched match (oldest one) and its game end timestamp to refetch older matches from there
-                last_match = fetched_matches[-1]
-                game_end_timestamp_ms = await self.riot_api_service.get_match_end_timestamp(last_match)
-                end_time = get_next_timestamp(game_end_timestamp_ms)
-                logger.info(f"[>] Continuing from => match: {last_match}, gameEndTimestamp: {game_end_timestamp_ms} ({end_time})")
+            logger.info(f"[*] No more matches to fetch for {self.puuid}")
 
         except MatchDataNotFoundException:
-            logger.error("[!] Worker failed to fetch match and will terminate now")
-            await queue.put(None)
+            logger.error(f"[!] Worker failed to fetch the matches of {self.puuid} (player not found) and will terminate now")
             raise
         except Exception as e:
             logger.exception(f"[!] An error occurred while fetching matches: {e}")
@@ -1,44 +1,345 @@
+from typing import AsyncIterator
 from tqdm import tqdm
+import asyncio
 import json
 import os
 import logging
-import psycopg
-import aiofiles
+import socket
+import uuid
 
 from db.repository.matches_repository import MatchesRepository
-from services.riot_api import RiotApiService
+from db.executor import Executor
+from errors import MatchDataNotFoundException, RiotApiException
+from services.riot_api import RiotApiService, region_of_match, platforms_of_region, project_match_by_config
+from storage import MatchStore, DirectoryMatchStore
 import config
 
 logger = logging.getLogger(__name__)
 
 
 class FetchStatisticsWorker:
-    cur: psycopg.cursor
+    exec: Executor
     matches_repository: MatchesRepository = MatchesRepository()  # TODO: do this via Dependency Injection
     riot_api_service: RiotApiService
+    match_store: MatchStore
 
-    def __init__(self, cur, riot_api_service):
-        self.cur = cur
+    def __init__(self, exec: Executor, riot_api_service, match_store: MatchStore, queue: bool | None = None):
+        self.exec = exec
         self.riot_api_service = riot_api_service
+        self.match_store = match_store
+        self.queue = config.fetch_statistics['queue'] if queue is None else queue
+        self.lease_seconds = config.fetch_statistics['lease_seconds']
+        self.max_attempts = config.fetch_statistics['max_attempts']
+        # seconds until the unavailable matches are requested again, None for never
+        self.recheck_after = config.unavailable_matches['recheck_after_days'] * 24 * 3600 or None
+        # owner of the claimed matches, unique across the processes and machines
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.raw_match_store = None
+        if config.projection['enabled'] and config.projection['keep_raw']:
+            self.raw_match_store = DirectoryMatchStore(config.projection['raw_dir'])
 
-    async def run(self, last_match_id=None):
+    async def __download_match(self, match_id: str, in_flight: asyncio.Semaphore):
+        projection = config.projection['enabled']
+        # match files can be streamed straight to the disk, unless they are projected (the archive compresses records itself)
+        if config.fetch_statistics['streaming'] and not projection and isinstance(self.match_store, DirectoryMatchStore):
+            compress = config.fetch_statistics['compress']
+            filepath = self.match_store.filepath(match_id, compress)
+            async with in_flight:
+                extracted = await self.riot_api_service.download_match_statistics(match_id=match_id, filepath=filepath, compress=compress)
+            logger.info(f"[+] Match {match_id} statistics streamed to file {os.path.abspath(filepath)} ({extracted})")
+            return
+
+        async with in_flight:
+            statistics = await self.riot_api_service.get_match_statistics(match_id=match_id)
+        if projection:
+            if self.raw_match_store is not None:
+                await self.raw_match_store.put(match_id, json.dumps(statistics, ensure_ascii=False).encode('utf-8'))
+            statistics = project_match_by_config(statistics)
+        await self.match_store.put(match_id, json.dumps(statistics, ensure_ascii=False).encode('utf-8'))
+        logger.info(f"[+] Match {match_id} statistics stored")
+
+    @staticmethod
+    def __platforms(region: str) -> dict:
+        """ Platforms filter of the region's match ids - the default region takes the unknown platforms as well. """
+        known_platforms = list(config.PLATFORM_REGIONS) if region == config.endpoints['default_region'] else None
+        return dict(platforms=platforms_of_region(region), known_platforms=known_platforms)
+
+    async def __stream_match_ids(self, last_match_id: str | None, batch_size: int, region: str) -> AsyncIterator[list[str]]:
+        """ Yields batches of the region's match ids older than `last_match_id` (newest first), a unit of work per batch. """
+        older_than = last_match_id
+        while True:
+            async with self.exec.connection() as conn:
+                match_ids = await self.matches_repository.get_matches_page(
+                    conn, older_than=older_than, limit=batch_size, **self.__platforms(region),
+                )
+            if match_ids:
+                yield match_ids
+            if len(match_ids) < batch_size:
+                return
+            older_than = match_ids[-1]
+
+    async def __claim_match_ids(self, last_match_id: str | None, batch_size: int, region: str) -> AsyncIterator[list[str]]:
+        """ Yields batches of the region's match ids claimed from the download queue, until there is nothing left to claim. """
+        while True:
+            async with self.exec.connection() as conn:
+                match_ids = await self.matches_repository.claim_downloads(
+                    conn, worker_id=self.worker_id, limit=batch_size, lease_seconds=self.lease_seconds,
+                    max_attempts=self.max_attempts, older_than=last_match_id, **self.__platforms(region),
+                )
+            if not match_ids:
+                return
+            yield match_ids
+
+    async def __claim_forwarded(self, match_id_batches: AsyncIterator[list[str]]) -> AsyncIterator[list[str]]:
+        """
+        Claims the batches of match ids coming from the previous pipeline stage - the matches downloaded, claimed
+        by other workers or unavailable already are dropped.
+        """
+        async for match_ids in match_id_batches:
+            async with self.exec.connection() as conn:
+                claimed = await self.matches_repository.claim_downloads(
+                    conn, worker_id=self.worker_id, limit=len(match_ids), lease_seconds=self.lease_seconds,
+                    max_attempts=self.max_attempts, match_ids=match_ids,
+                )
+            if len(claimed) < len(match_ids):
+                logger.info(f"[.] Skipping {len(match_ids) - len(claimed)} matches downloaded, claimed elsewhere or unavailable")
+            if claimed:
+                yield claimed
+
+    async def __renew_leases(self):
+        """ Heartbeat keeping the claimed matches leased while the worker runs - leases of a crashed worker just expire. """
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                async with self.exec.connection() as conn:
+                    renewed = await self.matches_repository.renew_leases(conn, worker_id=self.worker_id, lease_seconds=self.lease_seconds)
+                logger.debug(f"[.] Renewed {renewed} match leases of {self.worker_id}")
+            except Exception as e:
+                logger.warning(f"[!] Unable to renew the match leases of {self.worker_id}: {e}")
+
+    async def __release_leases(self):
+        """ Returns the claimed, but not downloaded matches to the queue. """
         try:
-            match_files_dir = config.exports['match_files_dir']
-            os.makedirs(match_files_dir, exist_ok=True)
+            async with self.exec.connection() as conn:
+                released = await self.matches_repository.release_downloads(conn, worker_id=self.worker_id)
+            if released:
+                logger.info(f"[-] Released {released} claimed matches of {self.worker_id}")
+        except Exception as e:
+            logger.warning(f"[!] Unable to release the claimed matches of {self.worker_id}, their leases will expire: {e}")
+
+    async def __enqueue_matches(self, match_id_batches: AsyncIterator[list[str]], match_ids_queue: asyncio.Queue, region: str, workers: int):
+        """ Streams the region's match ids into its (bounded) queue, then tells the region's workers to stop. """
+        queued = 0
+        async for match_ids in match_id_batches:
+            for match_id in match_ids:
+                await match_ids_queue.put(match_id)
+            queued += len(match_ids)
+            logger.debug(f"[.] Queued {len(match_ids)} more matches of {region} (down to {match_ids[-1]})")
+        logger.info(f"[+] All {queued} matches of {region} queued")
+        for _ in range(workers):
+            await match_ids_queue.put(None)
+
+    async def __dispatch_matches(self, match_id_batches: AsyncIterator[list[str]], match_ids_queues: dict[str, asyncio.Queue],
+                                 workers: int, batch_size: int, backlogs: dict[str, AsyncIterator[list[str]]] | None = None):
+        """
+        Distributes the match ids of a single stream (the previous pipeline stage) into the queues of their regions.
+        The ids wait in an overflow of their region, moved into the (bounded) region queue by a feeder of the region,
+        so a full queue of one region never holds back the others. The next batch is taken once the overflows
+        are down to a batch of ids per region.
+
+        Once the stream ends, the feeders queue the `backlogs` of their regions (if any) as well.
+        """
+        overflows = {region: asyncio.Queue() for region in match_ids_queues}
+        moved = asyncio.Condition()
+
+        async def feed(region: str):
+            overflow, match_ids_queue = overflows[region], match_ids_queues[region]
+            while (match_id := await overflow.get()) is not None:
+                await match_ids_queue.put(match_id)
+                async with moved:
+                    moved.notify_all()
+            if backlogs is not None:
+                await self.__enqueue_matches(backlogs[region], match_ids_queue, region, workers=0)
+            for _ in range(workers):
+                await match_ids_queue.put(None)
 
-            all_matches = await self.matches_repository.get_matches_older_than(cur=self.cur, match_id=last_match_id)
-            logger.info(f"[+] Began processing {len(all_matches)} matches: {all_matches}")
-            all_matches = tqdm(all_matches)
+        async def dispatch():
+            queued = 0
+            async for match_ids in match_id_batches:
+                for match_id in match_ids:
+                    overflows[region_of_match(match_id)].put_nowait(match_id)
+                queued += len(match_ids)
+                async with moved:
+                    await moved.wait_for(lambda: sum(overflow.qsize() for overflow in overflows.values()) <= batch_size * len(overflows))
+            logger.info(f"[+] All {queued} matches of the previous stage queued")
+            for overflow in overflows.values():
+                overflow.put_nowait(None)
 
-            for match_id in all_matches:
+        await asyncio.gather(dispatch(), *(feed(region) for region in overflows))
+
+    async def __process_match(self, match_id: str, in_flight: asyncio.Semaphore, skip_stored: bool) -> bool:
+        """
+        Downloads the statistics of the match, returns False when the match is unavailable. In the queue mode
+        a failed download is recorded for a retry and False is returned, only the fatal errors are raised.
+        """
+        try:
+            # stored by a previous run, which didn't get to record it (or before the download queue existed)
+            if skip_stored and self.match_store.contains(match_id):
+                logger.info(f"[.] Match {match_id} statistics already stored")
+            elif not self.queue:
+                await self.__download_match(match_id, in_flight)
+            else:
+                try:
+                    await self.__download_match(match_id, in_flight)
+                except MatchDataNotFoundException:
+                    raise
+                except Exception as e:
+                    # a rejected API key fails all the downloads, the rest is retried by a later run
+                    if isinstance(e, RiotApiException) and e.fatal:
+                        raise
+                    await self.__fail_download(match_id, e)
+                    return False
+            if self.queue:
+                async with self.exec.connection() as conn:
+                    await self.matches_repository.complete_download(conn, match_id=match_id)
+            return True
+        except MatchDataNotFoundException as e:
+            # expired on the Riot side - tombstoned, so it costs no more requests
+            async with self.exec.connection() as conn:
+                await self.matches_repository.mark_unavailable(conn, match_id=match_id, reason=str(e), recheck_after=self.recheck_after)
+            logger.warning(f"[!] Match {match_id} is unavailable ({e}), skipping it")
+            return False
+
+    async def __fail_download(self, match_id: str, error: Exception):
+        """ Records the failed download, the match is claimed again by a later run (until it reaches the max attempts). """
+        async with self.exec.connection() as conn:
+            await self.matches_repository.fail_download(conn, match_id=match_id, error=repr(error), max_attempts=self.max_attempts)
+        logger.error(f"[!] Download of match {match_id} failed ({error!r}), it is retried later")
+
+    async def __skip_unavailable(self, match_id_batches: AsyncIterator[list[str]]) -> AsyncIterator[list[str]]:
+        """ Drops the tombstoned matches from the batches of match ids coming from the previous pipeline stage. """
+        async for match_ids in match_id_batches:
+            async with self.exec.connection() as conn:
+                unavailable = await self.matches_repository.get_unavailable(conn, match_ids=match_ids)
+            if unavailable:
+                logger.info(f"[.] Skipping {len(unavailable)} unavailable matches")
+            available = [match_id for match_id in match_ids if match_id not in unavailable]
+            if available:
+                yield available
+
+    async def __run_download(self, match_ids_queue: asyncio.Queue, in_flight: asyncio.Semaphore, progress: tqdm,
+                             skip_stored: bool, downloaded_queue: asyncio.Queue | None):
+        """ Pulls match ids from the shared queue until `None` is received. """
+        while True:
+            match_id = await match_ids_queue.get()
+            try:
+                if match_id is None:
+                    return
                 logger.info(f"[>] Processing match: {match_id}")
-                all_matches.set_description("[>] Processing match: %s" % match_id)
-                statistics = await self.riot_api_service.get_match_statistics(match_id=match_id)
-                # TODO: implement streaming, will require changes in riot api service
-                async with aiofiles.open(f"{match_files_dir}/{match_id}.json", 'x', encoding='utf-8') as f:
-                    json_string = json.dumps(statistics, ensure_ascii=False, indent=4)
-                    await f.write(json_string)
-                    logger.info(f"[+] Match {match_id} statistics dumped to file {os.path.abspath(f.name)}")
+                stored = await self.__process_match(match_id, in_flight, skip_stored)
+                progress.set_description("[>] Processed match: %s" % match_id)
+                progress.update()
+                if stored and downloaded_queue is not None:
+                    await downloaded_queue.put(match_id)
+            finally:
+                match_ids_queue.task_done()
+
+    async def run(
+        self,
+        last_match_id=None,
+        workers: int | None = None,
+        max_in_flight: int | None = None,
+        batch_size: int | None = None,
+        match_id_batches: AsyncIterator[list[str]] | None = None,
+        downloaded_queue: asyncio.Queue | None = None,
+    ):
+        """
+        Downloads statistics of all the matches older than `last_match_id`. Every routing region
+        gets its own pool of `workers` coroutines (sharing the rate limiter of that region),
+        so all the regions are downloaded concurrently.
+
+        The match ids of every region are streamed from the database in batches of `batch_size` - the downloads
+        start with the first batch and at most a batch of ids per region waits in the memory. In the queue mode
+        the batches are claimed from the download queue, so only the matches not downloaded yet
+        (and not claimed by other workers) are processed.
+
+        In the pipeline mode the batches of match ids come from the previous stage (`match_id_batches`),
+        already stored matches are not downloaded again and the ids of the stored matches are put into
+        the `downloaded_queue` - the end of the queue is signalled by the caller. In the queue mode the
+        forwarded matches are claimed as well and once the previous stage ends, the matches left in the
+        download queue by the previous runs are claimed and downloaded too.
+        """
+        workers = workers or config.fetch_statistics['workers']
+        max_in_flight = max_in_flight or config.fetch_statistics['max_in_flight']
+        batch_size = batch_size or config.fetch_statistics['id_batch_size']
+        skip_stored = self.queue or match_id_batches is not None
+        tasks = []
+        heartbeat = None
+        # pools of all the regions are started up front, the idle ones just wait for the end of the stream
+        regions = sorted(set(config.PLATFORM_REGIONS.values()) | {config.endpoints['default_region']})
+        backlogs = None
+        try:
+            if match_id_batches is not None:
+                # the number of the matches is not known up front
+                total = None
+                logger.info(f"[+] Began processing the matches of the previous stage with {workers} workers per region")
+                if self.queue:
+                    match_id_batches = self.__claim_forwarded(match_id_batches)
+                    backlogs = {region: self.__claim_match_ids(last_match_id, batch_size, region) for region in regions}
+                    heartbeat = asyncio.create_task(self.__renew_leases(), name="FetchStatisticsWorker-Heartbeat")
+                else:
+                    match_id_batches = self.__skip_unavailable(match_id_batches)
+            else:
+                async with self.exec.connection() as conn:
+                    if self.queue and self.recheck_after:
+                        rechecked = await self.matches_repository.requeue_unavailable(conn)
+                        if rechecked:
+                            logger.info(f"[+] {rechecked} unavailable matches are due for a recheck")
+                    if self.queue:
+                        total = await self.matches_repository.count_pending_downloads(conn, older_than=last_match_id, max_attempts=self.max_attempts)
+                    else:
+                        total = await self.matches_repository.count_matches_older_than(conn, match_id=last_match_id)
+                if self.queue:
+                    logger.info(f"[+] Began processing {total} queued matches as {self.worker_id} with {workers} workers per region")
+                    heartbeat = asyncio.create_task(self.__renew_leases(), name="FetchStatisticsWorker-Heartbeat")
+                else:
+                    logger.info(f"[+] Began processing {total} matches with {workers} workers per region")
+
+            match_ids_queues = {region: asyncio.Queue(batch_size) for region in regions}
+
+            with tqdm(total=total) as progress:
+                if match_id_batches is not None:
+                    tasks.append(asyncio.create_task(
+                        self.__dispatch_matches(match_id_batches, match_ids_queues, workers, batch_size, backlogs),
+                        name="FetchStatisticsWorker-Dispatch",
+                    ))
+                else:
+                    # every region pages (claims) its own match ids, so the regions are downloaded concurrently
+                    for region, match_ids_queue in match_ids_queues.items():
+                        region_match_id_batches = self.__claim_match_ids(last_match_id, batch_size, region) if self.queue \
+                            else self.__stream_match_ids(last_match_id, batch_size, region)
+                        tasks.append(asyncio.create_task(
+                            self.__enqueue_matches(region_match_id_batches, match_ids_queue, region, workers),
+                            name=f"FetchStatisticsWorker-Enqueue-{region}",
+                        ))
+                for region, match_ids_queue in match_ids_queues.items():
+                    in_flight = asyncio.Semaphore(max_in_flight)
+                    for idx in range(workers):
+                        tasks.append(asyncio.create_task(
+                            self.__run_download(match_ids_queue, in_flight, progress, skip_stored, downloaded_queue),
+                            name=f"FetchStatisticsWorker-Download-{region}-{idx}",
+                        ))
+                # first failure stops the whole pool
+                await asyncio.gather(*tasks)
         except Exception as e:
             logger.exception(f"[!] An error occurred while fetching match statistics: {e}")
             raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.queue:
+                if heartbeat is not None:
+                    heartbeat.cancel()
+                # the cancelled downloads have to finish first, so none of them completes a released match
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await self.__release_leases()
@@ -1,8 +1,10 @@
 import asyncio
 import logging
+import time
 
-from db.repository.matches_repository import MatchesRepository
+from db.repository.matches_repository import MatchesRepository, CrawlCursor
 from db.executor import Executor
+import config
 
 logger = logging.getLogger(__name__)
 
@@ -13,19 +15,117 @@ class StoreMatchesWorker:
 
     matches_repository: MatchesRepository = MatchesRepository()  # TODO: do this via Dependency Injection
 
-    def __init__(self, exec: Executor):
+    def __init__(self, exec: Executor, bulk: bool | None = None, flush_size: int | None = None, flush_interval: float | None = None):
         self.exec = exec
+        self.bulk = config.store_matches['bulk'] if bulk is None else bulk
+        self.flush_size = flush_size or config.store_matches['flush_size']
+        self.flush_interval = flush_interval or config.store_matches['flush_interval']
+        # match ids already stored during this run - squads play together, so the same
+        # match comes from several players of the roster
+        self.__seen_matches: set[str] = set()
+        self.__duplicate_matches = 0
+        # bulk mode - `(puuid, match_id)` pairs waiting for the next flush
+        self.__pending: list[tuple[str, str]] = []
+        # crawl progress of the pending pairs, `(puuid, queue, type)` -> its crawl cursor
+        self.__pending_cursors: dict[tuple[str, int | None, str | None], CrawlCursor] = {}
+        self.__pending_since = 0.0
+        self.__inserted_matches = 0
+        self.__skipped_matches = 0
+        # pipeline mode - stored match ids are forwarded to the next stage (see `run`)
+        self.__stored_queue: asyncio.Queue | None = None
+        self.__unforwarded: list[str] = []
 
-    async def run(self, queue: asyncio.Queue):
+    async def __forward(self):
+        """ Forwards the match ids stored (committed) so far to the next stage. """
+        if self.__stored_queue is None or not self.__unforwarded:
+            return
+        stored, self.__unforwarded = self.__unforwarded, []
+        await self.__stored_queue.put(stored)
+
+    async def __flush(self):
+        if not self.__pending:
+            return
+        pending, self.__pending = self.__pending, []
+        cursors, self.__pending_cursors = self.__pending_cursors, {}
+        async with self.exec.connection() as conn:
+            result = await self.matches_repository.bulk_save_player_matches(conn, player_matches=pending)
+            await self.matches_repository.save_crawl_cursors(conn, cursors=cursors)
+        self.__inserted_matches += result.inserted_matches
+        self.__skipped_matches += result.skipped_matches
+        logger.info(f"[+] Flushed {len(pending)} player matches: {result.inserted_matches} matches inserted, "
+                    f"{result.skipped_matches} already stored ({result.inserted_player_matches} player matches inserted, "
+                    f"{result.skipped_player_matches} skipped)")
+        await self.__forward()
+
+    async def __store(self, puuid: str, matches: list[str], new_matches: list[str], query: dict):
+        if self.__stored_queue is not None:
+            self.__unforwarded.extend(new_matches)
+        # pages of a query come from the newest to the oldest match
+        cursor = {(puuid, query['queue'], query['type']): CrawlCursor(matches[-1], query.get('end_time'), query.get('crawled'))}
+        if self.bulk:
+            if not self.__pending:
+                self.__pending_since = time.monotonic()
+            self.__pending.extend((puuid, match_id) for match_id in matches)
+            self.__pending_cursors.update(cursor)
+            if len(self.__pending) >= self.flush_size:
+                await self.__flush()
+            return
+        # one unit of work (transaction) per page
+        async with self.exec.connection() as conn:
+            if new_matches:
+                await self.matches_repository.save_matches(conn, matches=list(map((lambda match: (match,)), new_matches)))
+            await self.matches_repository.save_player_matches(conn, puuid=puuid, matches=matches)
+            await self.matches_repository.save_crawl_cursors(conn, cursors=cursor)
+        await self.__forward()
+
+    async def run(self, queue: asyncio.Queue, stored_queue: asyncio.Queue | None = None):
+        """
+        Stores `(puuid, match_ids, query)` pages from the `queue` until `None` is received. The crawl cursor
+        of the query (see `FetchMatchesWorker`, the position of the page is in the `query`) is saved in the
+        same unit of work as the page.
+
+        In bulk mode the pages are accumulated and flushed once there are `flush_size` pairs
+        or the oldest of them has waited for `flush_interval` seconds.
+
+        In the pipeline mode the ids of the matches new to this run are put into the `stored_queue`
+        (in lists) once they are committed - the end of the queue is signalled by the caller.
+        """
+        self.__stored_queue = stored_queue
+        get_task: asyncio.Future | None = None
         try:
             while True:
-                matches = await queue.get()
-                if matches is None:
-                    logger.info("[*] No more matches to store")
+                # the oldest pending pair waits at most `flush_interval` seconds - checked before taking the next page,
+                # pages arriving without a pause would never let the wait below time out
+                if self.__pending and time.monotonic() >= self.__pending_since + self.flush_interval:
+                    await self.__flush()
+                if get_task is None:
+                    get_task = asyncio.ensure_future(queue.get())
+                timeout = max(0.0, self.__pending_since + self.flush_interval - time.monotonic()) if self.__pending else None
+                # the getter survives the timeout, so no item is lost
+                done, _ = await asyncio.wait({get_task}, timeout=timeout)
+                if not done:
+                    await self.__flush()
+                    continue
+                item, get_task = get_task.result(), None
+
+                if item is None:
+                    await self.__flush()
+                    summary = f"{len(self.__seen_matches)} unique matches stored, {self.__duplicate_matches} duplicates across players skipped"
+                    if self.bulk:
+                        summary += f", {self.__inserted_matches} matches inserted, {self.__skipped_matches} already stored"
+                    logger.info(f"[*] No more matches to store, {summary}")
                     return
-                logger.info(f"[+] Storing {len(matches)} matches: {matches}")
-                await self.matches_repository.save_matches(exec=self.exec, matches=list(map((lambda match: (match,)), matches)))
+                puuid, matches, query = item
+                new_matches = [match for match in matches if match not in self.__seen_matches]
+                self.__seen_matches.update(new_matches)
+                self.__duplicate_matches += len(matches) - len(new_matches)
+
+                logger.info(f"[+] Storing {len(matches)} matches of {puuid} ({len(new_matches)} new): {matches}")
+                await self.__store(puuid, matches, new_matches, query)
                 queue.task_done()
         except Exception as e:
             logger.exception(f"[!] An error occurred while storing matches: {e}")
             raise
+        finally:
+            if get_task is not None:
+                get_task.cancel()
@@ -0,0 +1,212 @@
+from collections import Counter
+from contextlib import asynccontextmanager
+import copy
+import json
+import os
+import random
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNAPSHOTS_DIR = os.path.join(ROOT_DIR, 'match_snapshots')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+import config  # noqa: E402
+from db.repository.matches_repository import BulkSaveResult  # noqa: E402
+
+
+class AllColumns(list):
+    """ Column list containing every column - makes the full transformation keep all it computes. """
+
+    def __contains__(self, column):
+        return True
+
+
+def load_snapshot() -> dict:
+    with open(os.path.join(SNAPSHOTS_DIR, 'version_14.23.636.9832.json'), 'r', encoding='utf-8') as snapshot_file:
+        return json.load(snapshot_file)
+
+
+def match_variant(base: dict, rng: random.Random) -> dict:
+    """ Variant of the match - shuffled participants/teams/keys, changed values, missing keys, other patches. """
+    match = copy.deepcopy(base)
+    participants = match['info']['participants']
+    if rng.random() < .5:
+        rng.shuffle(participants)
+    if rng.random() < .3:
+        match['info']['teams'].reverse()
+    for participant in participants:
+        for key in rng.sample(list(participant), 10):
+            value = participant[key]
+            if isinstance(value, bool):
+                participant[key] = rng.random() < .5
+            elif isinstance(value, (int, float)):
+                r = rng.random()
+                participant[key] = rng.randint(0, 50) if r < .8 else rng.random() if r < .95 else 2 ** 60
+        if rng.random() < .05:
+            participant.pop(rng.choice([key for key in participant if key not in ('teamId', 'puuid')]))
+    if rng.random() < .2:
+        order = list(participants[0])
+        rng.shuffle(order)
+        for idx, participant in enumerate(participants):
+            participants[idx] = {key: participant[key] for key in order if key in participant}
+    if rng.random() < .1:
+        match['info']['gameDuration'] = 200
+    if rng.random() < .2:
+        match['info']['gameVersion'] = rng.choice(['14.24.1.1', '13.1.2.3'])
+    return match
+
+
+def pick_columns(everything: dict, rng: random.Random) -> list:
+    """ Random subset of the computed columns, plus columns no match has. """
+    columns = list(everything)
+    columns = rng.sample(columns, min(len(columns), rng.choice([5, 12, 40, len(columns)])))
+    return columns + ['team_challenges', 'friendly_team_nonexistent']
+
+
+def assert_same_row(expected, actual):
+    assert actual == expected
+    if expected is not None:
+        # same column order and value types (ints stay ints in the export)
+        assert list(actual) == list(expected)
+        assert [type(value) for value in actual.values()] == [type(value) for value in expected.values()]
+
+
+@pytest.fixture
+def snapshot() -> dict:
+    return load_snapshot()
+
+
+@pytest.fixture
+def export_config(monkeypatch):
+    """ Restores the roster and the export columns changed by the test. """
+    monkeypatch.setattr(config, 'PUUIDS', list(config.PUUIDS))
+    monkeypatch.setattr(config, 'CSV_EXPORT_COLUMNS', list(config.CSV_EXPORT_COLUMNS))
+    return config
+
+
+class FakeExecutor:
+    """ `Executor` without a database - the units of work get no connection. """
+
+    @asynccontextmanager
+    async def connection(self):
+        yield None
+
+
+class FakeMatchesRepository:
+    """
+    In-memory `MatchesRepository` - the matches with their download status (`pending`, `done`, `failed`,
+    `unavailable` or the id of the worker leasing them), the player matches and the crawl cursors.
+    """
+
+    def __init__(self):
+        self.statuses: dict[str, str] = {}
+        self.attempts: Counter = Counter()
+        self.player_matches: set[tuple[str, str]] = set()
+        self.cursors: dict = {}
+        self.unavailable: set[str] = set()
+        # player matches of every bulk save
+        self.flushes: list[list[tuple[str, str]]] = []
+
+    def add_matches(self, match_ids, status: str = 'pending'):
+        self.statuses.update({match_id: status for match_id in match_ids})
+
+    @staticmethod
+    def _of_platforms(match_id, platforms, known_platforms) -> bool:
+        if platforms is None:
+            return True
+        platform = match_id.split('_', 1)[0].upper()
+        return platform in platforms or known_platforms is not None and platform not in known_platforms
+
+    def _newest_first(self, older_than=None, platforms=None, known_platforms=None):
+        return [
+            match_id for match_id in sorted(self.statuses, reverse=True)
+            if (older_than is None or match_id < older_than) and self._of_platforms(match_id, platforms, known_platforms)
+        ]
+
+    async def save_matches(self, conn, matches):
+        for (match_id,) in matches:
+            self.statuses.setdefault(match_id, 'pending')
+
+    async def save_player_matches(self, conn, puuid, matches):
+        self.player_matches.update((puuid, match_id) for match_id in matches)
+
+    async def bulk_save_player_matches(self, conn, player_matches):
+        self.flushes.append(list(player_matches))
+        new_matches = {match_id for _, match_id in player_matches} - set(self.statuses)
+        self.add_matches(new_matches)
+        self.player_matches.update(player_matches)
+        return BulkSaveResult(len(new_matches), 0, len(player_matches), 0)
+
+    async def save_crawl_cursors(self, conn, cursors):
+        self.cursors.update(cursors)
+
+    async def get_crawl_cursor(self, conn, puuid, queue=None, match_type=None):
+        return self.cursors.get((puuid, queue, match_type))
+
+    async def get_oldest_match(self, conn, puuid=None, newer_than=None):
+        return min((
+            match_id for player, match_id in self.player_matches
+            if player == puuid and match_id not in self.unavailable and (newer_than is None or match_id > newer_than)
+        ), default=None)
+
+    async def count_matches_older_than(self, conn, match_id):
+        return len([other for other in self._newest_first(match_id) if other not in self.unavailable])
+
+    async def get_matches_page(self, conn, older_than, limit, platforms=None, known_platforms=None):
+        match_ids = self._newest_first(older_than, platforms, known_platforms)
+        return [match_id for match_id in match_ids if match_id not in self.unavailable][:limit]
+
+    async def count_pending_downloads(self, conn, older_than, max_attempts):
+        return len([match_id for match_id in self._newest_first(older_than) if self.statuses[match_id] == 'pending'])
+
+    async def claim_downloads(self, conn, worker_id, limit, lease_seconds, max_attempts, older_than=None,
+                              platforms=None, known_platforms=None, match_ids=None):
+        claimed = [
+            match_id for match_id in self._newest_first(older_than, platforms, known_platforms)
+            if self.statuses[match_id] == 'pending' and self.attempts[match_id] < max_attempts
+            and (match_ids is None or match_id in match_ids)
+        ][:limit]
+        for match_id in claimed:
+            self.statuses[match_id] = worker_id
+            self.attempts[match_id] += 1
+        return claimed
+
+    async def renew_leases(self, conn, worker_id, lease_seconds):
+        return sum(1 for status in self.statuses.values() if status == worker_id)
+
+    async def complete_download(self, conn, match_id):
+        self.statuses[match_id] = 'done'
+        self.unavailable.discard(match_id)
+
+    async def fail_download(self, conn, match_id, error, max_attempts):
+        self.statuses[match_id] = 'failed' if self.attempts[match_id] >= max_attempts else 'pending'
+
+    async def release_downloads(self, conn, worker_id):
+        released = [match_id for match_id, status in self.statuses.items() if status == worker_id]
+        for match_id in released:
+            self.statuses[match_id] = 'pending'
+            self.attempts[match_id] -= 1
+        return len(released)
+
+    async def mark_unavailable(self, conn, match_id, reason, recheck_after=None):
+        self.unavailable.add(match_id)
+        if match_id in self.statuses:
+            self.statuses[match_id] = 'unavailable'
+
+    async def get_unavailable(self, conn, match_ids):
+        return {match_id for match_id in match_ids if match_id in self.unavailable}
+
+    async def requeue_unavailable(self, conn):
+        return 0
+
+
+@pytest.fixture
+def executor() -> FakeExecutor:
+    return FakeExecutor()
+
+
+@pytest.fixture
+def matches_repository() -> FakeMatchesRepository:
+    return FakeMatchesRepository()
@@ -0,0 +1,104 @@
+import asyncio
+import csv
+import json
+
+import pytest
+
+from utils.export_sinks import ExportSchema, SinkWriter, create_export_sink
+
+SCHEMA = ExportSchema(
+    columns=['win', 'kills', 'gameDuration', 'team', 'gameMode'],
+    types=['boolean', 'numeric', 'numeric', ('blue', 'red'), 'string'],
+)
+ROWS = [
+    [True, 3, 0, 'red', 'CLASSIC'],
+    [False, 0, 1.5, 'blue', 'ARAM ranked'],
+    [None, 12, 1800, 'red', None],
+]
+
+
+def write(export_format, filepath, batches, append=False, **kwargs):
+    async def scenario():
+        writer = SinkWriter(create_export_sink(export_format, str(filepath), append, **kwargs))
+        try:
+            await writer.open(SCHEMA)
+            for rows in batches:
+                await writer.write(rows)
+        finally:
+            await writer.close()
+    asyncio.run(scenario())
+
+
+def arff_sections(filepath):
+    header, data = filepath.read_text(encoding='utf-8').split('@DATA\n')
+    return header.splitlines(), [line for line in data.splitlines() if line]
+
+
+def test_dense_arff(tmp_path):
+    filepath = tmp_path / 'export.arff'
+
+    write('arff', filepath, [ROWS[:2], ROWS[2:]])
+
+    header, data = arff_sections(filepath)
+    assert header[0] == '@RELATION export'
+    assert [line for line in header if line.startswith('@ATTRIBUTE')] == [
+        '@ATTRIBUTE win {False,True}',
+        '@ATTRIBUTE kills NUMERIC',
+        '@ATTRIBUTE gameDuration NUMERIC',
+        '@ATTRIBUTE team {blue,red}',
+        '@ATTRIBUTE gameMode STRING',
+    ]
+    assert data == ["True,3,0,red,CLASSIC", "False,0,1.5,blue,'ARAM ranked'", "?,12,1800,red,?"]
+
+
+def test_sparse_arff(tmp_path):
+    filepath = tmp_path / 'export.arff'
+
+    write('arff', filepath, [ROWS], sparse=True)
+
+    header, data = arff_sections(filepath)
+    assert '@ATTRIBUTE win {False,True}' in header
+    # zeros and `False` (the first nominal value) are omitted
+    assert data == ["{0 True, 1 3, 3 red, 4 CLASSIC}", "{2 1.5, 3 blue, 4 'ARAM ranked'}", "{0 ?, 1 12, 2 1800, 3 red, 4 ?}"]
+
+
+def test_appended_arff_has_one_header(tmp_path):
+    filepath = tmp_path / 'export.arff'
+
+    write('arff', filepath, [ROWS[:1]])
+    write('arff', filepath, [ROWS[1:]], append=True)
+
+    header, data = arff_sections(filepath)
+    assert filepath.read_text(encoding='utf-8').count('@DATA') == 1
+    assert len(data) == len(ROWS)
+
+
+def test_ndjson_and_csv_rows_match(tmp_path):
+    write('csv', tmp_path / 'export.csv', [ROWS[:1], ROWS[1:]])
+    write('ndjson', tmp_path / 'export.ndjson', [ROWS[:1], ROWS[1:]])
+
+    with open(tmp_path / 'export.csv', newline='', encoding='utf-8') as f:
+        csv_rows = list(csv.reader(f))
+    with open(tmp_path / 'export.ndjson', encoding='utf-8') as f:
+        ndjson_rows = [json.loads(line) for line in f]
+
+    assert csv_rows[0] == SCHEMA.columns
+    assert [list(row) for row in ndjson_rows] == [SCHEMA.columns] * len(ROWS)
+    assert [list(row.values()) for row in ndjson_rows] == ROWS
+    # csv has the same values, only as text (missing ones empty)
+    assert csv_rows[1:] == [['' if value is None else str(value) for value in row] for row in ROWS]
+
+
+def test_writer_thread_errors_surface(tmp_path):
+    filepath = tmp_path / 'export.ndjson'
+
+    with pytest.raises(TypeError, match='not JSON serializable'):
+        write('ndjson', filepath, [ROWS, [[object(), 1, 2, 'red', 'CLASSIC']]])
+
+    # the batches written before the failure are in the closed file
+    assert len(filepath.read_text(encoding='utf-8').splitlines()) == len(ROWS)
+
+
+def test_unsupported_format():
+    with pytest.raises(ValueError, match='Unsupported export format'):
+        create_export_sink('xlsx', 'export.xlsx')
@@ -0,0 +1,49 @@
+import pytest
+
+import config
+from workers.export_statistics_worker import ExportStatisticsWorker
+
+
+class FakeMatchStore:
+    def fingerprint(self, match_id):
+        return f"fingerprint-{match_id}"
+
+
+@pytest.fixture
+def previous_export(export_config, monkeypatch, tmp_path):
+    """ Manifest of a finished export of two matches. """
+    monkeypatch.setitem(config.exports, 'incremental', True)
+    monkeypatch.setitem(config.exports, 'csv_export_dir', str(tmp_path))
+    monkeypatch.setattr(config, 'PUUIDS', ['puuid-b', 'puuid-a'])
+    export_filename = tmp_path / 'export.csv'
+    export_filename.write_text('a,b\n1,2\n')
+    worker = ExportStatisticsWorker('csv', str(export_filename), str(tmp_path / 'manifest.json'))
+    manifest = worker.new_manifest({'EUW1_1': 'fingerprint-EUW1_1', 'EUW1_2': 'fingerprint-EUW1_2'})
+    manifest.headers = ['a', 'b']
+    worker.save_manifest(manifest)
+    return worker
+
+
+def plan_export(previous_export):
+    worker = ExportStatisticsWorker('csv', manifest_file=previous_export.manifest_file)
+    match_ids, _ = worker.plan_export(FakeMatchStore(), ['EUW1_1', 'EUW1_2', 'EUW1_3'])
+    return worker, match_ids
+
+
+def test_same_roster_appends_new_matches(previous_export, monkeypatch):
+    # the order of the players doesn't matter
+    monkeypatch.setattr(config, 'PUUIDS', ['puuid-a', 'puuid-b'])
+
+    worker, match_ids = plan_export(previous_export)
+
+    assert worker.append
+    assert match_ids == ['EUW1_3']
+
+
+def test_changed_roster_rebuilds_the_export(previous_export, monkeypatch):
+    monkeypatch.setattr(config, 'PUUIDS', ['puuid-a', 'puuid-c'])
+
+    worker, match_ids = plan_export(previous_export)
+
+    assert not worker.append
+    assert match_ids == ['EUW1_1', 'EUW1_2', 'EUW1_3']
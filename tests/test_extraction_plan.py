@@ -0,0 +1,65 @@
+import copy
+import random
+
+import pytest
+
+from conftest import SNAPSHOTS_DIR, AllColumns, assert_same_row, match_variant, pick_columns
+from services.riot_api import ExtractionPlan, SchemaRegistry, UnsupportedMatchError
+from workers.export_statistics_worker import transform_match_data_full
+
+
+def extract(plan: ExtractionPlan, match: dict):
+    """ The plan with the fallback of the export (`transform_match_data`). """
+    try:
+        return plan.extract(match)
+    except UnsupportedMatchError:
+        return transform_match_data_full(match)
+
+
+def test_snapshot_configured_columns(snapshot, export_config):
+    export_config.PUUIDS = [snapshot['info']['participants'][0]['puuid']]
+    plan = ExtractionPlan(export_config.CSV_EXPORT_COLUMNS)
+
+    expected = transform_match_data_full(copy.deepcopy(snapshot))
+    assert expected is not None
+    assert_same_row(expected, plan.extract(copy.deepcopy(snapshot)))
+
+
+def test_key_missing_in_first_participant(snapshot, export_config):
+    participants = snapshot['info']['participants']
+    export_config.PUUIDS = [participants[1]['puuid']]
+    del participants[0]['gameEndedInEarlySurrender']
+    for participant in participants[1:]:
+        participant['gameEndedInEarlySurrender'] = participant['teamId'] == participants[1]['teamId']
+    export_config.CSV_EXPORT_COLUMNS = ['team_gameEndedInEarlySurrender', 'team_kills', 'win']
+    plan = ExtractionPlan(export_config.CSV_EXPORT_COLUMNS)
+
+    # the full transformation creates the column for the true value of a friendly participant
+    expected = transform_match_data_full(copy.deepcopy(snapshot))
+    assert expected['team_gameEndedInEarlySurrender'] is True
+    with pytest.raises(UnsupportedMatchError):
+        plan.extract(copy.deepcopy(snapshot))
+    assert_same_row(expected, extract(plan, copy.deepcopy(snapshot)))
+
+
+@pytest.mark.parametrize('with_registry', [False, True])
+def test_variants_match_full_transformation(snapshot, export_config, with_registry):
+    rng = random.Random(1)
+    registry = SchemaRegistry(SNAPSHOTS_DIR) if with_registry else None
+    export_config.CSV_EXPORT_COLUMNS = AllColumns()
+    everything = transform_match_data_full(copy.deepcopy(snapshot))
+
+    for _ in range(200):
+        match = match_variant(snapshot, rng)
+        participants = match['info']['participants']
+        r = rng.random()
+        export_config.PUUIDS = [] if r < .1 else [rng.choice(participants)['puuid']]
+        export_config.CSV_EXPORT_COLUMNS = pick_columns(everything, rng)
+        plan = ExtractionPlan(export_config.CSV_EXPORT_COLUMNS, registry=registry)
+
+        try:
+            expected = transform_match_data_full(copy.deepcopy(match))
+        except KeyError:
+            # a participant lacking a key the full transformation needs, nothing to compare with
+            continue
+        assert_same_row(expected, extract(plan, copy.deepcopy(match)))
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+import config
+from db.repository.matches_repository import CrawlCursor
+from errors import MatchDataNotFoundException
+from workers.fetch_matches_worker import CrawlFilter, FetchMatchesWorker
+from workers.store_matches_worker import StoreMatchesWorker
+
+PUUID = 'puuid'
+PAGE_SIZE = 5
+
+
+def match_id(idx: int) -> str:
+    return f"EUW1_{1000 + idx}"
+
+
+def end_timestamp_ms(idx: int) -> int:
+    return (1_700_000_000 + idx * 3600) * 1000
+
+
+# the matches of the two queues interleave in time - odd ones are ranked solo (420), even ones ARAM (450)
+QUEUE_MATCHES = {420: [idx for idx in range(1, 41) if idx % 2], 450: [idx for idx in range(1, 41) if not idx % 2]}
+
+
+class FakeRiotApiService:
+    def __init__(self, fail_at: tuple[int, int] | None = None, expired: set[str] = frozenset()):
+        # (queue, start) of the request failing - the crawl is interrupted there
+        self.fail_at = fail_at
+        self.expired = expired
+        # (queue, start) of the page requests and the matches downloaded for their end timestamp
+        self.requests: list[tuple[int, int]] = []
+        self.downloaded: list[str] = []
+
+    async def get_matches(self, puuid, start, count, startTime=None, endTime=None, queue=None, type=None):
+        self.requests.append((queue, start))
+        if (queue, start) == self.fail_at:
+            raise RuntimeError("crawl interrupted")
+        indexes = [idx for idx in QUEUE_MATCHES[queue] if endTime is None or end_timestamp_ms(idx) // 1000 <= endTime]
+        return [match_id(idx) for idx in sorted(indexes, reverse=True)][start:start + count]
+
+    async def get_match_end_timestamp(self, match_id):
+        self.downloaded.append(match_id)
+        if match_id in self.expired:
+            raise MatchDataNotFoundException(f"Match {match_id} not found")
+        return end_timestamp_ms(int(match_id.split('_')[1]) - 1000)
+
+
+@pytest.fixture(autouse=True)
+def small_pages(monkeypatch):
+    monkeypatch.setitem(config.fetch_matches, 'page_size', PAGE_SIZE)
+    monkeypatch.setitem(config.fetch_matches, 'prefetch_pages', 1)
+
+
+async def crawl(executor, repository, riot_api_service, should_resume):
+    """ Crawls the player and stores the fetched pages (also the ones fetched before a failure). """
+    worker = FetchMatchesWorker(executor, riot_api_service, PUUID, crawl_filter=CrawlFilter(queues=[420, 450]))
+    worker.matches_repository = repository
+    store_worker = StoreMatchesWorker(executor, bulk=False)
+    store_worker.matches_repository = repository
+    queue = asyncio.Queue()
+    try:
+        await worker.run(queue, should_resume=should_resume)
+    finally:
+        await queue.put(None)
+        await store_worker.run(queue)
+
+
+def all_match_ids():
+    return {match_id(idx) for indexes in QUEUE_MATCHES.values() for idx in indexes}
+
+
+def test_interrupted_multi_queue_crawl_resumes_every_queue(executor, matches_repository):
+    repository = matches_repository
+    # the second page of the second queue fails, its older matches are newer than the oldest match of the first queue
+    with pytest.raises(RuntimeError):
+        asyncio.run(crawl(executor, repository, FakeRiotApiService(fail_at=(450, PAGE_SIZE)), should_resume=False))
+    assert len(repository.player_matches) == len(QUEUE_MATCHES[420]) + PAGE_SIZE
+    assert repository.cursors[(PUUID, 450, None)].oldest_match_id == match_id(QUEUE_MATCHES[450][-PAGE_SIZE])
+
+    riot_api_service = FakeRiotApiService()
+    asyncio.run(crawl(executor, repository, riot_api_service, should_resume=True))
+
+    assert {match for _, match in repository.player_matches} == all_match_ids()
+    # resumed from the crawl positions - no match downloaded, no page crawled again
+    assert riot_api_service.downloaded == []
+    assert riot_api_service.requests == [(420, len(QUEUE_MATCHES[420])), (450, PAGE_SIZE), (450, 2 * PAGE_SIZE),
+                                         (450, 3 * PAGE_SIZE), (450, 4 * PAGE_SIZE)]
+
+
+def test_resume_past_an_unavailable_cursor_match(executor, matches_repository):
+    repository = matches_repository
+    with pytest.raises(RuntimeError):
+        asyncio.run(crawl(executor, repository, FakeRiotApiService(fail_at=(450, PAGE_SIZE)), should_resume=False))
+    # cursors saved before the crawl positions existed resume from the end of their match
+    cursor = repository.cursors[(PUUID, 450, None)].oldest_match_id
+    repository.cursors[(PUUID, 450, None)] = CrawlCursor(cursor)
+
+    asyncio.run(crawl(executor, repository, FakeRiotApiService(expired={cursor}), should_resume=True))
+
+    assert cursor in repository.unavailable
+    assert {match for _, match in repository.player_matches} == all_match_ids()
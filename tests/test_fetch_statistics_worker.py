@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from errors import RiotApiException
+from storage import DirectoryMatchStore
+from workers.fetch_statistics_worker import FetchStatisticsWorker
+
+# europe ids sort before the asia ones (newest first), the asia downloads must not wait for them
+EUROPE_IDS = [f"TR1_{idx}" for idx in range(9000, 9060)]
+ASIA_IDS = [f"KR_{idx}" for idx in range(1000, 1010)]
+UNKNOWN_IDS = ['XX1_1']
+
+
+class FakeRiotApiService:
+    def __init__(self):
+        self.downloaded = []
+
+    async def download_match_statistics(self, match_id, filepath, compress):
+        # europe is rate limited hard
+        await asyncio.sleep(0.01 if match_id.startswith('TR1') else 0)
+        self.downloaded.append(match_id)
+        return 1
+
+
+def new_worker(tmp_path, executor, matches_repository):
+    riot_api_service = FakeRiotApiService()
+    worker = FetchStatisticsWorker(executor, riot_api_service, DirectoryMatchStore(str(tmp_path)), queue=False)
+    worker.matches_repository = matches_repository
+    return worker, riot_api_service
+
+
+def assert_regions_concurrent(downloaded, before):
+    last_asia = max(downloaded.index(match_id) for match_id in ASIA_IDS)
+    assert last_asia < before, "asia matches waited for the europe ones"
+
+
+def test_regions_are_paged_separately(tmp_path, executor, matches_repository):
+    match_ids = EUROPE_IDS + ASIA_IDS + UNKNOWN_IDS
+    matches_repository.add_matches(match_ids)
+    worker, riot_api_service = new_worker(tmp_path, executor, matches_repository)
+
+    asyncio.run(worker.run(workers=2, max_in_flight=2, batch_size=5))
+
+    assert sorted(riot_api_service.downloaded) == sorted(match_ids)
+    assert_regions_concurrent(riot_api_service.downloaded, before=len(EUROPE_IDS) // 2)
+
+
+def test_previous_stage_is_dispatched_without_blocking(tmp_path, executor, matches_repository):
+    worker, riot_api_service = new_worker(tmp_path, executor, matches_repository)
+
+    async def previous_stage():
+        # every batch has both the regions, the europe ids first
+        for idx in range(5):
+            yield EUROPE_IDS[idx * 12:(idx + 1) * 12] + ASIA_IDS[idx * 2:(idx + 1) * 2]
+        yield UNKNOWN_IDS
+
+    asyncio.run(worker.run(workers=2, max_in_flight=2, batch_size=5, match_id_batches=previous_stage()))
+
+    assert sorted(riot_api_service.downloaded) == sorted(EUROPE_IDS + ASIA_IDS + UNKNOWN_IDS)
+    # the last asia ids come with the last europe batch, the overflows hold back the stream by a batch per region
+    assert_regions_concurrent(riot_api_service.downloaded, before=len(EUROPE_IDS) * 2 // 3)
+
+
+def test_previous_stage_claims_and_drains_the_download_queue(tmp_path, executor, matches_repository):
+    # pending matches of the previous runs, matches of this run - one downloaded and one claimed by other workers meanwhile
+    backlog = ['TR1_1', 'KR_1']
+    forwarded = ['TR1_9', 'TR1_8', 'KR_9', 'KR_8']
+    matches_repository.add_matches(backlog + forwarded)
+    matches_repository.statuses.update({'TR1_8': 'done', 'KR_8': 'other-worker'})
+    worker, riot_api_service = new_worker(tmp_path, executor, matches_repository)
+    worker.queue = True
+    downloaded_queue = asyncio.Queue()
+
+    async def previous_stage():
+        yield forwarded
+
+    asyncio.run(worker.run(workers=2, max_in_flight=2, batch_size=5, match_id_batches=previous_stage(),
+                           downloaded_queue=downloaded_queue))
+
+    assert sorted(riot_api_service.downloaded) == sorted(['TR1_9', 'KR_9'] + backlog)
+    assert sorted(downloaded_queue.get_nowait() for _ in range(downloaded_queue.qsize())) == sorted(riot_api_service.downloaded)
+    assert matches_repository.statuses['KR_8'] == 'other-worker'
+    assert all(matches_repository.statuses[match_id] == 'done' for match_id in riot_api_service.downloaded)
+
+
+class FailingRiotApiService(FakeRiotApiService):
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = errors
+
+    async def download_match_statistics(self, match_id, filepath, compress):
+        if match_id in self.errors:
+            raise self.errors[match_id]
+        return await super().download_match_statistics(match_id, filepath, compress)
+
+
+def test_failed_downloads_do_not_abort_the_pool(tmp_path, executor, matches_repository):
+    match_ids = EUROPE_IDS[:10] + ASIA_IDS
+    matches_repository.add_matches(match_ids)
+    failed = {EUROPE_IDS[0]: ConnectionResetError("connection reset"), ASIA_IDS[3]: RiotApiException(502)}
+    riot_api_service = FailingRiotApiService(failed)
+    worker = FetchStatisticsWorker(executor, riot_api_service, DirectoryMatchStore(str(tmp_path)), queue=True)
+    worker.matches_repository = matches_repository
+
+    asyncio.run(worker.run(workers=2, max_in_flight=2, batch_size=5))
+
+    assert sorted(riot_api_service.downloaded) == sorted(set(match_ids) - set(failed))
+    # claimed again by a later run
+    assert all(matches_repository.statuses[match_id] == 'pending' for match_id in failed)
+
+
+def test_rejected_api_key_aborts_the_pool(tmp_path, executor, matches_repository):
+    matches_repository.add_matches(EUROPE_IDS[:10])
+    riot_api_service = FailingRiotApiService({EUROPE_IDS[0]: RiotApiException(403)})
+    worker = FetchStatisticsWorker(executor, riot_api_service, DirectoryMatchStore(str(tmp_path)), queue=True)
+    worker.matches_repository = matches_repository
+
+    with pytest.raises(RiotApiException):
+        asyncio.run(worker.run(workers=2, max_in_flight=2, batch_size=5))
@@ -0,0 +1,72 @@
+import asyncio
+import gzip
+import os
+
+import pytest
+
+from utils.json_stream import JsonFileStream, JsonStreamError
+
+DOCUMENT = b'{"metadata": {"matchId": "EUW1_1"}, "info": {"gameDuration": 1800, "gameEndTimestamp": 1700000000000}}'
+
+
+def chunks(data: bytes, size: int) -> list[bytes]:
+    return [data[idx:idx + size] for idx in range(0, len(data), size)]
+
+
+def stream(filepath, data_chunks, **kwargs) -> JsonFileStream:
+    async def write():
+        async with JsonFileStream(str(filepath), fields=['gameEndTimestamp'], **kwargs) as json_stream:
+            for chunk in data_chunks:
+                await json_stream.write(chunk)
+        return json_stream
+    return asyncio.run(write())
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, len(DOCUMENT)])
+def test_fields_are_extracted_across_chunk_boundaries(tmp_path, chunk_size):
+    filepath = tmp_path / 'match.json'
+
+    json_stream = stream(filepath, chunks(DOCUMENT, chunk_size), expected_length=len(DOCUMENT))
+
+    assert json_stream.extracted == {'gameEndTimestamp': 1700000000000}
+    assert filepath.read_bytes() == DOCUMENT
+
+
+def test_compressed_document(tmp_path):
+    filepath = tmp_path / 'match.json.gz'
+
+    stream(filepath, chunks(DOCUMENT, 16), compress=True)
+
+    assert gzip.decompress(filepath.read_bytes()) == DOCUMENT
+
+
+@pytest.mark.parametrize('data, expected_length, error', [
+    (DOCUMENT[:-10], len(DOCUMENT), 'not a JSON object'),
+    (DOCUMENT[:-1] + b' }', len(DOCUMENT), 'truncated'),
+    (b'[1, 2, 3]', None, 'not a JSON object'),
+    (b'<html>Bad Gateway</html>', None, 'not a JSON object'),
+    (b'', None, 'not a JSON object'),
+])
+def test_invalid_payload_leaves_no_file(tmp_path, data, expected_length, error):
+    filepath = tmp_path / 'match.json'
+
+    with pytest.raises(JsonStreamError, match=error):
+        stream(filepath, chunks(data, 8), expected_length=expected_length)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_download_keeps_the_previous_file(tmp_path):
+    filepath = tmp_path / 'match.json'
+    filepath.write_bytes(DOCUMENT)
+
+    async def interrupted():
+        async with JsonFileStream(str(filepath)) as json_stream:
+            await json_stream.write(DOCUMENT[:20])
+            raise ConnectionResetError("connection reset")
+
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(interrupted())
+
+    assert os.listdir(tmp_path) == ['match.json']
+    assert filepath.read_bytes() == DOCUMENT
@@ -0,0 +1,43 @@
+import asyncio
+import importlib
+
+import pytest
+
+import config
+
+PAGES = 6
+
+
+class FakeFetchMatchesWorker:
+    def __init__(self, executor, riot_api_service, puuid):
+        self.puuid = puuid
+
+    async def run(self, queue, should_resume=False):
+        for page in range(PAGES):
+            await queue.put((self.puuid, [f"EUW1_{page}"], {'queue': None, 'type': None}))
+
+
+class FailingStoreMatchesWorker:
+    def __init__(self, executor):
+        pass
+
+    async def run(self, queue, stored_queue=None):
+        await queue.get()
+        # the crawl finishes (and fills up the queue) before the storing fails
+        await asyncio.sleep(0.01)
+        raise RuntimeError("storing failed")
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    monkeypatch.setitem(config.logging, 'log_file', str(tmp_path / 'logs' / 'test.log'))
+    main = importlib.import_module('main')
+    monkeypatch.setattr(main, 'FetchMatchesWorker', FakeFetchMatchesWorker)
+    monkeypatch.setattr(main, 'StoreMatchesWorker', FailingStoreMatchesWorker)
+    monkeypatch.setattr(config, 'PUUIDS', ['puuid'])
+    return main
+
+
+def test_storing_failure_after_the_crawl_is_raised(main):
+    with pytest.raises(RuntimeError, match="storing failed"):
+        asyncio.run(asyncio.wait_for(main.fetch_matches(), timeout=5))
@@ -0,0 +1,29 @@
+import os
+
+from storage.match_archive import MatchArchive
+
+
+def payload(idx: int) -> bytes:
+    return b'{"metadata": {"matchId": "EUW1_%d"}, "info": {"gameDuration": %d}}' % (idx, idx)
+
+
+def test_unindexed_records_are_recovered_and_a_partial_one_truncated(tmp_path):
+    archive = MatchArchive(str(tmp_path))
+    for idx in range(50):
+        archive.append(f"EUW1_{idx}", payload(idx))
+    archive.close()
+
+    # crash - only the first 10 records got indexed and the last record was written partially
+    index_path = tmp_path / 'index.tsv'
+    index_path.write_text(''.join(index_path.read_text().splitlines(keepends=True)[:10]))
+    segment_path = tmp_path / 'segment_000001.dat'
+    complete_length = os.path.getsize(segment_path)
+    with open(segment_path, 'ab') as segment_file:
+        segment_file.write(b'MA\x07')
+
+    archive = MatchArchive(str(tmp_path))
+
+    assert len(archive) == 50
+    assert all(archive.get(f"EUW1_{idx}") == payload(idx) for idx in range(50))
+    assert os.path.getsize(segment_path) == complete_length
+    archive.close()
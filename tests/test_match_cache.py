@@ -0,0 +1,102 @@
+import asyncio
+import gzip
+import json
+
+from services.riot_api.match_cache import MatchCache
+
+
+def payload(match_id):
+    return {'metadata': {'matchId': match_id}, 'info': {'gameEndTimestamp': 1_700_000_000_000, 'gameDuration': 1800}}
+
+
+class FakeApi:
+    """ Counts the fetches (and the streamed downloads) of every match. """
+
+    def __init__(self):
+        self.fetches = []
+
+    def fetch(self, match_id):
+        async def fetch():
+            self.fetches.append(match_id)
+            await asyncio.sleep(0.01)
+            return payload(match_id)
+        return fetch
+
+    def download(self, match_id, filepath, compress):
+        async def download():
+            self.fetches.append(match_id)
+            await asyncio.sleep(0.01)
+            data = json.dumps(payload(match_id)).encode('utf-8')
+            with open(filepath, 'wb') as f:
+                f.write(gzip.compress(data) if compress else data)
+            return {'gameEndTimestamp': payload(match_id)['info']['gameEndTimestamp']}
+        return download
+
+
+def read_payload(filepath, compress):
+    with (gzip.open if compress else open)(filepath, 'rb') as f:
+        return json.loads(f.read())
+
+
+def test_least_recently_used_match_is_evicted():
+    cache, api = MatchCache(memory_entries=2), FakeApi()
+
+    async def scenario():
+        for match_id in ['EUW1_1', 'EUW1_2', 'EUW1_1', 'EUW1_3', 'EUW1_1', 'EUW1_2']:
+            await cache.get_or_fetch(match_id, api.fetch(match_id))
+
+    asyncio.run(scenario())
+
+    # EUW1_2 was the least recently used one when EUW1_3 came
+    assert api.fetches == ['EUW1_1', 'EUW1_2', 'EUW1_3', 'EUW1_2']
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_disk_tier_outlives_the_memory_tier(tmp_path):
+    api = FakeApi()
+    asyncio.run(MatchCache(memory_entries=0, disk_dir=str(tmp_path)).get_or_fetch('EUW1_1', api.fetch('EUW1_1')))
+
+    cache = MatchCache(memory_entries=0, disk_dir=str(tmp_path))
+    data = asyncio.run(cache.get_or_fetch('EUW1_1', api.fetch('EUW1_1')))
+
+    assert data == payload('EUW1_1')
+    assert api.fetches == ['EUW1_1']
+    assert cache.hits == 1
+
+
+def test_concurrent_fetches_are_coalesced():
+    cache, api = MatchCache(memory_entries=16), FakeApi()
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_fetch('EUW1_1', api.fetch('EUW1_1')) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+
+    assert api.fetches == ['EUW1_1']
+    assert all(result == payload('EUW1_1') for result in results)
+
+
+def test_downloads_are_coalesced_and_added_to_the_disk_tier(tmp_path):
+    cache, api = MatchCache(memory_entries=0, disk_dir=str(tmp_path / 'cache')), FakeApi()
+    filepaths = [(str(tmp_path / f"match_{idx}.json{'.gz' if idx % 2 else ''}"), bool(idx % 2)) for idx in range(4)]
+
+    async def scenario():
+        return await asyncio.gather(*(
+            cache.get_or_download('EUW1_1', filepath, compress, api.download('EUW1_1', filepath, compress))
+            for filepath, compress in filepaths
+        ))
+
+    results = asyncio.run(scenario())
+
+    assert api.fetches == ['EUW1_1']
+    assert all(result == {'gameEndTimestamp': 1_700_000_000_000} for result in results)
+    assert all(read_payload(filepath, compress) == payload('EUW1_1') for filepath, compress in filepaths)
+
+    # later runs copy the match from the disk tier
+    filepath = str(tmp_path / 'match_again.json.gz')
+    cache = MatchCache(memory_entries=0, disk_dir=str(tmp_path / 'cache'))
+    result = asyncio.run(cache.get_or_download('EUW1_1', filepath, True, api.download('EUW1_1', filepath, True)))
+
+    assert api.fetches == ['EUW1_1']
+    assert result == {'gameEndTimestamp': 1_700_000_000_000}
+    assert read_payload(filepath, True) == payload('EUW1_1')
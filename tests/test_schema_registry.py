@@ -0,0 +1,39 @@
+import copy
+import logging
+
+from conftest import SNAPSHOTS_DIR, assert_same_row
+from services.riot_api import ExtractionPlan, SchemaRegistry, project_match_by_config
+from workers.export_statistics_worker import transform_match_data_full
+
+
+def test_projected_match_without_drift(snapshot, caplog):
+    registry = SchemaRegistry(SNAPSHOTS_DIR, projection=project_match_by_config)
+    projected = project_match_by_config(snapshot)
+    # a stored (projected) match of a new patch with the same shape
+    projected['info']['gameVersion'] = '14.24.1.1'
+
+    with caplog.at_level(logging.WARNING):
+        schema = registry.schema_of(projected)
+    assert schema.participant_keys == tuple(projected['info']['participants'][0])
+    assert registry.drifts == []
+    assert 'drift' not in caplog.text
+
+
+def test_unprojected_snapshots_report_projected_keys(snapshot):
+    registry = SchemaRegistry(SNAPSHOTS_DIR, report_drift=False)
+    projected = project_match_by_config(snapshot)
+    projected['info']['gameVersion'] = '14.24.1.1'
+
+    registry.schema_of(projected)
+    assert set(registry.drifts[0].removed_keys) == {'challenges', 'perks', 'missions'}
+
+
+def test_projected_match_uses_version_layout(snapshot, export_config):
+    export_config.PUUIDS = [snapshot['info']['participants'][0]['puuid']]
+    registry = SchemaRegistry(SNAPSHOTS_DIR, projection=project_match_by_config)
+    plan = ExtractionPlan(export_config.CSV_EXPORT_COLUMNS, registry=registry)
+    projected = project_match_by_config(snapshot)
+
+    context = plan.prepare(copy.deepcopy(projected))
+    assert context.layout is not None
+    assert_same_row(transform_match_data_full(copy.deepcopy(snapshot)), plan.extract(copy.deepcopy(projected)))
@@ -0,0 +1,23 @@
+import asyncio
+from workers import store_matches_worker
+from workers.store_matches_worker import StoreMatchesWorker
+
+
+def test_flush_interval_while_pages_keep_arriving(monkeypatch, executor, matches_repository):
+    # every clock reading is 10ms later, pages are always waiting in the queue
+    clock = iter(range(1_000_000))
+    monkeypatch.setattr(store_matches_worker.time, 'monotonic', lambda: next(clock) * 0.01)
+
+    async def scenario():
+        worker = StoreMatchesWorker(executor, bulk=True, flush_size=10_000, flush_interval=0.05)
+        worker.matches_repository = matches_repository
+        queue = asyncio.Queue()
+        for page in range(30):
+            queue.put_nowait(('puuid', [f"EUN1_{page}"], {'queue': None, 'type': None}))
+        queue.put_nowait(None)
+        await worker.run(queue)
+        return matches_repository.flushes
+
+    flushes = asyncio.run(scenario())
+    assert len(flushes) > 1
+    assert [match_id for flush in flushes for _, match_id in flush] == [f"EUN1_{page}" for page in range(30)]
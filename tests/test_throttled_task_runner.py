@@ -0,0 +1,208 @@
+import asyncio
+import heapq
+from itertools import count
+from types import SimpleNamespace
+
+import pytest
+
+from utils import throttled_task_runner
+from services.riot_api.riot_api_service import MATCH_IDS_BY_PUUID_ROUTE, MATCH_ROUTE, _RegionalClient
+from utils.throttled_task_runner import ThrottledTaskRunner, RateLimit, PacingPolicy, reserve_all, acquire_all
+
+
+class FakeClock:
+    """
+    Virtual `time.monotonic` - it only moves when every coroutine of `run` waits, then it jumps to the
+    earliest sleeper. `on_sleep` runs before the first sleeper is woken up (e.g. a 429 meanwhile).
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.on_sleep = None
+        self.__sleepers: list[tuple[float, int, asyncio.Future]] = []
+        self.__order = count()
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep_until(self, slot: float):
+        if self.on_sleep is not None:
+            on_sleep, self.on_sleep = self.on_sleep, None
+            on_sleep()
+        if slot <= self.now:
+            await asyncio.sleep(0)
+            return
+        woken = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.__sleepers, (slot, next(self.__order), woken))
+        await woken
+
+    async def run(self, *coroutines):
+        tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+        while not all(task.done() for task in tasks):
+            # lets the coroutines run until all of them wait (there is no real I/O)
+            for _ in range(20):
+                await asyncio.sleep(0)
+            if self.__sleepers:
+                slot, _, woken = heapq.heappop(self.__sleepers)
+                self.now = max(self.now, slot)
+                woken.set_result(None)
+        return [task.result() for task in tasks]
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(throttled_task_runner, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(throttled_task_runner, 'sleep_until', clock.sleep_until)
+    return clock
+
+
+def new_runner(*rate_limits: tuple[int, int]) -> ThrottledTaskRunner:
+    return ThrottledTaskRunner([RateLimit(value, time_window) for value, time_window in rate_limits],
+                               policy=PacingPolicy.BURST, margin=0)
+
+
+def test_permit_moved_past_a_pause_is_released(clock):
+    runner = new_runner((2, 10))
+    reserve_all([runner])
+    reserve_all([runner])
+
+    def got_429():
+        clock.now = 1
+        runner.pause(10)
+
+    # the third permit waits for the window (slot 10), the 429 comes meanwhile
+    clock.on_sleep = got_429
+    asyncio.run(clock.run(runner.acquire()))
+    assert clock.now == 11
+
+    # the slot 10 was given back - only the permit at 11 counts against the window
+    assert reserve_all([runner]) == 11
+
+
+def test_server_count_is_synced_into_the_running_count(clock):
+    runner = new_runner((5, 10))
+    for _ in range(2):
+        reserve_all([runner])
+
+    clock.now = 5
+    # other processes used the key as well
+    runner.sync_count(time_window=10, count=4)
+    assert reserve_all([runner]) == 5
+    assert reserve_all([runner]) == 10
+
+    # the first permits expired, the synced ones (at 5) still count
+    clock.now = 12
+    runner.sync_count(time_window=10, count=4)
+    assert reserve_all([runner]) == 12
+    assert reserve_all([runner]) == 15
+
+
+def granted_at(clock: FakeClock, runners: list[ThrottledTaskRunner], name: str, granted: list):
+    async def acquire():
+        await acquire_all(runners)
+        granted.append((name, clock.now))
+    return acquire()
+
+
+def test_every_window_is_enforced(clock):
+    runner = new_runner((3, 10), (5, 60))
+
+    slots = [reserve_all([runner]) for _ in range(6)]
+
+    assert slots == [0, 0, 0, 10, 10, 60]
+
+
+def test_no_window_is_ever_exceeded(clock):
+    rate_limits = [(4, 1), (10, 5)]
+    for policy in PacingPolicy:
+        runner = ThrottledTaskRunner([RateLimit(value, time_window) for value, time_window in rate_limits], policy=policy, margin=0)
+        slots = [reserve_all([runner]) for _ in range(100)]
+
+        assert slots == sorted(slots)
+        for value, time_window in rate_limits:
+            assert all(sum(1 for other in slots if slot - time_window < other <= slot) <= value for slot in slots)
+
+
+def test_spread_policy_paces_by_the_slowest_window(clock):
+    runner = ThrottledTaskRunner([RateLimit(2, 1), RateLimit(10, 10)], policy=PacingPolicy.SPREAD, margin=0)
+
+    assert [reserve_all([runner]) for _ in range(4)] == [0, 1, 2, 3]
+
+
+def test_method_limit_gates_only_its_own_callers(clock):
+    app, method_a, method_b = new_runner((10, 10)), new_runner((1, 10)), new_runner((1, 10))
+    granted = []
+
+    asyncio.run(clock.run(
+        granted_at(clock, [app, method_a], 'a1', granted),
+        granted_at(clock, [app, method_a], 'a2', granted),
+        granted_at(clock, [app, method_b], 'b1', granted),
+    ))
+
+    # the second caller of method a doesn't hold an app permit (nor the callers behind it) while it waits
+    assert granted == [('a1', 0), ('b1', 0), ('a2', 10)]
+    assert app.earliest() == 10
+
+
+def test_app_limit_gates_every_method(clock):
+    app, method_a, method_b = new_runner((2, 10)), new_runner((5, 10)), new_runner((5, 10))
+    granted = []
+
+    asyncio.run(clock.run(*(
+        granted_at(clock, [app, method], name, granted)
+        for name, method in [('a1', method_a), ('b1', method_b), ('a2', method_a), ('b2', method_b)]
+    )))
+
+    assert granted == [('a1', 0), ('b1', 0), ('a2', 10), ('b2', 10)]
+
+
+def test_paused_limiter_resumes_after_retry_after(clock):
+    runner = new_runner((10, 10))
+    reserve_all([runner])
+
+    clock.now = 1
+    runner.pause(5)
+
+    assert reserve_all([runner]) == 6
+
+
+def test_429_pauses_only_the_exceeded_limit(clock):
+    async def scenario():
+        client = _RegionalClient('europe')
+        try:
+            granted = []
+            clock.now = 1
+            assert client.pause(MATCH_ROUTE, 'method', 5)
+            # the underlying service is overloaded - none of our limits is paused
+            assert not client.pause(MATCH_ROUTE, 'service', 60)
+            await clock.run(
+                granted_at(clock, client.rate_limiters(MATCH_ROUTE), 'match', granted),
+                granted_at(clock, client.rate_limiters(MATCH_IDS_BY_PUUID_ROUTE), 'match ids', granted),
+            )
+            assert granted == [('match ids', 1), ('match', 6)]
+
+            assert client.pause(MATCH_IDS_BY_PUUID_ROUTE, 'application', 10)
+            granted.clear()
+            await clock.run(granted_at(clock, client.rate_limiters(MATCH_ROUTE), 'match', granted))
+            assert granted == [('match', 16)]
+        finally:
+            await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_window_is_synced_with_the_rate_limit_headers(clock):
+    async def scenario():
+        client = _RegionalClient('europe')
+        try:
+            # the key was used by another process as well - 3 of 3 requests of this second are gone
+            client.adapt_rate_limits(MATCH_ROUTE, {'X-App-Rate-Limit': '3:1,100:120', 'X-App-Rate-Limit-Count': '3:1,3:120'})
+            granted = []
+            await clock.run(granted_at(clock, client.rate_limiters(MATCH_ROUTE), 'match', granted))
+            return granted
+        finally:
+            await client.close()
+
+    [(_, slot)] = asyncio.run(scenario())
+    assert slot >= 1